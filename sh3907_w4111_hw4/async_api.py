@@ -0,0 +1,343 @@
+"""
+asyncio facade for RedisFunctions and FanGraph.
+
+pymysql and py2neo are blocking, so calls run on a thread pool and are awaited from the event loop. The
+thread pool and the MySQL connection pool bound how many queries run at once. Any number of requests
+can be awaited concurrently, the rest queue up for a thread.
+
+Cache reads can skip the thread pool. Given a redis.asyncio client, AsyncRedisFunctions reads cached
+values on the event loop and only goes to a thread on a miss.
+
+    arf = AsyncRedisFunctions(async_redis=redis.asyncio.StrictRedis(host="localhost", port=6379))
+    afg = AsyncFanGraph()
+    page = await player_page(arf, afg, "ortizda01", "BOS", 2013)
+"""
+
+import asyncio
+import functools
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBridge:
+    """
+    Runs blocking calls on a thread pool.
+    """
+
+    def __init__(self, executor=None, max_workers=32):
+        """
+        :param executor: Executor to run calls on. A ThreadPoolExecutor with max_workers threads is
+            created if None, and shut down by close().
+        """
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+
+    async def run(self, f, *args, **kwargs):
+        """
+        :return: f(*args, **kwargs), called on the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(f, *args, **kwargs))
+
+    async def iterate(self, rows, batch_size=100):
+        """
+        Iterates a blocking generator, e.g. from iter_by_template, pulling batch_size items per thread
+        pool call.
+
+        :return: An async generator of the items.
+        """
+        rows = iter(rows)
+        try:
+            while True:
+                batch = await self.run(lambda: list(islice(rows, batch_size)))
+                if not batch:
+                    break
+                for r in batch:
+                    yield r
+        finally:
+            close = getattr(rows, "close", None)
+            if close is not None:
+                await self.run(close)
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+
+
+def bridged(name):
+    """
+    :return: An async method calling the blocking method of the same name on self.target.
+    """
+    async def method(self, *args, **kwargs):
+        return await self.run(getattr(self.target, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "Awaitable {}.".format(name)
+    return method
+
+
+class AsyncRedisFunctions(AsyncBridge):
+
+    def __init__(self, rf=None, executor=None, max_workers=32, async_redis=None):
+        """
+        :param rf: The RedisFunctions to run. By default one is created whose MySQL connection pool
+            matches max_workers.
+        :param async_redis: A redis.asyncio client with decode_responses=False on the same Redis. If given,
+            cache hits are read on the event loop.
+        """
+        super().__init__(executor, max_workers)
+
+        if rf is None:
+            from redis_func import RedisFunctions
+            from redis_helper import MysqlHelpers
+            rf = RedisFunctions(db=MysqlHelpers(pool_max_size=max_workers))
+
+        self.rf = self.target = rf
+        self.ar = async_redis
+        if async_redis is not None:
+            # Creates the blocking clients and the CacheBudget here rather than on the event loop.
+            rf.connect_redis()
+
+    async def retrieve_by_template(self, table, template, fields=None, limit=None, offset=None, order_by=None,
+                                   use_cache=False):
+        """
+        Awaitable RedisFunctions.retrieve_by_template. With an async client, a miss goes straight to the
+        fill on the thread pool.
+        """
+        if not use_cache or self.ar is None:
+            return await self.run(self.rf.retrieve_by_template, table, template, fields, limit, offset, order_by,
+                                  use_cache)
+
+        key = self.rf.generate_key(table, template, fields, limit, offset, order_by)
+        generation = self.rf.l1.generation if self.rf.l1 is not None else None
+        rows = await self.check_cache(table, template, fields, limit, offset, order_by)
+        if rows:
+            return rows
+
+        return await self.run(self.rf.single_flight, key,
+                              lambda: self.rf.fill(key, table, template, fields, limit, offset, order_by, generation))
+
+    async def check_cache(self, table, template, fields=None, limit=None, offset=None, order_by=None):
+        """
+        Reads a cached result from L1, then Redis on the event loop, like RedisFunctions.check_cache.
+        The LRU/LFU bookkeeping, the stale while revalidate check and key_compat migrations use the
+        blocking client, so they are handed to the thread pool without waiting.
+
+        :return: The rows, or None on a miss.
+        """
+        rf = self.rf
+        key = rf.generate_key(table, template, fields, limit, offset, order_by)
+
+        generation = None
+        if rf.l1 is not None:
+            rows = rf.l1.get(key)
+            if rows is not None:
+                return rows
+            generation = rf.l1.generation
+
+        loop = asyncio.get_running_loop()
+        rows = rf.codec.decode(await self.ar.get(key))
+        if not rows and rf.key_compat:
+            legacy_key = rf.generate_legacy_key(table, template, fields, limit, offset, order_by)
+            rows = rf.codec.decode(await self.ar.get(legacy_key))
+            if rows:
+                loop.run_in_executor(self.executor, self.migrate, legacy_key, key, table, template, fields, limit,
+                                     offset, order_by, rows)
+                rf.metrics.incr("cache_hits_total", table=table)
+                return rows
+
+        if not rows:
+            rf.metrics.incr("cache_misses_total", table=table)
+            logger.debug("CACHE MISS key=%s", key)
+            return None
+
+        rf.metrics.incr("cache_hits_total", table=table)
+        logger.debug("CACHE HIT key=%s", key)
+        if rf.budget.enabled:
+            loop.run_in_executor(self.executor, rf.budget.touch, key)
+        if rf.stale_while_revalidate is not None or rf.l1 is not None:
+            loop.run_in_executor(self.executor, self.refresh_if_stale, key, table, template, fields, limit,
+                                 offset, order_by, rows, generation)
+        return rows
+
+    def migrate(self, legacy_key, key, table, template, fields, limit, offset, order_by, rows):
+        if self.rf.add_to_cache(table, template, fields, limit, offset, order_by, rows):
+            logger.info("Migrated cache key=%s to key=%s", legacy_key, key)
+
+    def refresh_if_stale(self, key, table, template, fields, limit, offset, order_by, rows=None, generation=None):
+        if self.rf.is_stale(table, key):
+            self.rf.refresh_in_background(key, table, template, fields, limit, offset, order_by)
+        elif self.rf.l1 is not None and rows is not None:
+            self.rf.l1.put(key, rows, generation)
+
+    async def retrieve_all(self, table, templates, fields=None, order_by=None, use_cache=True):
+        """
+        Runs retrieve_by_template for every template concurrently.
+
+        :return: A list with the rows for each template, in the order of templates.
+        """
+        return await asyncio.gather(*[self.retrieve_by_template(table, t, fields, None, None, order_by, use_cache)
+                                      for t in templates])
+
+    async def stream_by_template(self, table, template, fields=None, limit=None, offset=None, order_by=None,
+                                 use_cache=False, chunk_size=1000):
+        """
+        Async generator over RedisFunctions.stream_by_template.
+        """
+        rows = self.rf.stream_by_template(table, template, fields, limit, offset, order_by, use_cache, chunk_size)
+        async for r in self.iterate(rows, chunk_size):
+            yield r
+
+    retrieve_many = bridged("retrieve_many")
+    invalidate = bridged("invalidate")
+    delete_keys = bridged("delete_keys")
+
+    async def close(self):
+        if self.ar is not None:
+            await self.ar.aclose()
+        super().close()
+
+
+class AsyncFanGraph(AsyncBridge):
+
+    def __init__(self, fg=None, executor=None, max_workers=32, **kwargs):
+        """
+        :param fg: The FanGraph to run. Created with kwargs if None.
+        """
+        super().__init__(executor, max_workers)
+
+        if fg is None:
+            from fan_graph import FanGraph
+            fg = FanGraph(**kwargs)
+
+        self.fg = self.target = fg
+
+    get_fan = bridged("get_fan")
+    get_player = bridged("get_player")
+    get_team = bridged("get_team")
+    get_comment = bridged("get_comment")
+    get_appearance = bridged("get_appearance")
+    get_sub_comments = bridged("get_sub_comments")
+    get_player_comments = bridged("get_player_comments")
+    get_team_comments = bridged("get_team_comments")
+    get_players_by_team = bridged("get_players_by_team")
+    get_roster = bridged("get_roster")
+    find_nodes_by_template = bridged("find_nodes_by_template")
+
+    create_fan = bridged("create_fan")
+    create_player = bridged("create_player")
+    create_team = bridged("create_team")
+    create_supports = bridged("create_supports")
+    create_follows = bridged("create_follows")
+    create_appearance_all = bridged("create_appearance_all")
+    create_comment = bridged("create_comment")
+    create_sub_comment = bridged("create_sub_comment")
+    create_comments = bridged("create_comments")
+
+    bulk_load_players = bridged("bulk_load_players")
+    bulk_load_teams = bridged("bulk_load_teams")
+    bulk_load_appearances = bridged("bulk_load_appearances")
+
+    async def iter_comment_thread(self, comment_id, max_depth=None, page_size=100, after=None):
+        async for r in self.iterate(self.fg.iter_comment_thread(comment_id, max_depth, page_size, after),
+                                    page_size):
+            yield r
+
+    async def iter_team_comments(self, team_id, page_size=100, after=None):
+        async for r in self.iterate(self.fg.iter_team_comments(team_id, page_size, after), page_size):
+            yield r
+
+    async def iter_player_comments(self, player_id, page_size=100, after=None):
+        async for r in self.iterate(self.fg.iter_player_comments(player_id, page_size, after), page_size):
+            yield r
+
+    async def bulk_write(self, name, q, rows, batch_size=1000, retries=3, invalidates=None, concurrency=4):
+        """
+        Like FanGraph.bulk_write, with up to concurrency batches in flight at once. Concurrent MERGEs
+        on the same nodes can deadlock, the deadlocked batch is retried like any transient error.
+        The next batch is only read from rows once a batch finished, so at most concurrency batches
+        are held in memory.
+
+        :param rows: An iterable of rows. It is read on the event loop, so it should not block.
+        :param invalidates: Function giving the cached (method, args) a committed batch makes stale.
+        :return: The summed load statistics.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        stats = {"rows": 0, "batches": 0, "failed_batches": 0, "failed_rows": 0}
+
+        def add(done):
+            for t in done:
+                s = t.result()
+                for k in stats:
+                    stats[k] += s[k]
+
+        rows = iter(rows)
+        pending = set()
+        try:
+            while True:
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    add(done)
+
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                pending.add(asyncio.ensure_future(
+                    self.run(self.fg.bulk_write, name, q, batch, len(batch), retries, invalidates)))
+
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                add(done)
+        finally:
+            # Only left over if reading rows or a batch raised.
+            for t in pending:
+                t.cancel()
+
+        stats["seconds"] = loop.time() - start
+        stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        logger.info("Loaded %d %s in %.1f seconds (%.0f rows/sec) with %d batches in flight.",
+                    stats["rows"], name, stats["seconds"], stats["rows_per_sec"], concurrency)
+        return stats
+
+    async def close(self):
+        super().close()
+
+
+async def player_page(arf, afg, player_id, team_id, year):
+    """
+    Example of fanning out one request. The People row, the team's comments and the roster are fetched
+    concurrently from Redis/MySQL and Neo4j, so the page takes as long as the slowest call instead of
+    the sum of all three.
+
+    :return: {"player": People rows, "team_comments": list of Relationship, "roster": list of Player Nodes}
+    """
+    player, comments, roster = await asyncio.gather(
+        arf.retrieve_by_template("People", {"playerID": player_id}, use_cache=True),
+        afg.get_team_comments(team_id),
+        afg.get_roster(team_id, year))
+
+    return {"player": player, "team_comments": comments, "roster": roster}
+
+
+async def main(player_id="ortizda01", team_id="BOS", year=2013):
+    import redis.asyncio
+
+    arf = AsyncRedisFunctions(async_redis=redis.asyncio.StrictRedis(host="localhost", port=6379))
+    afg = AsyncFanGraph(check_schema=False)
+    try:
+        page = await player_page(arf, afg, player_id, team_id, int(year))
+        print("player:", page["player"])
+        print("team comments:", len(page["team_comments"]))
+        print("roster:", len(page["roster"]))
+    finally:
+        await arf.close()
+        await afg.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*sys.argv[1:]))
@@ -0,0 +1,550 @@
+"""
+Benchmarks for the cache, MySQL and graph paths.
+
+Every backend has a local stand-in, so the suite runs anywhere:
+  - Redis: fakeredis, or the local Redis server with --redis local,
+  - MySQL: SqliteHelpers, a MysqlHelpers over a SQLite file seeded with a synthetic lahman2017 subset,
+    or the local lahman2017 with --mysql local,
+  - Neo4j: a FanGraph over a RecordingGraph, whose transactions only count statements and sleep for a
+    simulated round trip (DEFAULT_GRAPH_LATENCY, set with --graph-latency), or the local Neo4j with
+    --graph local.
+
+Each scenario reports p50/p95/p99 latency, throughput and the peak memory traced by tracemalloc. Memory
+tracing slows allocations down, use --no-memory for latencies closer to production. Results can be
+saved as a JSON baseline and diffed against a previous one:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+--cold-start instead measures, in fresh interpreters, how long importing and constructing the clients
+takes, and which drivers that loads.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from redis_helper import MysqlHelpers
+
+
+class SqliteHelpers(MysqlHelpers):
+    """
+    MysqlHelpers over a SQLite file. Supports the read paths, find_by_template, iter_by_template and
+    everything built on them, and insert. The %s placeholders are rewritten to SQLite's ?.
+    """
+
+    def __init__(self, path, pool_min_size=1, pool_max_size=10, pool_timeout=5.0):
+        self.path = path
+        super().__init__(pool_min_size, pool_max_size, pool_timeout)
+
+    def get_new_connection(self, params=None):
+        # Autocommit, like the MySQL connections.
+        cnx = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        cnx.row_factory = lambda cursor, row: {d[0]: v for d, v in zip(cursor.description, row)}
+        return cnx
+
+    def set_config(self):
+        self.db_schema = "main"
+        self.default_db_params = {"path": self.path}
+        return self.default_db_params
+
+    def get_column_types(self, table):
+        types = self.column_types.get(table)
+        if types is None:
+            with self.pool.connection() as cnx:
+                rows = cnx.execute("PRAGMA table_info(" + table + ")").fetchall()
+            types = {r["name"]: r["type"].lower() for r in rows}
+            self.column_types[table] = types
+        return types
+
+    def get_primary_key(self, table):
+        key = self.primary_keys.get(table)
+        if key is None:
+            with self.pool.connection() as cnx:
+                rows = cnx.execute("PRAGMA table_info(" + table + ")").fetchall()
+            key = [r["name"] for r in sorted(rows, key=lambda r: r["pk"]) if r["pk"]]
+            self.primary_keys[table] = key
+        return key
+
+    def last_insert_id(self, cnx):
+        return cnx.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
+
+    def run_q(self, cnx, q, args, fetch=False, commit=True):
+        with self.metrics.timer("mysql_query_seconds"):
+            cursor = cnx.execute(q.replace("%s", "?"), args)
+            result = cursor.fetchall() if fetch else cursor.rowcount
+        self.metrics.incr("mysql_round_trips_total")
+        if commit:
+            cnx.commit()
+        return result
+
+    def iter_by_template(self, table, t, fields=None, limit=None, offset=None, orderBy=None, batch_size=None):
+        q, args = self.build_select(table, t, fields, limit, offset, orderBy)
+
+        cnx = self.pool.acquire()
+        try:
+            cursor = cnx.execute(q.replace("%s", "?"), args)
+            while True:
+                rows = cursor.fetchmany(batch_size or 1000)
+                if not rows:
+                    break
+                if batch_size:
+                    yield rows
+                else:
+                    for r in rows:
+                        yield r
+        finally:
+            self.pool.release(cnx)
+
+
+def seed_lahman(path, n_players=5000, n_teams=30, first_year=1990, last_year=2017, seed=0):
+    """
+    Creates People, Teams, Batting and Appearances tables shaped like lahman2017 in a SQLite file.
+    Each player has a career of 1 to 10 consecutive seasons, each with one team.
+
+    :return: {table: number of rows}
+    """
+    rng = random.Random(seed)
+    teams = ["T{:02d}".format(i) for i in range(n_teams)]
+
+    cnx = sqlite3.connect(path)
+    cnx.executescript("""
+        CREATE TABLE People (playerID TEXT PRIMARY KEY, nameFirst TEXT, nameLast TEXT, birthYear INTEGER,
+                             bats TEXT, throws TEXT);
+        CREATE TABLE Teams (yearID INTEGER, teamID TEXT, lgID TEXT, name TEXT, W INTEGER, L INTEGER,
+                            PRIMARY KEY (yearID, teamID));
+        CREATE TABLE Batting (playerID TEXT, yearID INTEGER, stint INTEGER, teamID TEXT, G INTEGER,
+                              AB INTEGER, H INTEGER, HR INTEGER, RBI INTEGER);
+        CREATE TABLE Appearances (yearID INTEGER, teamID TEXT, playerID TEXT, G_all INTEGER);
+        CREATE INDEX batting_player ON Batting (playerID);
+        CREATE INDEX batting_team_year ON Batting (teamID, yearID);
+        CREATE INDEX appearances_team_year ON Appearances (teamID, yearID);
+    """)
+
+    people, batting, appearances = [], [], []
+    for i in range(n_players):
+        player_id = "player{:05d}".format(i)
+        people.append((player_id, "First{}".format(i), "Last{}".format(i % 997), rng.randint(1950, 1995),
+                       rng.choice("LRB"), rng.choice("LR")))
+
+        start = rng.randint(first_year, last_year)
+        for year in range(start, min(last_year, start + rng.randint(0, 9)) + 1):
+            team = rng.choice(teams)
+            games = rng.randint(1, 162)
+            ab = games * rng.randint(0, 4)
+            batting.append((player_id, year, 1, team, games, ab, ab // 4, rng.randint(0, 40), rng.randint(0, 120)))
+            appearances.append((year, team, player_id, games))
+
+    team_rows = [(year, team, "AL" if j % 2 else "NL", "Team {}".format(team), rng.randint(50, 110), 0)
+                 for year in range(first_year, last_year + 1) for j, team in enumerate(teams)]
+
+    cnx.executemany("INSERT INTO People VALUES (?,?,?,?,?,?)", people)
+    cnx.executemany("INSERT INTO Teams VALUES (?,?,?,?,?,?)", team_rows)
+    cnx.executemany("INSERT INTO Batting VALUES (?,?,?,?,?,?,?,?,?)", batting)
+    cnx.executemany("INSERT INTO Appearances VALUES (?,?,?,?)", appearances)
+    cnx.commit()
+    cnx.close()
+
+    return {"People": len(people), "Teams": len(team_rows), "Batting": len(batting),
+            "Appearances": len(appearances)}
+
+
+class RecordingCursor:
+
+    def __iter__(self):
+        return iter(())
+
+    def evaluate(self):
+        return None
+
+
+# Simulated Neo4j round trip of the recording graph, about a bolt statement on a local network.
+DEFAULT_GRAPH_LATENCY = 0.0005
+
+
+class RecordingTransaction:
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def run(self, q, args=None):
+        self.graph.statements += 1
+        self.graph.rows += len((args or {}).get("rows") or ())
+        if self.graph.latency:
+            time.sleep(self.graph.latency)
+        return RecordingCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class RecordingGraph:
+    """
+    Stands in for a py2neo Graph. Counts transactions, statements and rows sent with $rows, and sleeps
+    latency seconds per statement to simulate a round trip. Queries return nothing.
+    """
+
+    def __init__(self, latency=None):
+        if latency is None:
+            latency = DEFAULT_GRAPH_LATENCY
+        self.latency = latency
+        self.transactions = 0
+        self.statements = 0
+        self.rows = 0
+
+    def begin(self, autocommit=False):
+        self.transactions += 1
+        return RecordingTransaction(self)
+
+
+def recording_fan_graph(latency=None):
+    """
+    :return: A FanGraph writing to a RecordingGraph instead of Neo4j.
+    """
+    from fan_graph import FanGraph
+    from instrumentation import NOOP_METRICS
+
+    fg = FanGraph.__new__(FanGraph)
+    fg._graph = fg._read_graph = RecordingGraph(latency)
+    fg.retries = 3
+    fg.cache = None
+    fg.materialize_rosters = True
+    fg.metrics = NOOP_METRICS
+    return fg
+
+
+def make_redis_functions(db, backend="fake"):
+    """
+    :param backend: "fake" for fakeredis, "local" for the Redis server on localhost.
+    :return: A RedisFunctions reading from db.
+    """
+    import redis_func
+
+    if backend != "fake":
+        return redis_func.RedisFunctions(db=db)
+
+    import fakeredis
+    server = fakeredis.FakeServer()
+
+    def connect(*args, decode_responses=False, **kwargs):
+        return fakeredis.FakeStrictRedis(server=server, decode_responses=decode_responses)
+
+    # Every client RedisFunctions creates shares one fake server. The clients are created on first use,
+    # so connect while the patch is active.
+    with mock.patch("redis.StrictRedis", connect):
+        rf = redis_func.RedisFunctions(db=db)
+        rf.connect_redis()
+    return rf
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def measure(ops, workers=1, trace_memory=True):
+    """
+    Runs the ops, timing each one.
+
+    :param ops: List of functions taking no arguments.
+    :param workers: Threads running the ops. 1 runs them in this thread.
+    :return: {"n", "p50_ms", "p95_ms", "p99_ms", "mean_ms", "ops_per_sec", "peak_kb"}
+    """
+    def timed(op):
+        start = time.perf_counter()
+        op()
+        return time.perf_counter() - start
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    if workers == 1:
+        latencies = [timed(op) for op in ops]
+    else:
+        with ThreadPoolExecutor(workers) as ex:
+            latencies = list(ex.map(timed, ops))
+    wall = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {"n": len(latencies),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 4),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 4),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else 0.0,
+            "ops_per_sec": round(len(latencies) / wall, 1) if wall > 0 else 0.0,
+            "peak_kb": round(peak / 1024, 1) if peak is not None else None}
+
+
+def cache_mix_ops(rf, player_ids, hit_ratio, n, rng, hot_size=100):
+    """
+    Clears the cached People results, warms hot_size of them and returns n People lookups of which
+    about hit_ratio are hits on the warm keys. The others are each a different, cold key.
+    """
+    rf.delete_keys("People")
+    hot, cold = player_ids[:hot_size], iter(player_ids[hot_size:])
+
+    for pid in hot:
+        rf.retrieve_by_template("People", {"playerID": pid}, use_cache=True)
+
+    ops = []
+    for i in range(n):
+        pid = rng.choice(hot) if rng.random() < hit_ratio else next(cold, None) or rng.choice(hot)
+        ops.append(lambda pid=pid: rf.retrieve_by_template("People", {"playerID": pid}, use_cache=True))
+    return ops
+
+
+def run_suite(redis_backend="fake", mysql_backend="sqlite", graph_backend="recording", n=2000, seed=0,
+              graph_latency=None, trace_memory=True, workers=(1, 4, 16)):
+    """
+    Runs every scenario.
+
+    :param graph_latency: Seconds the recording graph sleeps per statement. DEFAULT_GRAPH_LATENCY if None.
+    :return: {"meta": {...}, "results": {scenario: stats}}
+    """
+    if graph_latency is None:
+        graph_latency = DEFAULT_GRAPH_LATENCY
+    rng = random.Random(seed)
+    results = {}
+    meta = {"python": platform.python_version(), "platform": platform.platform(), "redis": redis_backend,
+            "mysql": mysql_backend, "graph": graph_backend, "n": n, "seed": seed,
+            "graph_latency": graph_latency, "trace_memory": trace_memory,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    tmp_dir = None
+    if mysql_backend == "sqlite":
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "lahman.db")
+        meta["rows"] = seed_lahman(path, n_players=max(5000, 2 * n), seed=seed)
+        make_db = lambda pool_size: SqliteHelpers(path, pool_max_size=pool_size)
+    else:
+        make_db = lambda pool_size: MysqlHelpers(pool_max_size=pool_size)
+
+    try:
+        db = make_db(max(workers))
+        rf = make_redis_functions(db, redis_backend)
+
+        player_ids = [r["playerID"] for r in db.find_by_template("People", None, ["playerID"],
+                                                                 orderBy={"fields": ["playerID"]})]
+        team_years = [(r["teamID"], r["yearID"]) for r in db.find_by_template("Teams", None, ["teamID", "yearID"])]
+        rng.shuffle(player_ids)
+
+        for hit_ratio in (0.0, 0.5, 0.9, 0.99):
+            ops = cache_mix_ops(rf, player_ids, hit_ratio, n, rng)
+            results["cache_hit_ratio_{:.2f}".format(hit_ratio)] = measure(ops, trace_memory=trace_memory)
+
+        ops = []
+        for i in range(n):
+            team_id, year = rng.choice(team_years)
+            ops.append(lambda t={"teamID": team_id, "yearID": year}: db.find_by_template("Batting", t))
+        results["mysql_batting_by_team_year"] = measure(ops, trace_memory=trace_memory)
+
+        rf.delete_keys("People")
+        batches = [rng.sample(player_ids, 100) for i in range(max(1, n // 100))]
+        ops = [lambda b=b: rf.retrieve_many("People", [{"playerID": pid} for pid in b]) for b in batches]
+        results["retrieve_many_100"] = measure(ops, trace_memory=trace_memory)
+
+        for w in workers:
+            ops = cache_mix_ops(rf, player_ids, 0.9, n, rng)
+            results["concurrent_hit_ratio_0.90_workers_{}".format(w)] = measure(ops, workers=w,
+                                                                                 trace_memory=trace_memory)
+
+        appearances = [{"player_id": r["playerID"], "team_id": r["teamID"], "year": r["yearID"],
+                        "games": r["G_all"]}
+                       for r in db.iter_by_template("Appearances", None, ["playerID", "teamID", "yearID", "G_all"])]
+
+        for name, batch_size in (("graph_bulk_appearances_1000", 1000), ("graph_bulk_appearances_100", 100)):
+            fg = make_fan_graph(graph_backend, graph_latency)
+            stats = measure([lambda: fg.bulk_load_appearances(appearances, batch_size)], trace_memory=trace_memory)
+            stats["rows_per_sec"] = round(len(appearances) / (stats["mean_ms"] / 1000), 1) if stats["mean_ms"] else 0.0
+            stats.update(graph_counts(fg))
+            results[name] = stats
+
+        fg = make_fan_graph(graph_backend, graph_latency)
+        sample = appearances[:n]
+        ops = [lambda a=a: fg.create_appearance_all(a["player_id"], a["team_id"], a["year"], a["games"])
+               for a in sample]
+        stats = measure(ops, trace_memory=trace_memory)
+        stats["rows_per_sec"] = stats["ops_per_sec"]
+        stats.update(graph_counts(fg))
+        results["graph_row_by_row_appearances"] = stats
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    return {"meta": meta, "results": results}
+
+
+def make_fan_graph(backend, latency):
+    if backend == "recording":
+        return recording_fan_graph(latency)
+    from fan_graph import FanGraph
+    return FanGraph(check_schema=False)
+
+
+def graph_counts(fg):
+    g = fg._graph
+    if isinstance(g, RecordingGraph):
+        return {"transactions": g.transactions, "statements": g.statements}
+    return {}
+
+
+# Metrics where a larger value is an improvement. For the others a smaller value is.
+HIGHER_IS_BETTER = ("ops_per_sec", "rows_per_sec")
+COMPARED_METRICS = ("p50_ms", "p95_ms", "p99_ms", "ops_per_sec", "rows_per_sec", "peak_kb")
+
+
+def compare(current, baseline, threshold=0.10):
+    """
+    :param current: Result of run_suite.
+    :param baseline: A previous result of run_suite.
+    :param threshold: Relative change counted as a regression or improvement.
+    :return: (list of report lines, number of regressions)
+    """
+    lines = []
+    regressions = 0
+
+    for k in ("redis", "mysql", "graph", "graph_latency"):
+        a, b = baseline["meta"].get(k), current["meta"].get(k)
+        if a != b:
+            lines.append("{:<44} {} -> {}, results are not comparable".format(k, a, b))
+
+    for scenario, stats in current["results"].items():
+        old = baseline["results"].get(scenario)
+        if old is None:
+            lines.append("{:<44} new scenario".format(scenario))
+            continue
+
+        for metric in COMPARED_METRICS:
+            a, b = old.get(metric), stats.get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif worse < -threshold:
+                flag = "improved"
+            lines.append("{:<44} {:<12} {:>12} -> {:>12} {:>+8.1%} {}".format(scenario, metric, a, b, change, flag))
+
+    return lines, regressions
+
+
+# Run in a fresh interpreter by cold_start(). Construction must not need a server, so it stops short of
+# the first query.
+COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import redis_func
+import fan_graph
+imported = time.perf_counter()
+rf = redis_func.RedisFunctions()
+fg = fan_graph.FanGraph()
+constructed = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "construct_ms": (constructed - imported) * 1000,
+                  "drivers": sorted(m for m in ("redis", "pymysql", "py2neo") if m in sys.modules)}))
+"""
+
+
+def cold_start(repeat=5):
+    """
+    :return: {"import_ms", "construct_ms", "total_ms", "drivers"}, with the median times over repeat
+        fresh interpreters.
+    """
+    runs = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], check=True, capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    result = {"drivers": runs[-1]["drivers"]}
+    for k in ("import_ms", "construct_ms"):
+        result[k] = round(sorted(r[k] for r in runs)[len(runs) // 2], 1)
+    result["total_ms"] = round(result["import_ms"] + result["construct_ms"], 1)
+    return result
+
+
+def print_results(suite):
+    meta = suite["meta"]
+    graph = meta["graph"]
+    if graph == "recording":
+        graph += ", {:g} ms per statement".format(meta["graph_latency"] * 1000)
+    print("redis: {}, mysql: {}, graph: {}".format(meta["redis"], meta["mysql"], graph))
+    print("{:<44} {:>8} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+        "scenario", "n", "p50 ms", "p95 ms", "p99 ms", "ops/sec", "peak KB"))
+    for scenario, s in suite["results"].items():
+        print("{:<44} {:>8} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+            scenario, s["n"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s.get("rows_per_sec", s["ops_per_sec"]),
+            s["peak_kb"] if s["peak_kb"] is not None else "-"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the cache, MySQL and graph paths.")
+    parser.add_argument("--redis", choices=("fake", "local"), default="fake")
+    parser.add_argument("--mysql", choices=("sqlite", "local"), default="sqlite")
+    parser.add_argument("--graph", choices=("recording", "local"), default="recording")
+    parser.add_argument("-n", type=int, default=2000, help="Operations per scenario.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--graph-latency", type=float, default=DEFAULT_GRAPH_LATENCY,
+                        help="Seconds the recording graph sleeps per statement, 0 for none.")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Diff the results against this JSON baseline.")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--cold-start", action="store_true",
+                        help="Measure import and construction time of the clients instead.")
+    args = parser.parse_args(argv)
+
+    if args.cold_start:
+        result = cold_start()
+        print("import {import_ms} ms, construct {construct_ms} ms, total {total_ms} ms, drivers loaded: {}".format(
+            ", ".join(result["drivers"]) or "none", **result))
+        return 0
+
+    suite = run_suite(args.redis, args.mysql, args.graph, args.n, args.seed, args.graph_latency,
+                      not args.no_memory)
+
+    print_results(suite)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(suite, f, indent=2)
+        print("Saved results to", args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(suite, baseline, args.threshold)
+        print("\nCompared with {} ({}):".format(args.compare, baseline["meta"].get("time")))
+        for line in lines:
+            print(line)
+        print("{} regressions over {:.0%}.".format(regressions, args.threshold))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Codecs for the values in the Redis result cache.
+
+A cached value is a list of row dictionaries. Apart from the plain JSON the cache always used, a
+CacheCodec can write
+  - a columnar layout: the column names once, then one array of values per column,
+  - msgpack instead of JSON text (needs the msgpack package),
+  - zlib or lz4 compression (lz4 needs the lz4 package) for values over a size threshold.
+
+Every value that is not plain JSON starts with a 5 byte header: the magic b"RC", the format version,
+the layout/encoding byte and the compression byte. decode() reads the header, so any codec can read
+values written by any other codec, and values without the header are read as plain JSON.
+
+Run this module to compare the codecs on a synthetic Batting result.
+"""
+
+import json
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+MAGIC = b"RC"
+VERSION = 1
+
+LAYOUT_ROWS = 0
+LAYOUT_COLUMNAR = 1
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZ4 = 2
+
+LAYOUTS = {"rows": LAYOUT_ROWS, "columnar": LAYOUT_COLUMNAR}
+ENCODINGS = {"json": ENCODING_JSON, "msgpack": ENCODING_MSGPACK}
+COMPRESSIONS = {None: COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "lz4": COMPRESSION_LZ4}
+
+
+class CacheCodec:
+
+    def __init__(self, layout="rows", encoding="json", compression=None, compress_threshold=4096,
+                 compress_level=6):
+        """
+        The default codec writes plain JSON without a header, which clients that predate codecs can
+        still read.
+
+        :param layout: "rows" or "columnar".
+        :param encoding: "json" or "msgpack".
+        :param compression: None, "zlib" or "lz4".
+        :param compress_threshold: Encoded values smaller than this many bytes are not compressed.
+        :param compress_level: zlib compression level.
+        """
+        if layout not in LAYOUTS:
+            raise ValueError("Invalid layout {}. Use one of {}.".format(layout, list(LAYOUTS)))
+        if encoding not in ENCODINGS:
+            raise ValueError("Invalid encoding {}. Use one of {}.".format(encoding, list(ENCODINGS)))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Invalid compression {}. Use one of {}.".format(compression, list(COMPRESSIONS)))
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("The msgpack encoding needs the msgpack package.")
+        if compression == "lz4" and lz4 is None:
+            raise ValueError("lz4 compression needs the lz4 package.")
+
+        self.layout = layout
+        self.encoding = encoding
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    @property
+    def plain(self):
+        return self.layout == "rows" and self.encoding == "json" and self.compression is None
+
+    def __repr__(self):
+        return "CacheCodec(layout={}, encoding={}, compression={})".format(
+            self.layout, self.encoding, self.compression)
+
+    def encode(self, rows):
+        """
+        :param rows: A list of row dictionaries.
+        :return: The encoded value as bytes.
+        """
+        if self.plain:
+            return json.dumps(rows, default=str).encode("utf-8")
+
+        layout = LAYOUTS[self.layout]
+        if layout == LAYOUT_COLUMNAR:
+            data = to_columns(rows)
+            if data is None:
+                # Rows with different columns cannot be stored column wise.
+                layout = LAYOUT_ROWS
+                data = rows
+        else:
+            data = rows
+
+        encoding = ENCODINGS[self.encoding]
+        if encoding == ENCODING_MSGPACK:
+            body = msgpack.packb(data, default=str, use_bin_type=True)
+        else:
+            body = json.dumps(data, default=str, separators=(",", ":")).encode("utf-8")
+
+        compression = COMPRESSION_NONE
+        if self.compression is not None and len(body) >= self.compress_threshold:
+            compression = COMPRESSIONS[self.compression]
+            if compression == COMPRESSION_ZLIB:
+                body = zlib.compress(body, self.compress_level)
+            else:
+                body = lz4.compress(body)
+
+        header = MAGIC + bytes([VERSION, (layout << 4) | encoding, compression])
+        return header + body
+
+    def decode(self, value):
+        """
+        :param value: A value read from the cache, as bytes or str. None is passed through.
+        :return: The list of row dictionaries.
+        """
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+
+        if not value.startswith(MAGIC):
+            return json.loads(value)
+
+        version, packed, compression = value[2], value[3], value[4]
+        if version != VERSION:
+            raise ValueError("Unsupported cache value version {}.".format(version))
+
+        body = value[5:]
+        if compression == COMPRESSION_ZLIB:
+            body = zlib.decompress(body)
+        elif compression == COMPRESSION_LZ4:
+            if lz4 is None:
+                raise ValueError("Cache value is lz4 compressed, but the lz4 package is not installed.")
+            body = lz4.decompress(body)
+
+        layout, encoding = packed >> 4, packed & 0x0F
+        if encoding == ENCODING_MSGPACK:
+            if msgpack is None:
+                raise ValueError("Cache value is msgpack encoded, but the msgpack package is not installed.")
+            data = msgpack.unpackb(body, raw=False)
+        else:
+            data = json.loads(body)
+
+        if layout == LAYOUT_COLUMNAR:
+            return from_columns(data)
+        return data
+
+
+def to_columns(rows):
+    """
+    :return: {"columns": [names], "values": [[values of column 0], ...]}, or None if the rows do not
+        all have the same columns in the same order.
+    """
+    if not rows:
+        return {"columns": [], "values": [], "n": 0}
+
+    columns = list(rows[0].keys())
+    for r in rows:
+        if list(r.keys()) != columns:
+            return None
+
+    values = [[r[c] for r in rows] for c in columns]
+    return {"columns": columns, "values": values, "n": len(rows)}
+
+
+def from_columns(data):
+    columns = data["columns"]
+    values = data["values"]
+    return [dict(zip(columns, row)) for row in zip(*values)] if columns else [{} for i in range(data["n"])]
+
+
+def benchmark_codecs(rows, codecs=None, repeat=5):
+    """
+    Compares codecs on a result set.
+
+    :param rows: A list of row dictionaries.
+    :param codecs: {name: CacheCodec}. Defaults to every codec the installed packages support.
+    :param repeat: Each encode and decode is timed this many times, the best time is reported.
+    :return: {name: {"bytes": size, "ratio": size relative to plain JSON, "encode_ms": t, "decode_ms": t}}
+    """
+    if codecs is None:
+        codecs = {"json": CacheCodec(),
+                  "columnar+json": CacheCodec(layout="columnar"),
+                  "columnar+json+zlib": CacheCodec(layout="columnar", compression="zlib")}
+        if msgpack is not None:
+            codecs["msgpack"] = CacheCodec(encoding="msgpack")
+            codecs["columnar+msgpack"] = CacheCodec(layout="columnar", encoding="msgpack")
+            codecs["columnar+msgpack+zlib"] = CacheCodec(layout="columnar", encoding="msgpack",
+                                                         compression="zlib")
+        if lz4 is not None:
+            codecs["columnar+msgpack+lz4"] = CacheCodec(layout="columnar", encoding="msgpack",
+                                                        compression="lz4")
+
+    baseline = len(CacheCodec().encode(rows))
+    result = {}
+
+    for name, codec in codecs.items():
+        encode_times = []
+        decode_times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            v = codec.encode(rows)
+            encode_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            decoded = codec.decode(v)
+            decode_times.append(time.perf_counter() - start)
+
+        if decoded != json.loads(json.dumps(rows, default=str)):
+            raise ValueError("Codec {} does not round trip the rows.".format(name))
+
+        result[name] = {"bytes": len(v),
+                        "ratio": round(len(v) / baseline, 3),
+                        "encode_ms": round(min(encode_times) * 1000, 2),
+                        "decode_ms": round(min(decode_times) * 1000, 2)}
+
+    return result
+
+
+def synthetic_batting(n):
+    """
+    :return: n rows shaped like lahman2017 Batting.
+    """
+    rows = []
+    for i in range(n):
+        rows.append({"playerID": "player{:04d}".format(i % 5000), "yearID": 1990 + i % 28, "stint": 1,
+                     "teamID": ["BOS", "NYA", "WAS", "CHA", "CHN"][i % 5], "lgID": "AL", "G": i % 162,
+                     "AB": i % 600, "R": i % 120, "H": i % 200, "2B": i % 40, "3B": i % 10, "HR": i % 50,
+                     "RBI": i % 130, "SB": i % 60, "CS": i % 20, "BB": i % 100, "SO": i % 180,
+                     "IBB": i % 20, "HBP": i % 15, "SH": i % 10, "SF": i % 10, "GIDP": i % 25})
+    return rows
+
+
+if __name__ == "__main__":
+    for n in (10, 1000, 50000):
+        print("Batting rows = ", n)
+        for name, stats in benchmark_codecs(synthetic_batting(n)).items():
+            print("  {:<24} {:>10} bytes  ratio {:>6}  encode {:>8} ms  decode {:>8} ms".format(
+                name, stats["bytes"], stats["ratio"], stats["encode_ms"], stats["decode_ms"]))
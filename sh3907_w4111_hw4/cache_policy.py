@@ -0,0 +1,180 @@
+"""
+Cache policies for the Redis result cache.
+
+A CachePolicy says how long results for a table live in Redis, how big a serialized result may be
+before it is not cached at all, and whether the entry may be evicted to stay inside the memory budget.
+CacheBudget does the accounting for that budget. The bookkeeping is kept in Redis (a sorted set of
+keys and a hash of sizes), so every process using the same cache shares one budget.
+"""
+
+import time
+
+
+class CachePolicy:
+
+    def __init__(self, ttl=None, max_value_bytes=None, evictable=True):
+        """
+        :param ttl: Seconds an entry lives in Redis. None means no expiry.
+        :param max_value_bytes: Results whose serialized size is larger than this are not cached.
+            None means no limit.
+        :param evictable: If False, entries are never evicted by CacheBudget and do not count
+            against the budget. Use for small, hot dimension tables.
+        """
+        self.ttl = ttl
+        self.max_value_bytes = max_value_bytes
+        self.evictable = evictable
+
+    def allows(self, size):
+        """
+        :param size: Serialized size of a result in bytes.
+        :return: True if a result of this size may be cached.
+        """
+        return self.max_value_bytes is None or size <= self.max_value_bytes
+
+    def __repr__(self):
+        return "CachePolicy(ttl={}, max_value_bytes={}, evictable={})".format(
+            self.ttl, self.max_value_bytes, self.evictable)
+
+
+# Used for any table without its own policy.
+DEFAULT_POLICY = CachePolicy(ttl=3600, max_value_bytes=1024 * 1024)
+
+# Small dimension tables stay resident. Scans of the big lahman2017 fact tables age out quickly and
+# are not cached at all when the result is large.
+DEFAULT_TABLE_POLICIES = {
+    "people": CachePolicy(ttl=None, max_value_bytes=None, evictable=False),
+    "teams": CachePolicy(ttl=None, max_value_bytes=None, evictable=False),
+    "batting": CachePolicy(ttl=300, max_value_bytes=256 * 1024),
+    "pitching": CachePolicy(ttl=300, max_value_bytes=256 * 1024),
+    "fielding": CachePolicy(ttl=300, max_value_bytes=256 * 1024),
+    "appearances": CachePolicy(ttl=300, max_value_bytes=256 * 1024),
+}
+
+
+class CacheBudget:
+
+    def __init__(self, r, max_bytes=None, strategy="lru", prefix="cache:budget"):
+        """
+        :param r: Redis client.
+        :param max_bytes: Budget for the serialized size of all evictable entries. None disables
+            tracking and eviction.
+        :param strategy: "lru" scores keys by last access time, "lfu" by number of accesses.
+        :param prefix: Prefix for the Redis keys holding the bookkeeping.
+        """
+        if strategy not in ("lru", "lfu"):
+            raise ValueError("Invalid eviction strategy {}. Use 'lru' or 'lfu'.".format(strategy))
+
+        self.r = r
+        self.max_bytes = max_bytes
+        self.strategy = strategy
+        self.index_key = prefix + ":" + strategy
+        self.sizes_key = prefix + ":sizes"
+        self.total_key = prefix + ":bytes"
+
+    @property
+    def enabled(self):
+        return self.max_bytes is not None
+
+    def track(self, pipe, key, size):
+        """
+        Queues the bookkeeping for a new or overwritten entry on pipe.
+
+        :param pipe: A Redis pipeline. The caller executes it.
+        :param key: Cache key.
+        :param size: Serialized size of the value in bytes.
+        :return: None
+        """
+        self.track_many(pipe, [(key, size)])
+
+    def track_many(self, pipe, entries):
+        """
+        Like track, for a list of (key, size) pairs. Reads the previous sizes in one round trip. A key
+        listed more than once is counted once, with its last size.
+        """
+        sizes = dict(entries)
+        if not sizes:
+            return
+
+        keys = list(sizes)
+        old_sizes = self.r.hmget(self.sizes_key, keys)
+        delta = sum(sizes.values()) - sum(int(s) for s in old_sizes if s is not None)
+
+        if self.strategy == "lru":
+            now = time.time()
+            pipe.zadd(self.index_key, {k: now for k in keys})
+        else:
+            pipe.zadd(self.index_key, {k: 1 for k in keys})
+        pipe.hset(self.sizes_key, mapping=sizes)
+        pipe.incrby(self.total_key, delta)
+
+    def touch(self, key):
+        """
+        Records a cache hit. Keys that are not tracked (non evictable tables) are left alone.
+        """
+        self.touch_many([key])
+
+    def touch_many(self, keys):
+        """
+        Records hits on several keys in one round trip.
+        """
+        if not keys:
+            return
+
+        pipe = self.r.pipeline(transaction=False)
+        now = time.time()
+        for key in keys:
+            if self.strategy == "lru":
+                pipe.zadd(self.index_key, {key: now}, xx=True)
+            else:
+                pipe.zadd(self.index_key, {key: 1}, xx=True, incr=True)
+        pipe.execute()
+
+    def forget(self, pipe, keys):
+        """
+        Queues removal of the bookkeeping for keys that were deleted by other means.
+        """
+        if not keys:
+            return
+
+        sizes = self.r.hmget(self.sizes_key, keys)
+        freed = sum(int(s) for s in sizes if s is not None)
+
+        pipe.zrem(self.index_key, *keys)
+        pipe.hdel(self.sizes_key, *keys)
+        pipe.decrby(self.total_key, freed)
+
+    def used_bytes(self):
+        return int(self.r.get(self.total_key) or 0)
+
+    def evict(self, batch_size=1):
+        """
+        Evicts the coldest entries until the tracked size is inside the budget. Entries that already
+        expired through their TTL are still in the index until they are evicted here, so the tracked
+        size can overstate what Redis holds.
+
+        :param batch_size: Number of keys popped from the index per round trip.
+        :return: The list of evicted keys.
+        """
+        evicted = []
+
+        if not self.enabled:
+            return evicted
+
+        while self.used_bytes() > self.max_bytes:
+            popped = self.r.zpopmin(self.index_key, batch_size)
+            if not popped:
+                break
+
+            keys = [k for k, score in popped]
+            sizes = self.r.hmget(self.sizes_key, keys)
+            freed = sum(int(s) for s in sizes if s is not None)
+
+            pipe = self.r.pipeline()
+            pipe.delete(*keys)
+            pipe.hdel(self.sizes_key, *keys)
+            pipe.decrby(self.total_key, freed)
+            pipe.execute()
+
+            evicted.extend(keys)
+
+        return evicted
@@ -1,7 +1,26 @@
-from py2neo import data, Graph, NodeMatcher, Node, Relationship, RelationshipMatcher
+from graph_cache import cached_read
+from instrumentation import NOOP_METRICS, CountingTransaction, timed
+from startup import neo4j_config
 
 import json
+import logging
+import re
+import threading
+import time
 import uuid
+from contextlib import contextmanager
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+def player_dependencies(result):
+    """
+    :return: The cache dependencies of a result listing players, as Player Nodes or as Records with
+        the Node in "p": "player:<player_id>" for each. See GraphCache.invalidate_dependents().
+    """
+    nodes = (v if hasattr(v, "labels") else v["p"] for v in result or [])
+    return ["player:" + str(n["player_id"]) for n in nodes]
 
 
 class FanGraph(object):
@@ -15,34 +34,249 @@ class FanGraph(object):
     # but tend to be annoying after a while. So, I did not create types Player, Team, etc.
     #
 
-    # Connects to the DB and sets a Graph instance variable.
-    # Also creates a NodeMatcher and RelationshipMatcher, which are a py2neo framework classes.
-    def __init__(self, auth=('neo4j', 'sh3907'), host='localhost', port=7687, secure=False, ):
-        self._graph = Graph(secure=secure,
-                            bolt=True,
-                            auth=auth,
-                            host=host,
-                            port=port)
-        self._node_matcher = NodeMatcher(self._graph)
-        self._relationship_matcher = RelationshipMatcher(self._graph)
+    # Uniqueness constraints (label, property). Each also gives an index for point lookups on the property.
+    UNIQUE_PROPERTIES = [("Fan", "uni"),
+                         ("Player", "player_id"),
+                         ("Team", "team_id"),
+                         ("Comment", "comment_id"),
+                         ("Roster", "roster_id"),
+                         ("SyncCheckpoint", "name")]
+
+    # Indexes beyond the ones the constraints give. Roster.year is used by graph_sync to read the
+    # appearances of a range of years. Relationship property indexes need Neo4j 4.3 or later.
+    ROSTER_YEAR_INDEX_Q = "CREATE INDEX roster_year IF NOT EXISTS FOR (r:Roster) ON (r.year)"
+    APPEARED_YEAR_INDEX_Q = "CREATE INDEX appeared_year IF NOT EXISTS FOR ()-[r:APPEARED]-() ON (r.year)"
+
+    # Keeps the connection settings. connect() imports py2neo and sets a Graph instance variable, plus a
+    # second one for reads if reads are routed to another host. It runs on first use.
+    def __init__(self, auth=None, host=None, port=None, secure=None, check_schema=True,
+                 read_host=None, read_port=None, retries=3, cache=None, materialize_rosters=True,
+                 metrics=None, config=None):
+        """
+        Connection arguments left as None are taken from config, the environment or the defaults, see
+        startup.neo4j_config().
+
+        :param auth: (user, password).
+        :param check_schema: If True, warns about missing constraints from ensure_schema() on connecting.
+        :param read_host: Host that read transactions are routed to, e.g. a read replica. Reads go to
+            host if None.
+        :param read_port: Port for read_host. Defaults to port.
+        :param retries: Times a transaction that fails with a transient error is retried.
+        :param cache: A GraphCache for get_fan, get_player, get_team, get_team_comments and
+            get_players_by_team, or None to always query the graph.
+        :param materialize_rosters: If True, appearance writes also keep the Roster nodes read by
+            get_roster() up to date.
+        :param metrics: Metrics recording latency per method and Neo4j round trips, transactions and
+            retries. Records nothing by default.
+        :param config: Connection settings overriding the environment.
+        """
+        user, password = auth if auth is not None else (None, None)
+        self.config = neo4j_config(dict(config or {}, user=user, password=password, host=host, port=port,
+                                        secure=secure, read_host=read_host, read_port=read_port))
+        self.check_schema_on_connect = check_schema
+        self.retries = retries
+        self.cache = cache
+        self.materialize_rosters = materialize_rosters
+        self.metrics = metrics or NOOP_METRICS
+
+        # Set by connect().
+        self._graph = None
+        self._read_graph = None
+        self._connect_lock = threading.Lock()
+
+    def connect(self):
+        """
+        Imports py2neo and connects to the primary, and the read host if one is set, if that has not
+        happened yet. With check_schema, then warns about missing constraints.
+        """
+        with self._connect_lock:
+            if self._graph is not None:
+                return
+
+            from py2neo import Graph
+
+            c = self.config
+            auth = (c["user"], c["password"])
+            graph = Graph(secure=c["secure"],
+                          bolt=True,
+                          auth=auth,
+                          host=c["host"],
+                          port=c["port"])
+            if c["read_host"] is not None:
+                self._read_graph = Graph(secure=c["secure"],
+                                         bolt=True,
+                                         auth=auth,
+                                         host=c["read_host"],
+                                         port=c["read_port"] or c["port"])
+            else:
+                self._read_graph = graph
+            self._graph = graph
+
+        if self.check_schema_on_connect:
+            missing = self.check_schema()
+            if missing:
+                logger.warning("FanGraph: missing uniqueness constraints %s. Call ensure_schema() to create them.",
+                               missing)
+
+    def graph(self, readonly=False):
+        """
+        :return: The Graph for writes, or for reads if readonly. Connects on first use.
+        """
+        if self._graph is None:
+            self.connect()
+        return self._read_graph if readonly else self._graph
+
+    def check_schema(self):
+        """
+        :return: The (label, property) pairs from UNIQUE_PROPERTIES that have no uniqueness constraint.
+        """
+        missing = []
+        for label, prop in self.UNIQUE_PROPERTIES:
+            if prop not in self.graph().schema.get_uniqueness_constraints(label):
+                missing.append((label, prop))
+        return missing
+
+    def ensure_schema(self):
+        """
+        Creates the uniqueness constraints in UNIQUE_PROPERTIES that do not exist yet, the index on
+        Roster.year, and the index on APPEARED.year if the server supports relationship indexes. Safe to
+        call on every startup.
 
-    def run_q(self, qs, args):
+        :return: The (label, property) pairs that are still missing. A constraint cannot be created
+            while the existing data has duplicates.
+        """
+        for label, prop in self.check_schema():
+            try:
+                self.graph().schema.create_uniqueness_constraint(label, prop)
+                logger.info("Created uniqueness constraint on %s.%s", label, prop)
+            except Exception as e:
+                logger.error("ensure_schema: could not create constraint on %s.%s, remove duplicates first: %s",
+                             label, prop, e)
+
+        try:
+            self.run_in_transaction(lambda tx: tx.run(self.ROSTER_YEAR_INDEX_Q))
+        except Exception as e:
+            logger.error("ensure_schema: could not create the index on Roster.year: %s", e)
+
+        try:
+            self.run_in_transaction(lambda tx: tx.run(self.APPEARED_YEAR_INDEX_Q))
+        except Exception as e:
+            logger.warning("ensure_schema: relationship indexes are not supported by this server: %s", e)
+
+        return self.check_schema()
+
+    # Transactions. Every query runs inside read_transaction() or write_transaction(), which always end
+    # the transaction: commit when the block succeeds, rollback when it raises. Results must be
+    # consumed inside the block. run_in_transaction() adds retries on transient errors and is what the
+    # methods below use.
+    @contextmanager
+    def write_transaction(self):
+        """
+        :return: A context manager giving a write transaction on the primary.
+        """
+        tx = self.begin(self.graph())
+        try:
+            yield tx
+        except BaseException as e:
+            tx.rollback()
+            raise e
+        else:
+            tx.commit()
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        :return: A context manager giving a transaction on the read graph. It is rolled back at the end,
+            since there is nothing to commit.
+        """
+        tx = self.begin(self.graph(readonly=True))
+        try:
+            yield tx
+        finally:
+            tx.rollback()
+
+    def begin(self, graph):
+        """
+        :return: A new transaction on graph, counting its statements as round trips when metrics are on.
+        """
+        tx = graph.begin(autocommit=False)
+        if self.metrics.enabled:
+            self.metrics.incr("neo4j_transactions_total")
+            tx = CountingTransaction(tx, self.metrics, "neo4j_round_trips_total")
+        return tx
+
+    def run_in_transaction(self, work, readonly=False, retries=None):
+        """
+        Runs work(tx) in a new transaction, retrying with exponential backoff when it fails with a
+        transient error (deadlock, leader switch, lost connection). work may therefore run more than
+        once and must not have side effects outside the transaction.
+
+        :param work: Function taking the transaction. It must consume any result it needs.
+        :param readonly: If True, runs in a read transaction.
+        :param retries: Overrides the retries given to the constructor.
+        :return: What work returns.
+        """
+        if retries is None:
+            retries = self.retries
+
+        for attempt in range(retries + 1):
+            try:
+                if readonly:
+                    with self.read_transaction() as tx:
+                        return work(tx)
+                else:
+                    with self.write_transaction() as tx:
+                        return work(tx)
+            except Exception as e:
+                if attempt == retries or not self.is_transient(e):
+                    raise e
+                self.metrics.incr("neo4j_retries_total")
+                logger.info("Retrying transaction after a transient error: %s", e)
+                time.sleep(0.1 * 2 ** attempt)
+
+    def is_transient(self, e):
+        """
+        :return: True if the error is worth retrying.
+        """
+        names = [c.__name__ for c in type(e).__mro__]
+        code = str(getattr(e, "code", "") or "")
+        return "TransientError" in names or "ServiceUnavailable" in names or \
+            code.startswith("Neo.TransientError") or isinstance(e, (ConnectionError, TimeoutError))
+
+    # Cached reads. Each write below names the (method, args) results it makes stale. Relationships
+    # that no cached read returns (SUPPORTS, FOLLOWS, replies to comments) invalidate nothing.
+    def invalidate_cached(self, calls):
+        """
+        :param calls: List of (method, args) whose cached results are stale. Ignored without a cache.
+        """
+        if self.cache is not None and calls:
+            self.cache.invalidate(calls)
+
+    def invalidate_rosters_of(self, player_ids):
+        """
+        Invalidates the cached get_players_by_team and get_roster results listing any of the players,
+        e.g. after their names changed.
+        """
+        if self.cache is not None and player_ids:
+            self.cache.invalidate_dependents(["player:" + str(p) for p in player_ids])
+
+    def run_q(self, qs, args, readonly=False):
         """
 
         :param qs: Query string that may have {} slots for parameters.
         :param args: Dictionary of parameters to insert into query string.
-        :return:  Result of the query, which executes as a single, standalone transaction.
+        :param readonly: If True, runs in a read transaction.
+        :return:  List of the result records. The query executes as a single, standalone transaction.
         """
         try:
-            tx = self._graph.begin(autocommit=False)
-            result = self._graph.run(qs, args)
-            return result
+            return self.run_in_transaction(lambda tx: list(tx.run(qs, args)), readonly=readonly)
         except Exception as e:
-            print("Run exaception = ", e)
+            logger.error("Run exaception = %s", e)
 
+    @timed("run_match")
     def run_match(self, labels=None, properties=None):
         """
-        Uses a NodeMatcher to find a node matching a "template."
+        Finds the nodes matching a "template."
         :param labels: A list of labels that the node must have.
         :param properties: A dictionary of {property_name: property_value} defining the template that the
             node must match.
@@ -51,22 +285,35 @@ class FanGraph(object):
         # ut.debug_message("Labels = ", labels)
         # ut.debug_message("Properties = ", json.dumps(properties))
 
-        if labels is not None and properties is not None:
-            result = self._node_matcher.match(labels, **properties)
-        elif labels is not None and properties is None:
-            result = self._node_matcher.match(labels)
-        elif labels is None and properties is not None:
-            result = self._node_matcher.match(**properties)
-        else:
+        if labels is None and properties is None:
             raise ValueError("Invalid request. Labels and properties cannot both be None.")
 
-        # Convert NodeMatch data into a simple list of Nodes.
-        full_result = []
-        for r in result:
-            full_result.append(r)
+        if isinstance(labels, str):
+            labels = [labels]
+
+        q = "MATCH (n" + "".join(":" + self.quote_name(l) for l in labels or []) + ")"
+        args = {}
+        if properties:
+            conditions = []
+            for i, (k, v) in enumerate(properties.items()):
+                conditions.append("n." + self.quote_name(k) + " = $p" + str(i))
+                args["p" + str(i)] = v
+            q += " WHERE " + " AND ".join(conditions)
+        q += " RETURN n"
+
+        # Convert the records into a simple list of Nodes.
+        full_result = self.run_in_transaction(lambda tx: [r["n"] for r in tx.run(q, args)], readonly=True)
 
         return full_result
 
+    def quote_name(self, name):
+        """
+        :return: The label or property name quoted for use in Cypher text.
+        """
+        if not isinstance(name, str) or not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name):
+            raise ValueError("Invalid label or property name {}.".format(name))
+        return "`" + name + "`"
+
     def find_nodes_by_template(self, tmp):
         """
 
@@ -80,23 +327,27 @@ class FanGraph(object):
         return result
 
     # Create and save a new node for  a 'Fan.'
+    @timed("create_fan")
     def create_fan(self, uni, last_name, first_name):
         """
 
         :param uni: uni
         :param last_name: Obvious
         :param first_name: Obvious
-        :return: Node created.
+        :return: Node created, or the existing Fan with this uni, updated with the names.
 
-        NOTE: This does not check uni uniqueness. We could do using transactions or setting a constraint
-        on the database.
+        uni uniqueness is enforced by the constraint from ensure_schema(). MERGE makes this safe to call
+        again for an existing fan.
         """
-        n = Node("Fan", uni=uni, last_name=last_name, first_name=first_name)
-        tx = self._graph.begin(autocommit=True)
-        tx.create(n)
+        q = "MERGE (f:Fan {uni: $uni}) SET f.last_name = $last_name, f.first_name = $first_name RETURN f"
+        args = {"uni": uni, "last_name": last_name, "first_name": first_name}
+        n = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
+        self.invalidate_cached([("get_fan", [uni])])
         return n
 
     # Given a UNI, return the node for the Fan.
+    @timed("get_fan")
+    @cached_read("get_fan")
     def get_fan(self, uni):
         n = self.find_nodes_by_template({"label": "Fan", "template": {"uni": uni}})
         if n is not None and len(n) > 0:
@@ -107,12 +358,18 @@ class FanGraph(object):
 
         return n
 
+    @timed("create_player")
     def create_player(self, player_id, last_name, first_name):
-        n = Node("Player", player_id=player_id, last_name=last_name, first_name=first_name)
-        tx = self._graph.begin(autocommit=True)
-        tx.create(n)
+        q = "MERGE (p:Player {player_id: $player_id}) " + \
+            "SET p.last_name = $last_name, p.first_name = $first_name RETURN p"
+        args = {"player_id": player_id, "last_name": last_name, "first_name": first_name}
+        n = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
+        self.invalidate_cached([("get_player", [player_id])])
+        self.invalidate_rosters_of([player_id])
         return n
 
+    @timed("get_player")
+    @cached_read("get_player")
     def get_player(self, player_id):
         n = self.find_nodes_by_template({"label": "Player", "template": {"player_id": player_id}})
         if n is not None and len(n) > 0:
@@ -122,12 +379,16 @@ class FanGraph(object):
 
         return n
 
+    @timed("create_team")
     def create_team(self, team_id, team_name):
-        n = Node("Team", team_id=team_id, team_name=team_name)
-        tx = self._graph.begin(autocommit=True)
-        tx.create(n)
+        q = "MERGE (t:Team {team_id: $team_id}) SET t.team_name = $team_name RETURN t"
+        args = {"team_id": team_id, "team_name": team_name}
+        n = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
+        self.invalidate_cached([("get_team", [team_id]), ("get_team_comments", [team_id])])
         return n
 
+    @timed("get_team")
+    @cached_read("get_team")
     def get_team(self, team_id):
         n = self.find_nodes_by_template({"label": "Team", "template": {"team_id": team_id}})
         if n is not None and len(n) > 0:
@@ -137,101 +398,272 @@ class FanGraph(object):
 
         return n
 
+    @timed("create_supports")
     def create_supports(self, uni, team_id):
         """
         Create a SUPPORTS relationship from a Fan to a Team.
         :param uni: The UNI for a fan.
         :param team_id: An ID for a team.
-        :return: The created SUPPORTS relationship from the Fan to the Team
+        :return: The SUPPORTS relationship from the Fan to the Team. Only one is ever created.
         """
-        f = self.get_fan(uni)
-        t = self.get_team(team_id)
-        r = Relationship(f, "SUPPORTS", t)
-        tx = self._graph.begin(autocommit=True)
-        tx.create(r)
+        q = "MATCH (f:Fan {uni: $uni}), (t:Team {team_id: $team_id}) MERGE (f)-[r:SUPPORTS]->(t) RETURN r"
+        args = {"uni": uni, "team_id": team_id}
+        r = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
         return r
 
+    @timed("get_appearance")
     def get_appearance(self, player_id, team_id, year_id):
         """
         Get the information about appearances for a player and team.
         :param player_id: player_id
         :param team_id: team_id
-        :param year_id: The year for getting appearances.
-        :return:
+        :param year_id: The year for getting appearances, or None for every year.
+        :return: List of the APPEARED relationships.
         """
         try:
-            # Get the Nodes at the ends of the relationship representing appearances.
-            p = self.get_player(player_id)
-            t = self.get_team(team_id)
-
-            # Run a match looking for relationships of a specific type linking the nodes.
-            rm = self._graph.match(nodes=[p, t], r_type="APPEARED")
-            result = []
-
-            # If there is a list of relationships.
-            if rm is not None:
-                for r in rm:
+            # The year is matched in the query, so only the wanted relationships are returned.
+            q = "MATCH (p:Player {player_id: $player_id})-[r:APPEARED]->(t:Team {team_id: $team_id}) " + \
+                "WHERE $year IS NULL OR r.year = $year RETURN r"
+            args = {"player_id": player_id, "team_id": team_id,
+                    "year": int(year_id) if year_id is not None else None}
+            result = self.run_in_transaction(lambda tx: [rec["r"] for rec in tx.run(q, args)], readonly=True)
+            return result
+        except Exception as e:
+            logger.error("get_appearance: Exception e = %s", e)
+            raise e
 
-                    # The type will be a class APPEARED() because of the OO mapping.
-                    node_type = type(r).__name__
-                    year = r['year']
+    # Rosters. A Roster node per team and year, (p:Player)-[:ON_ROSTER]->(:Roster)-[:ROSTER_OF]->(t:Team),
+    # is kept up to date by the appearance writes. Reading a roster then touches only that team and
+    # year, however much history is loaded.
+    ROSTER_MERGE = "MERGE (ro:Roster {{roster_id: {roster_id}}}) " + \
+                   "ON CREATE SET ro.team_id = {team_id}, ro.year = {year} " + \
+                   "MERGE (ro)-[:ROSTER_OF]->(t) " + \
+                   "MERGE (p)-[:ON_ROSTER]->(ro)"
 
-                    # If the type and year are correct, add to result
-                    if node_type == "APPEARED" and (year == year_id or year_id is None):
-                        result.append(r)
+    APPEARANCE_Q = "MATCH (p:Player {player_id: $player_id}), (t:Team {team_id: $team_id}) " + \
+                   "MERGE (p)-[r:APPEARED {year: $year}]->(t) SET r.games = $games"
 
-                return result
-            else:
-                return None
-        except Exception as e:
-            print("get_appearance: Exception e = ", e)
-            raise e
+    def roster_id(self, team_id, year):
+        return team_id + "_" + str(int(year))
 
     # Create an APPEARED relationship from a player to a Team
+    @timed("create_appearance_all")
     def create_appearance_all(self, player_id, team_id, year, games):
         """
 
         :param player_id: O
         :param team_id:
-        :param year:
+        :param year: The year, stored as an integer.
         :param games:
         :return:
         """
         try:
-            tx = self._graph.begin(autocommit=False)
-            q = "match (n:Player {player_id: '" + player_id + "'}), " + \
-                "(t:Team {team_id: '" + team_id + "'}) " + \
-                "create (n)-[r:APPEARED { games: " + str(games) + ", year : " + str(year) + \
-                "}]->(t)"
-            result = self._graph.run(q)
-            tx.commit()
+            # One APPEARED relationship per player, team and year. Loading again updates games.
+            q = self.APPEARANCE_Q
+            if self.materialize_rosters:
+                q += " " + self.ROSTER_MERGE.format(roster_id="$roster_id", team_id="$team_id", year="$year")
+            args = {"player_id": player_id, "team_id": team_id, "year": int(year), "games": games,
+                    "roster_id": self.roster_id(team_id, year)}
+            self.run_in_transaction(lambda tx: tx.run(q, args))
+            self.invalidate_cached([("get_players_by_team", [team_id, year]), ("get_roster", [team_id, year])])
         except Exception as e:
-            print("create_appearances: exception = ", e)
+            logger.error("create_appearances: exception = %s", e)
 
     # Create a FOLLOWS relationship from a Fan to another Fan.
+    @timed("create_follows")
     def create_follows(self, follower, followed):
-        f = self.get_fan(follower)
-        t = self.get_fan(followed)
-        r = Relationship(f, "FOLLOWS", t)
-        tx = self._graph.begin(autocommit=True)
-        tx.create(r)
+        q = "MATCH (f:Fan {uni: $follower}), (t:Fan {uni: $followed}) MERGE (f)-[r:FOLLOWS]->(t) RETURN r"
+        args = {"follower": follower, "followed": followed}
+        r = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
+        return r
+
+    # Bulk loading. Each loader sends its rows in batches bound to $rows, one explicit transaction per
+    # batch, instead of one transaction per node or relationship. Loading with MERGE makes re-running
+    # a load safe.
+    BULK_PLAYERS_Q = "UNWIND $rows AS row " + \
+                     "MERGE (p:Player {player_id: row.player_id}) " + \
+                     "SET p.last_name = row.last_name, p.first_name = row.first_name"
+
+    BULK_TEAMS_Q = "UNWIND $rows AS row " + \
+                   "MERGE (t:Team {team_id: row.team_id}) " + \
+                   "SET t.team_name = row.team_name"
+
+    BULK_APPEARANCES_Q = "UNWIND $rows AS row " + \
+                         "MATCH (p:Player {player_id: row.player_id}), (t:Team {team_id: row.team_id}) " + \
+                         "MERGE (p)-[r:APPEARED {year: row.year}]->(t) " + \
+                         "SET r.games = row.games"
+
+    def bulk_load_players(self, rows, batch_size=1000, retries=3):
+        """
+        :param rows: Iterable of {"player_id", "last_name", "first_name"}.
+        :param batch_size: Rows per transaction.
+        :param retries: Times a batch failing with a transient error is retried before it is counted
+            as failed.
+        :return: Load statistics, see bulk_write.
+        """
+        def invalidates(batch):
+            player_ids = [r["player_id"] for r in batch]
+            self.invalidate_rosters_of(player_ids)
+            return [("get_player", [p]) for p in player_ids]
+
+        return self.bulk_write("players", self.BULK_PLAYERS_Q, rows, batch_size, retries, invalidates)
+
+    def bulk_load_teams(self, rows, batch_size=1000, retries=3):
+        """
+        :param rows: Iterable of {"team_id", "team_name"}.
+        """
+        return self.bulk_write("teams", self.BULK_TEAMS_Q, rows, batch_size, retries,
+                               lambda batch: [(m, [r["team_id"]]) for r in batch
+                                              for m in ("get_team", "get_team_comments")])
+
+    BULK_ROSTERS_Q = BULK_APPEARANCES_Q + " " + \
+        ROSTER_MERGE.format(roster_id="row.team_id + '_' + toString(row.year)", team_id="row.team_id",
+                            year="row.year")
+
+    def bulk_load_appearances(self, rows, batch_size=1000, retries=3):
+        """
+        :param rows: Iterable of {"player_id", "team_id", "year", "games"}. The Player and Team nodes
+            must already exist. Rows for unknown players or teams are skipped. The year must be an
+            integer.
+        """
+        q = self.BULK_ROSTERS_Q if self.materialize_rosters else self.BULK_APPEARANCES_Q
+        return self.bulk_write("appearances", q, rows, batch_size, retries,
+                               lambda batch: [(m, list(k)) for k in {(r["team_id"], r["year"]) for r in batch}
+                                              for m in ("get_players_by_team", "get_roster")])
+
+    @timed("bulk_write")
+    def bulk_write(self, name, q, rows, batch_size=1000, retries=3, invalidates=None, results=None):
+        """
+        Runs q once per batch of rows, with the batch bound to $rows, in its own transaction. A batch
+        that fails with a transient error is rolled back and retried with exponential backoff.
+
+        :param name: What is being loaded, for progress messages.
+        :param invalidates: Function giving the cached (method, args) a committed batch makes stale.
+        :param results: If given, a list extended with the first column of the records q returns, for
+            each committed batch.
+        :return: {"rows", "batches", "failed_batches", "failed_rows", "seconds", "rows_per_sec"}
+        """
+        stats = {"rows": 0, "batches": 0, "failed_batches": 0, "failed_rows": 0}
+        start = time.time()
+        rows = iter(rows)
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            try:
+                if results is None:
+                    self.run_in_transaction(lambda tx: tx.run(q, {"rows": batch}), retries=retries)
+                else:
+                    results.extend(self.run_in_transaction(
+                        lambda tx: [rec[0] for rec in tx.run(q, {"rows": batch})], retries=retries))
+                stats["rows"] += len(batch)
+                if invalidates is not None:
+                    self.invalidate_cached(invalidates(batch))
+            except Exception as e:
+                logger.error("bulk_write: %s batch of %d rows failed: %s", name, len(batch), e)
+                stats["failed_batches"] += 1
+                stats["failed_rows"] += len(batch)
+
+            stats["batches"] += 1
+            if stats["batches"] % 10 == 0:
+                elapsed = time.time() - start
+                logger.info("Loaded %d %s (%.0f rows/sec).", stats["rows"], name, stats["rows"] / elapsed)
+
+        stats["seconds"] = time.time() - start
+        stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        logger.info("Loaded %d %s in %.1f seconds (%.0f rows/sec), %d rows failed.",
+                    stats["rows"], name, stats["seconds"], stats["rows_per_sec"], stats["failed_rows"])
+
+        return stats
+
+    def load_from_mysql(self, db, since_year=None, batch_size=1000):
+        """
+        Streams players, teams and appearances from lahman2017 into the graph.
+
+        :param db: A MysqlHelpers. Rows are read with iter_by_template, so the tables are never held
+            in memory.
+        :param since_year: Only load teams and appearances from this year on. Players are all loaded.
+        :return: {"players": stats, "teams": stats, "appearances": stats}
+        """
+        year_t = {"yearID": {">=": since_year}} if since_year is not None else None
+
+        players = ({"player_id": r["playerID"], "last_name": r["nameLast"], "first_name": r["nameFirst"]}
+                   for r in db.iter_by_template("People", None, ["playerID", "nameLast", "nameFirst"]))
+
+        # Teams has a row per team and year. Loading them in year order leaves the latest name.
+        teams = ({"team_id": r["teamID"], "team_name": r["name"]}
+                 for r in db.iter_by_template("Teams", year_t, ["teamID", "name"],
+                                              orderBy={"fields": ["yearID"], "direction": "asc"}))
+
+        appearances = ({"player_id": r["playerID"], "team_id": r["teamID"], "year": r["yearID"],
+                        "games": r["G_all"]}
+                       for r in db.iter_by_template("Appearances", year_t,
+                                                    ["playerID", "teamID", "yearID", "G_all"]))
+
+        return {"players": self.bulk_load_players(players, batch_size),
+                "teams": self.bulk_load_teams(teams, batch_size),
+                "appearances": self.bulk_load_appearances(appearances, batch_size)}
 
     # -------- Sin-Yi Huang's implementation starts from here
+    @timed("get_comment")
     def get_comment(self, comment_id):
         """
 
         :param comment_id: Comment ID
         :return: Comment
         """
-        # create a matcher
-        matcher = NodeMatcher(self._graph)
-
-        # connect fan node to comment node
-        comment_n = matcher.match("Comment", comment_id=comment_id).first()
+        q = "MATCH (c:Comment {comment_id: $comment_id}) RETURN c"
+        comment_n = self.run_in_transaction(lambda tx: tx.run(q, {"comment_id": comment_id}).evaluate(),
+                                            readonly=True)
 
         # return type: Node
         return comment_n
 
+    # Comment writes. Each comment is written by a single statement that matches the endpoints,
+    # creates the comment and its relationships and returns the comment node. The statement text only
+    # depends on which endpoints are given, and is built once per combination. A comment whose fan or
+    # endpoints do not exist matches nothing, so it is not created.
+    COMMENT_Q_CACHE = {}
+
+    def comment_query(self, team, player, origin, bulk=False):
+        """
+        :param team: True if the comment is on a team.
+        :param player: True if the comment is on a player.
+        :param origin: True if the comment is a response to another comment.
+        :param bulk: If True, the statement for create_comments: it creates a comment per element of
+            $rows and returns the comment_ids of the comments created.
+        :return: The Cypher statement for create_comment and create_sub_comment.
+        """
+        shape = (team, player, origin, bulk)
+        q = self.COMMENT_Q_CACHE.get(shape)
+
+        if q is None:
+            v = "row." if bulk else "$"
+            matches = ["(f:Fan {uni: " + v + "uni})"]
+            creates = ["(f)-[:COMMENT_BY]->(c:Comment {comment_id: " + v + "comment_id, comment: " + v +
+                       "comment, created_at: timestamp()})"]
+            if team:
+                matches.append("(t:Team {team_id: " + v + "team_id})")
+                creates.append("(c)-[:COMMENT_ON]->(t)")
+            if player:
+                matches.append("(p:Player {player_id: " + v + "player_id})")
+                creates.append("(c)-[:COMMENT_ON]->(p)")
+            if origin:
+                matches.append("(o:Comment {comment_id: " + v + "origin_comment_id})")
+                creates.append("(c)-[:COMMENT_ON]->(o)")
+
+            q = "MATCH " + ", ".join(matches) + " CREATE " + ", ".join(creates)
+            if bulk:
+                q = "UNWIND $rows AS row " + q + " RETURN c.comment_id AS comment_id"
+            else:
+                q += " RETURN c"
+            self.COMMENT_Q_CACHE[shape] = q
+
+        return q
+
+    @timed("create_comment")
     def create_comment(self, uni, comment, team_id=None, player_id=None):
         """
         Creates a comment
@@ -239,134 +671,243 @@ class FanGraph(object):
         :param comment: A simple string.
         :param team_id: A valid team ID or None. team_id and player_id cannot BOTH be None.
         :param player_id: A valid player ID or None
-        :return: The Node representing the comment.
+        :return: The Node representing the comment, or None if the fan, team or player does not exist.
         """
+        if not team_id and not player_id:
+            raise ValueError("Invalid request. team_id and player_id cannot both be None.")
+
+        comment_n = None
         try:
-            tx = self._graph.begin(autocommit=False)
-            # create a random id for comment
-            cid = uuid.uuid4()
-
-            # create comment node
-            comment_n = Node("Comment", comment=comment, comment_id=str(cid))
-            tx.create(comment_n)
-            print(comment_n)
-
-            # create a matcher
-            matcher = NodeMatcher(self._graph)
-
-            # connect fan node to comment node
-            fan_n = matcher.match("Fan", uni=uni).first()
-            rela = Relationship(fan_n, "COMMENT_BY", comment_n)
-            tx.create(rela)
-
-            # connect comment node to team node
-            if team_id:
-                team_n = matcher.match("Team", team_id=team_id).first()
-                rela = Relationship(comment_n, "COMMENT_ON", team_n)
-                tx.create(rela)
-
-            # connect comment node to player node
-            if player_id:
-                player_n = matcher.match("Player", player_id=player_id).first()
-                rela = Relationship(comment_n, "COMMENT_ON", player_n)
-                tx.create(rela)
+            q = self.comment_query(bool(team_id), bool(player_id), False)
+            args = {"uni": uni, "comment_id": str(uuid.uuid4()), "comment": comment,
+                    "team_id": team_id, "player_id": player_id}
+            comment_n = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
 
-            tx.commit()
+            if comment_n is None:
+                logger.warning("create_comment: fan, team or player not found, comment not created.")
+            elif team_id:
+                self.invalidate_cached([("get_team_comments", [team_id])])
 
         except Exception as e:
-            print("create_comment: exception = ", e)
+            logger.error("create_comment: exception = %s", e)
 
         # return type: Node
         return comment_n
 
+    @timed("create_sub_comment")
     def create_sub_comment(self, uni, origin_comment_id, comment):
         """
         Create a sub-comment (response to a comment or response) and links with parent in thread.
         :param uni: ID of the Fan making the comment.
         :param origin_comment_id: Id of the comment to which this is a response.
         :param comment: Comment string
-        :return: Created comment.
+        :return: Created comment, or None if the fan or the original comment does not exist.
         """
+        comment_n = None
         try:
-            tx = self._graph.begin(autocommit=False)
-
-            # create a random id for comment
-            cid = uuid.uuid4()
-
-            # create comment node
-            comment_n = Node("Comment", comment=comment, comment_id=str(cid))
-            tx.create(comment_n)
-
-            # create a matcher
-            matcher = NodeMatcher(self._graph)
+            q = self.comment_query(False, False, True)
+            args = {"uni": uni, "comment_id": str(uuid.uuid4()), "comment": comment,
+                    "origin_comment_id": origin_comment_id}
+            comment_n = self.run_in_transaction(lambda tx: tx.run(q, args).evaluate())
 
-            # connect fan node to comment node
-            fan_n = matcher.match("Fan", uni=uni).first()
-            rela = Relationship(fan_n, "COMMENT_BY", comment_n)
-            tx.create(rela)
-
-            # connect comment node to original comment node
-            origin_comment_n = matcher.match("Comment", comment_id=origin_comment_id).first()
-            rela = Relationship(comment_n, "COMMENT_ON", origin_comment_n)
-            tx.create(rela)
-
-            tx.commit()
+            if comment_n is None:
+                logger.warning("create_sub_comment: fan or original comment not found, comment not created.")
 
         except Exception as e:
-            print("create_comment: exception = ", e)
+            logger.error("create_comment: exception = %s", e)
 
         # return type: Node
         return comment_n
 
+    # Batch variant of create_comment and create_sub_comment. Rows are grouped by which endpoints they
+    # name, and each group is written with the comment_query for its endpoints.
+    @timed("create_comments")
+    def create_comments(self, comments, batch_size=500, retries=3):
+        """
+        Creates many comments, batch_size per transaction.
+
+        :param comments: Iterable of {"uni", "comment"} with any of "team_id", "player_id" and
+            "origin_comment_id", at least one of them. Rows whose fan, team, player or original comment
+            does not exist are skipped.
+        :return: (list of the comment_ids of the comments created, in the order of comments, load
+            statistics)
+        """
+        rows = []
+        by_shape = {}
+        for c in comments:
+            row = {"uni": c["uni"], "comment": c["comment"], "comment_id": str(uuid.uuid4()),
+                   "team_id": c.get("team_id"), "player_id": c.get("player_id"),
+                   "origin_comment_id": c.get("origin_comment_id")}
+            shape = (bool(row["team_id"]), bool(row["player_id"]), bool(row["origin_comment_id"]))
+            if not any(shape):
+                raise ValueError("Invalid request. Comment {} has no team_id, player_id or origin_comment_id."
+                                 .format(len(rows)))
+            rows.append(row)
+            by_shape.setdefault(shape, []).append(row)
+
+        created = []
+        stats = {"rows": 0, "batches": 0, "failed_batches": 0, "failed_rows": 0, "seconds": 0.0}
+        for shape, group in by_shape.items():
+            s = self.bulk_write("comments", self.comment_query(*shape, bulk=True), group, batch_size, retries,
+                                lambda batch: [("get_team_comments", [t])
+                                               for t in {r["team_id"] for r in batch if r["team_id"]}],
+                                results=created)
+            for k in stats:
+                stats[k] += s[k]
+        stats["rows_per_sec"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+
+        if len(created) < len(rows):
+            logger.warning("create_comments: %d comments not created, their fan, team, player or original "
+                           "comment was not found.", len(rows) - len(created))
+
+        created = set(created)
+        return [r["comment_id"] for r in rows if r["comment_id"] in created], stats
+
+    @timed("get_sub_comments")
     def get_sub_comments(self, comment_id):
         """
 
         :param comment_id: The unique ID of the comment.
         :return: The sub-comments.
         """
-        # create a matcher
-        matcher = NodeMatcher(self._graph)
+        q = "MATCH (s)-[r:COMMENT_ON]->(c:Comment {comment_id: $comment_id}) RETURN r"
+        sub_comments = self.run_in_transaction(
+            lambda tx: [rec["r"] for rec in tx.run(q, {"comment_id": comment_id})], readonly=True)
 
-        comment_n = matcher.match("Comment", comment_id=comment_id).first()
+        # return type: list of Relationship
+        return sub_comments
 
-        sub_comments = RelationshipMatcher(self._graph).match((None, comment_n), "COMMENT_ON")
+    # Paginated comment retrieval. Pages are ordered by (created_at, comment_id) and each page starts
+    # after the last key of the previous one (keyset pagination), so a page costs the same however deep
+    # into the list it is. Comments created before created_at was stored sort first, as created_at 0.
+    KEYSET_WHERE = "(coalesce(c.created_at, 0) > $after_ts OR " + \
+                   "(coalesce(c.created_at, 0) = $after_ts AND c.comment_id > $after_id))"
+    KEYSET_ORDER = "coalesce(c.created_at, 0), c.comment_id"
 
-        # return type: RelationshipMatch
-        return sub_comments
+    THREAD_Q_CACHE = {}
+
+    def thread_query(self, max_depth):
+        """
+        :param max_depth: Deepest level of replies to return, or None for the whole tree.
+        :return: The Cypher statement for a page of iter_comment_thread.
+        """
+        q = self.THREAD_Q_CACHE.get(max_depth)
+
+        if q is None:
+            hops = "*1.." + (str(int(max_depth)) if max_depth is not None else "")
+            q = "MATCH path = (c:Comment)-[:COMMENT_ON" + hops + "]->(root:Comment {comment_id: $comment_id}) " + \
+                "WHERE " + self.KEYSET_WHERE + " " + \
+                "WITH c, length(path) AS depth, nodes(path)[1] AS parent " + \
+                "ORDER BY " + self.KEYSET_ORDER + " LIMIT $page_size " + \
+                "OPTIONAL MATCH (f:Fan)-[:COMMENT_BY]->(c) " + \
+                "RETURN c, depth, parent.comment_id AS parent_id, f " + \
+                "ORDER BY " + self.KEYSET_ORDER
+            self.THREAD_Q_CACHE[max_depth] = q
+
+        return q
+
+    def iter_comment_thread(self, comment_id, max_depth=None, page_size=100, after=None):
+        """
+        Gets the replies under a comment, at every level or down to max_depth, with one variable length
+        COMMENT_ON traversal per page.
+
+        :param comment_id: ID of the comment at the top of the thread. It is not returned itself.
+        :param max_depth: 1 returns direct replies only, 2 adds their replies, and so on. None returns
+            the whole tree.
+        :param page_size: Replies fetched per round trip.
+        :param after: (created_at, comment_id) of the last reply already seen, to resume a thread.
+        :return: A generator of {"comment": Node, "commenter": Node, "depth": int, "parent_id": str}
+            in (created_at, comment_id) order.
+        """
+        if max_depth is not None and max_depth < 1:
+            raise ValueError("Invalid request. max_depth must be at least 1.")
+
+        q = self.thread_query(max_depth)
+        return self.iter_pages(q, {"comment_id": comment_id}, page_size, after,
+                               lambda rec: {"comment": rec["c"], "commenter": rec["f"],
+                                            "depth": rec["depth"], "parent_id": rec["parent_id"]})
+
+    def iter_team_comments(self, team_id, page_size=100, after=None):
+        """
+        Gets the comments on a team with the fans who made them, a page at a time.
+
+        :return: A generator of {"comment": Node, "commenter": Node} in (created_at, comment_id) order.
+        """
+        q = "MATCH (c:Comment)-[:COMMENT_ON]->(:Team {team_id: $id}) " + \
+            "WHERE " + self.KEYSET_WHERE + " " + \
+            "WITH c ORDER BY " + self.KEYSET_ORDER + " LIMIT $page_size " + \
+            "OPTIONAL MATCH (f:Fan)-[:COMMENT_BY]->(c) " + \
+            "RETURN c, f ORDER BY " + self.KEYSET_ORDER
+        return self.iter_pages(q, {"id": team_id}, page_size, after,
+                               lambda rec: {"comment": rec["c"], "commenter": rec["f"]})
+
+    def iter_player_comments(self, player_id, page_size=100, after=None):
+        """
+        Gets the comments on a player with the fans who made them, a page at a time.
+
+        :return: A generator of {"comment": Node, "commenter": Node} in (created_at, comment_id) order.
+        """
+        q = "MATCH (c:Comment)-[:COMMENT_ON]->(:Player {player_id: $id}) " + \
+            "WHERE " + self.KEYSET_WHERE + " " + \
+            "WITH c ORDER BY " + self.KEYSET_ORDER + " LIMIT $page_size " + \
+            "OPTIONAL MATCH (f:Fan)-[:COMMENT_BY]->(c) " + \
+            "RETURN c, f ORDER BY " + self.KEYSET_ORDER
+        return self.iter_pages(q, {"id": player_id}, page_size, after,
+                               lambda rec: {"comment": rec["c"], "commenter": rec["f"]})
+
+    def iter_pages(self, q, args, page_size, after, to_result):
+        """
+        Runs a keyset paginated query page by page, each page in its own read transaction.
 
+        :param q: Query using $after_ts, $after_id and $page_size, returning the comment as c.
+        :param to_result: Converts a record into the value yielded.
+        """
+        after_ts, after_id = after if after is not None else (-1, "")
+
+        while True:
+            page_args = dict(args, after_ts=after_ts, after_id=after_id, page_size=page_size)
+            page = self.run_in_transaction(lambda tx: list(tx.run(q, page_args)), readonly=True)
+
+            for rec in page:
+                yield to_result(rec)
+
+            if len(page) < page_size:
+                break
+
+            last = page[-1]["c"]
+            after_ts, after_id = last["created_at"] or 0, last["comment_id"]
+
+    @timed("get_player_comments")
     def get_player_comments(self, player_id):
         """
         Gets all of the comments associated with a player, Also returns the Nodes for people making the comments.
         :param player_id: ID of the player.
         :return: Graph containing comment, comment streams and commenters.
         """
-        tx = self._graph.begin(autocommit=False)
-
-        q = "MATCH (n:Player {player_id:'" + player_id + "'}) MATCH (c:Comment)-[r:COMMENT_ON]->(n) RETURN c;"
+        q = "MATCH (n:Player {player_id: $player_id}) MATCH (c:Comment)-[r:COMMENT_ON]->(n) RETURN c"
 
-        result = self._graph.run(q)
+        result = self.run_in_transaction(lambda tx: list(tx.run(q, {"player_id": player_id})), readonly=True)
 
-        tx.commit()
-
-        # return type: Cursor
+        # return type: list of Record
         return result
 
+    @timed("get_team_comments")
+    @cached_read("get_team_comments")
     def get_team_comments(self, team_id):
         """
         Gets all of the comments associated with a team.  Also returns the Nodes for people making the comments.
         :param player_id: ID of the team.
         :return: Graph containing comment, comment streams and commenters.
         """
-        # create a matcher
-        matcher = NodeMatcher(self._graph)
-
-        team_n = matcher.match("Team", team_id=team_id).first()
+        q = "MATCH (c)-[r:COMMENT_ON]->(t:Team {team_id: $team_id}) RETURN r"
+        comments = self.run_in_transaction(lambda tx: [rec["r"] for rec in tx.run(q, {"team_id": team_id})],
+                                           readonly=True)
 
-        comments = RelationshipMatcher(self._graph).match((None, team_n), "COMMENT_ON")
-
-        # return type: RelationshipMatch
+        # return type: list of Relationship
         return comments
 
+    @timed("get_players_by_team")
+    @cached_read("get_players_by_team", player_dependencies)
     def get_players_by_team(self, team_id, yearid):
         """
 
@@ -374,13 +915,43 @@ class FanGraph(object):
         :param yearid: A year.
         :return: Returns the players who played for the team in the year.
         """
-        tx = self._graph.begin(autocommit=False)
+        # Starts from the team, so only its APPEARED relationships are read.
+        q = "MATCH (t:Team {team_id: $team_id})<-[r:APPEARED]-(p:Player) WHERE r.year = $year RETURN p"
+        args = {"team_id": team_id, "year": int(yearid)}
 
-        q = "MATCH (t:Team {team_id:'" + team_id + "'}) MATCH (p:Player)-[r:APPEARED]->(n) WHERE r.year = " + yearid + " RETURN p;"
+        result = self.run_in_transaction(lambda tx: list(tx.run(q, args)), readonly=True)
 
-        result = self._graph.run(q)
+        # return type: list of Record
+        return result
 
-        tx.commit()
+    @timed("get_roster")
+    @cached_read("get_roster", player_dependencies)
+    def get_roster(self, team_id, year):
+        """
+        Same players as get_players_by_team, read from the materialized Roster node.
 
-        # return type: Cursor
-        return result
+        :return: List of Player Nodes. Empty if the roster was never materialized, see rebuild_rosters().
+        """
+        q = "MATCH (:Roster {roster_id: $roster_id})<-[:ON_ROSTER]-(p:Player) RETURN p"
+        args = {"roster_id": self.roster_id(team_id, year)}
+        return self.run_in_transaction(lambda tx: [rec["p"] for rec in tx.run(q, args)], readonly=True)
+
+    def rebuild_rosters(self, retries=3):
+        """
+        Materializes the Roster nodes from the existing APPEARED relationships, one transaction per team.
+
+        :return: Number of teams processed.
+        """
+        teams_q = "MATCH (t:Team) RETURN t.team_id AS id"
+        teams = self.run_in_transaction(lambda tx: [rec["id"] for rec in tx.run(teams_q)], readonly=True)
+        q = "MATCH (t:Team {team_id: $team_id})<-[r:APPEARED]-(p:Player) " + \
+            "WITH t, p, r.year AS year " + \
+            self.ROSTER_MERGE.format(roster_id="t.team_id + '_' + toString(year)", team_id="t.team_id",
+                                     year="year")
+
+        for team_id in teams:
+            self.run_in_transaction(lambda tx: tx.run(q, {"team_id": team_id}), retries=retries)
+
+        if self.cache is not None:
+            self.cache.invalidate_method("get_roster")
+        return len(teams)
@@ -0,0 +1,350 @@
+"""
+Batch analytics over the fan graph.
+
+FanAnalytics exports every SUPPORTS and FOLLOWS edge in one streamed read. The edges are stored as
+scipy sparse matrices: fans x teams for SUPPORTS and fans x fans for FOLLOWS. From those it computes
+  - team similarity: cosine similarity of the sets of fans supporting two teams,
+  - follow recommendations: fans followed by the fans you follow (friends of friends), ranked by the
+    number of paths, without the fans you already follow,
+  - fan influence: PageRank over FOLLOWS.
+The top k results are written back in batches: pagerank as a Fan property, RECOMMENDED_FOLLOW edges
+between fans and SIMILAR_TO edges between teams.
+
+Needs numpy and scipy. Run this module to time the computations on synthetic graphs.
+"""
+
+import logging
+import sys
+import time
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+logger = logging.getLogger(__name__)
+
+
+class Adjacency:
+
+    def __init__(self, fans, teams, supports, follows):
+        """
+        :param fans: List of fan unis. Row i of both matrices is fans[i].
+        :param teams: List of team_ids. Column j of supports is teams[j].
+        :param supports: CSR matrix, fans x teams, 1 where the fan SUPPORTS the team.
+        :param follows: CSR matrix, fans x fans, 1 where the row fan FOLLOWS the column fan.
+        """
+        self.fans = fans
+        self.teams = teams
+        self.supports = supports
+        self.follows = follows
+
+    def __repr__(self):
+        return "Adjacency(fans={}, teams={}, supports={}, follows={})".format(
+            len(self.fans), len(self.teams), self.supports.nnz, self.follows.nnz)
+
+
+class FanAnalytics:
+
+    EXPORT_Q = "MATCH (f:Fan)-[r:SUPPORTS|FOLLOWS]->(x) " + \
+               "RETURN f.uni AS src, type(r) AS rel, coalesce(x.uni, x.team_id) AS dst"
+
+    PAGERANK_Q = "UNWIND $rows AS row " + \
+                 "MATCH (f:Fan {uni: row.uni}) " + \
+                 "SET f.pagerank = row.score"
+
+    RECOMMENDED_FOLLOW_Q = "UNWIND $rows AS row " + \
+                           "MATCH (a:Fan {uni: row.src}), (b:Fan {uni: row.dst}) " + \
+                           "CREATE (a)-[:RECOMMENDED_FOLLOW {score: row.score, rank: row.rank}]->(b)"
+
+    SIMILAR_TO_Q = "UNWIND $rows AS row " + \
+                   "MATCH (a:Team {team_id: row.src}), (b:Team {team_id: row.dst}) " + \
+                   "CREATE (a)-[:SIMILAR_TO {score: row.score, rank: row.rank}]->(b)"
+
+    def __init__(self, fg):
+        """
+        :param fg: The FanGraph to read from and write to.
+        """
+        self.fg = fg
+
+    def export(self):
+        """
+        Reads the SUPPORTS and FOLLOWS edges with a single query, consuming the result as it streams.
+
+        :return: An Adjacency. Fans without either kind of edge are left out.
+        """
+        def work(tx):
+            fan_index = {}
+            team_index = {}
+            s_rows, s_cols = array("i"), array("i")
+            f_rows, f_cols = array("i"), array("i")
+
+            for rec in tx.run(self.EXPORT_Q):
+                src = fan_index.setdefault(rec["src"], len(fan_index))
+                if rec["rel"] == "SUPPORTS":
+                    s_rows.append(src)
+                    s_cols.append(team_index.setdefault(rec["dst"], len(team_index)))
+                else:
+                    f_rows.append(src)
+                    f_cols.append(fan_index.setdefault(rec["dst"], len(fan_index)))
+
+            return fan_index, team_index, s_rows, s_cols, f_rows, f_cols
+
+        fan_index, team_index, s_rows, s_cols, f_rows, f_cols = self.fg.run_in_transaction(work, readonly=True)
+
+        n_fans, n_teams = len(fan_index), len(team_index)
+        return Adjacency(list(fan_index), list(team_index),
+                         to_csr(s_rows, s_cols, (n_fans, n_teams)),
+                         to_csr(f_rows, f_cols, (n_fans, n_fans)))
+
+    def run(self, k_follow=10, k_similar=5, write=True, batch_size=5000):
+        """
+        Exports the graph, computes all analytics and writes the results back.
+
+        :param k_follow: Recommendations per fan.
+        :param k_similar: Similar teams per team.
+        :param write: If False, only computes.
+        :return: (results, timings). results is {"adjacency", "pagerank", "recommendations",
+            "similar_teams"} and timings has the seconds each stage took.
+        """
+        timings = {}
+
+        start = time.time()
+        adj = self.export()
+        timings["export"] = time.time() - start
+
+        results, compute_timings = compute_all(adj, k_follow, k_similar)
+        timings.update(compute_timings)
+
+        if write:
+            start = time.time()
+            self.write_pagerank(adj, results["pagerank"], batch_size)
+            self.write_recommendations(adj, results["recommendations"], batch_size)
+            self.write_similar_teams(adj, results["similar_teams"], batch_size)
+            timings["write"] = time.time() - start
+
+        logger.info("FanAnalytics: %s in %s.", adj,
+                    ", ".join("{} {:.2f}s".format(k, v) for k, v in timings.items()))
+        return results, timings
+
+    def write_pagerank(self, adj, scores, batch_size=5000):
+        rows = ({"uni": uni, "score": float(s)} for uni, s in zip(adj.fans, scores))
+        return self.fg.bulk_write("pagerank", self.PAGERANK_Q, rows, batch_size,
+                                  invalidates=lambda batch: [("get_fan", [r["uni"]]) for r in batch])
+
+    def write_recommendations(self, adj, recommendations, batch_size=5000):
+        """
+        Replaces all RECOMMENDED_FOLLOW edges with the given recommendations.
+
+        :param recommendations: (rows, cols, scores, ranks) from follow_recommendations.
+        """
+        self.clear_relationships("RECOMMENDED_FOLLOW", batch_size)
+        return self.fg.bulk_write("recommended follows", self.RECOMMENDED_FOLLOW_Q,
+                                  edge_rows(adj.fans, adj.fans, recommendations), batch_size)
+
+    def write_similar_teams(self, adj, similar, batch_size=5000):
+        """
+        Replaces all SIMILAR_TO edges with the given similarities.
+
+        :param similar: (rows, cols, scores, ranks) from team_similarity.
+        """
+        self.clear_relationships("SIMILAR_TO", batch_size)
+        return self.fg.bulk_write("similar teams", self.SIMILAR_TO_Q,
+                                  edge_rows(adj.teams, adj.teams, similar), batch_size)
+
+    def clear_relationships(self, rel_type, batch_size=5000):
+        """
+        Deletes every relationship of a type, batch_size per transaction.
+
+        :return: Number of relationships deleted.
+        """
+        q = "MATCH ()-[r:" + self.fg.quote_name(rel_type) + "]->() WITH r LIMIT $limit DELETE r RETURN count(r)"
+        deleted = 0
+        while True:
+            n = self.fg.run_in_transaction(lambda tx: tx.run(q, {"limit": batch_size}).evaluate()) or 0
+            deleted += n
+            if n < batch_size:
+                return deleted
+
+
+def to_csr(rows, cols, shape):
+    """
+    :return: A binary CSR matrix with a 1 at each (row, col). Duplicate pairs count once.
+    """
+    rows = np.frombuffer(rows, dtype=np.int32) if len(rows) else np.zeros(0, dtype=np.int32)
+    cols = np.frombuffer(cols, dtype=np.int32) if len(cols) else np.zeros(0, dtype=np.int32)
+    m = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+    m.sum_duplicates()
+    m.data[:] = 1
+    return m
+
+
+def top_k(m, k):
+    """
+    :param m: A sparse matrix. Zero entries are never returned.
+    :return: (rows, cols, scores, ranks) of the k largest entries in each row, grouped by row with the
+        largest first. Ties go to the smaller column.
+    """
+    m = sp.csr_matrix(m)
+    m.eliminate_zeros()
+
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    order = np.lexsort((m.indices, -m.data, rows))
+    rows, cols, scores = rows[order], m.indices[order], m.data[order]
+
+    # After sorting, row i's entries start at indptr[i] again.
+    ranks = np.arange(len(rows)) - m.indptr[rows]
+    keep = ranks < k
+    return rows[keep], cols[keep], scores[keep], ranks[keep] + 1
+
+
+def team_similarity(supports, k=5):
+    """
+    :param supports: fans x teams binary matrix.
+    :return: top_k of the cosine similarity between teams' sets of supporters, without the team itself.
+    """
+    co = (supports.T @ supports).tocsr().astype(np.float64)
+    counts = co.diagonal()
+    inv_norm = np.divide(1.0, np.sqrt(counts), out=np.zeros_like(counts), where=counts > 0)
+    sim = sp.diags(inv_norm) @ co @ sp.diags(inv_norm)
+    sim = sp.csr_matrix(sim)
+    sim.setdiag(0)
+    return top_k(sim, k)
+
+
+def follow_recommendations(follows, k=10, block_size=50000):
+    """
+    Scores each fan c for fan a by the number of fans a follows who follow c. Fans a already follows,
+    and a itself, are left out. Computed block_size rows at a time to bound memory.
+
+    :param follows: fans x fans binary matrix.
+    :return: top_k of the scores, with rows and cols indexing fans.
+    """
+    n = follows.shape[0]
+    parts = []
+
+    for start in range(0, n, block_size):
+        block = follows[start:start + block_size]
+        fof = (block @ follows).tocsr()
+        fof = (fof - fof.multiply(block)).tocoo()
+
+        keep = (fof.data > 0) & (fof.col != fof.row + start)
+        fof = sp.csr_matrix((fof.data[keep], (fof.row[keep], fof.col[keep])), shape=fof.shape)
+
+        rows, cols, scores, ranks = top_k(fof, k)
+        parts.append((rows + start, cols, scores, ranks))
+
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), empty
+    return tuple(np.concatenate(p) for p in zip(*parts))
+
+
+def pagerank(follows, damping=0.85, tol=1e-8, max_iter=100):
+    """
+    PageRank by power iteration. Fans who follow nobody spread their score over all fans.
+
+    :param follows: fans x fans binary matrix.
+    :return: (scores summing to 1, iterations run)
+    """
+    n = follows.shape[0]
+    if n == 0:
+        return np.zeros(0), 0
+
+    out_degree = np.asarray(follows.sum(axis=1)).ravel()
+    inv_degree = np.divide(1.0, out_degree, out=np.zeros(n), where=out_degree > 0)
+    transition = sp.csr_matrix((sp.diags(inv_degree) @ follows).T)
+    dangling = out_degree == 0
+
+    x = np.full(n, 1.0 / n)
+    for i in range(1, max_iter + 1):
+        x_new = damping * (transition @ x + x[dangling].sum() / n) + (1.0 - damping) / n
+        err = np.abs(x_new - x).sum()
+        x = x_new
+        if err < tol:
+            break
+
+    return x, i
+
+
+def compute_all(adj, k_follow=10, k_similar=5):
+    """
+    :return: (results, timings) as in FanAnalytics.run, without export and write.
+    """
+    timings = {}
+    results = {"adjacency": adj}
+
+    start = time.time()
+    results["similar_teams"] = team_similarity(adj.supports, k_similar)
+    timings["team_similarity"] = time.time() - start
+
+    start = time.time()
+    results["recommendations"] = follow_recommendations(adj.follows, k_follow)
+    timings["recommendations"] = time.time() - start
+
+    start = time.time()
+    results["pagerank"], results["pagerank_iterations"] = pagerank(adj.follows)
+    timings["pagerank"] = time.time() - start
+
+    return results, timings
+
+
+def edge_rows(src_ids, dst_ids, result):
+    """
+    :return: A generator of {"src", "dst", "score", "rank"} for a top_k result.
+    """
+    rows, cols, scores, ranks = result
+    for r, c, s, k in zip(rows, cols, scores, ranks):
+        yield {"src": src_ids[r], "dst": dst_ids[c], "score": float(s), "rank": int(k)}
+
+
+def synthetic_adjacency(n_fans, n_teams=30, follows_per_fan=10, teams_per_fan=2, seed=0):
+    """
+    :return: An Adjacency for a random graph. Popularity is skewed: the chance of following fan i or
+        supporting team i falls off as 1 / (i + 1).
+    """
+    rng = np.random.default_rng(seed)
+
+    def skewed(n, size):
+        p = 1.0 / np.arange(1, n + 1)
+        return rng.choice(n, size=size, p=p / p.sum()).astype(np.int32)
+
+    f_rows = np.repeat(np.arange(n_fans, dtype=np.int32), follows_per_fan)
+    f_cols = skewed(n_fans, len(f_rows))
+    s_rows = np.repeat(np.arange(n_fans, dtype=np.int32), teams_per_fan)
+    s_cols = skewed(n_teams, len(s_rows))
+
+    follows = to_csr(f_rows, f_cols, (n_fans, n_fans))
+    follows.setdiag(0)
+    follows.eliminate_zeros()
+
+    return Adjacency(["fan{}".format(i) for i in range(n_fans)],
+                     ["team{}".format(i) for i in range(n_teams)],
+                     to_csr(s_rows, s_cols, (n_fans, n_teams)), follows)
+
+
+def benchmark(sizes=(10000, 100000, 1000000), k_follow=10, k_similar=5):
+    """
+    Times compute_all on synthetic graphs.
+
+    :return: {n_fans: {"supports", "follows", "generate" and the timings from compute_all}}
+    """
+    result = {}
+    for n in sizes:
+        start = time.time()
+        adj = synthetic_adjacency(n)
+        stats = {"supports": adj.supports.nnz, "follows": adj.follows.nnz, "generate": time.time() - start}
+
+        results, timings = compute_all(adj, k_follow, k_similar)
+        stats.update(timings)
+        stats["pagerank_iterations"] = results["pagerank_iterations"]
+        result[n] = stats
+    return result
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    for n, stats in benchmark(sizes).items():
+        print("Fans = {:>8}  follows {:>9}  team similarity {:>7.2f}s  recommendations {:>7.2f}s  "
+              "pagerank {:>7.2f}s ({} iterations)".format(
+                  n, stats["follows"], stats["team_similarity"], stats["recommendations"], stats["pagerank"],
+                  stats["pagerank_iterations"]))
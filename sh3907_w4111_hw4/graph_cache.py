@@ -0,0 +1,230 @@
+"""
+Redis cache for FanGraph read methods.
+
+Results are serialized to JSON. Nodes keep their labels and properties, relationships keep their type,
+properties and end nodes, and records become {key: value} dictionaries. Cached results come back as
+unbound py2neo Nodes and Relationships built from that data, so they read like the originals but are
+not attached to the graph.
+
+Keys are "<prefix>:<method>:<arg>:<arg>...". FanGraph write methods call invalidate() with the exact
+(method, args) entries they make stale.
+
+Some results depend on data that is not in their arguments, e.g. a roster shows the names of its
+players. Such reads name their dependencies when cached, and every dependency keeps a set of the keys
+depending on it, "<prefix>:_deps:<dependency>", so a write can delete just those keys with
+invalidate_dependents() instead of scanning for every cached result of the method.
+
+A miss can load a result, lose the race with a write and its invalidation, and cache the stale result
+afterwards. Every method has a version, "<prefix>:_version:<method>", and reads with dependencies also
+share "<prefix>:_version:_deps". The invalidations increment them before deleting keys, and a miss only
+caches its result if the versions it read before loading are unchanged when the SET runs.
+"""
+
+import functools
+import inspect
+import json
+import logging
+from urllib.parse import quote
+
+from instrumentation import NOOP_METRICS
+from startup import redis_config
+
+logger = logging.getLogger(__name__)
+
+# Version shared by the reads with dependencies, see invalidate_dependents().
+DEPENDENTS_VERSION = "_deps"
+
+
+class GraphCache:
+
+    def __init__(self, r=None, ttl=300, prefix="fg", metrics=None):
+        """
+        :param r: Redis client with decode_responses=True. If None, one is created from
+            startup.redis_config().
+        :param ttl: Seconds an entry lives. None means no expiry, relying on invalidation alone.
+        :param prefix: Prefix for the cache keys.
+        :param metrics: Metrics counting hits and misses per method.
+        """
+        if r is None:
+            import redis
+            r = redis.StrictRedis(decode_responses=True, **redis_config())
+
+        self.r = r
+        self.ttl = ttl
+        self.prefix = prefix
+        self.metrics = metrics or NOOP_METRICS
+
+    def key(self, method, args):
+        """
+        :return: The cache key for a call. Arguments are compared as strings, so year 2013 and "2013"
+            share an entry.
+        """
+        return self.prefix + ":" + method + "".join(":" + quote(str(a), safe="") for a in args)
+
+    def dependents_key(self, dependency):
+        return self.prefix + ":_deps:" + quote(str(dependency), safe="")
+
+    def version_key(self, name):
+        return self.prefix + ":_version:" + name
+
+    def fetch(self, method, args, loader, depends=None):
+        """
+        :param loader: Function that runs the query on a miss.
+        :param depends: Function giving the dependencies of a result, see invalidate_dependents().
+        :return: The cached result, or the result of loader(), which is then cached.
+        """
+        from redis import WatchError
+
+        key = self.key(method, args)
+        versions = [self.version_key(method)]
+        if depends is not None:
+            versions.append(self.version_key(DEPENDENTS_VERSION))
+        v, *before = self.r.mget([key] + versions)
+
+        if v is not None:
+            self.metrics.incr("graph_cache_hits_total", method=method)
+            return from_json(json.loads(v))
+
+        self.metrics.incr("graph_cache_misses_total", method=method)
+        result = loader()
+        value = json.dumps(to_json(result), default=str)
+        dependencies = list(depends(result)) if depends is not None else []
+
+        with self.r.pipeline() as pipe:
+            try:
+                pipe.watch(*versions)
+                if pipe.mget(versions) != before:
+                    logger.debug("%s was invalidated during the load. Not caching the result.", method)
+                    return result
+                pipe.multi()
+                pipe.set(key, value, ex=self.ttl)
+                for dependency in dependencies:
+                    d = self.dependents_key(dependency)
+                    pipe.sadd(d, key)
+                    if self.ttl is not None:
+                        pipe.expire(d, self.ttl)
+                pipe.execute()
+            except WatchError:
+                logger.debug("%s was invalidated during the load. Not caching the result.", method)
+        return result
+
+    def invalidate(self, calls):
+        """
+        :param calls: List of (method, args) whose cached results are stale.
+        :return: Number of keys deleted.
+        """
+        keys = [self.key(method, args) for method, args in calls]
+        if not keys:
+            return 0
+        pipe = self.r.pipeline()
+        for method in sorted(set(method for method, args in calls)):
+            pipe.incr(self.version_key(method))
+        pipe.unlink(*keys)
+        return pipe.execute()[-1]
+
+    def invalidate_dependents(self, dependencies, batch_size=500):
+        """
+        Deletes the cached results that named any of the dependencies when they were cached.
+
+        :return: Number of keys deleted.
+        """
+        deleted = 0
+        dependencies = list(dependencies)
+        if not dependencies:
+            return 0
+        self.r.incr(self.version_key(DEPENDENTS_VERSION))
+        for i in range(0, len(dependencies), batch_size):
+            sets = [self.dependents_key(d) for d in dependencies[i:i + batch_size]]
+            pipe = self.r.pipeline()
+            for d in sets:
+                pipe.smembers(d)
+            keys = set().union(*pipe.execute())
+            if keys:
+                deleted += self.r.unlink(*sorted(keys))
+            self.r.unlink(*sets)
+        return deleted
+
+    def invalidate_method(self, method, batch_size=500):
+        """
+        Deletes every cached result for a method, with SCAN and batched UNLINK.
+
+        :return: Number of keys deleted.
+        """
+        deleted = 0
+        batch = []
+        self.r.incr(self.version_key(method))
+        for key in self.r.scan_iter(match=self.prefix + ":" + method + ":*", count=1000):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += self.r.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += self.r.unlink(*batch)
+        return deleted
+
+
+def cached_read(method, depends=None):
+    """
+    Decorator for FanGraph read methods. Serves the result from self.cache when the FanGraph has one.
+
+    :param method: Name used in the cache key.
+    :param depends: Function giving the dependencies of a result, see GraphCache.invalidate_dependents().
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return f(self, *args, **kwargs)
+
+            # Positional and keyword calls share an entry.
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            key_args = list(bound.arguments.values())[1:]
+            return self.cache.fetch(method, key_args, lambda: f(self, *args, **kwargs), depends)
+        return wrapper
+    return decorator
+
+
+def to_json(v):
+    """
+    :return: A JSON serializable form of a query result.
+    """
+    from py2neo import Node, Relationship
+
+    if v is None:
+        return None
+    if isinstance(v, Node):
+        return {"_node": {"labels": sorted(v.labels), "properties": dict(v)}}
+    if isinstance(v, Relationship):
+        return {"_rel": {"type": type(v).__name__, "properties": dict(v),
+                         "start": to_json(v.start_node), "end": to_json(v.end_node)}}
+    if isinstance(v, dict):
+        return {"_map": {k: to_json(x) for k, x in v.items()}}
+    if hasattr(v, "keys") and hasattr(v, "values"):
+        # A py2neo Record.
+        return {"_map": {k: to_json(x) for k, x in zip(v.keys(), v.values())}}
+    if isinstance(v, (list, tuple)):
+        return [to_json(x) for x in v]
+    return v
+
+
+def from_json(v):
+    """
+    :return: The query result for a value made by to_json. Records come back as dictionaries.
+    """
+    from py2neo import Node, Relationship
+
+    if isinstance(v, list):
+        return [from_json(x) for x in v]
+    if isinstance(v, dict):
+        if "_node" in v:
+            n = v["_node"]
+            return Node(*n["labels"], **n["properties"])
+        if "_rel" in v:
+            r = v["_rel"]
+            return Relationship(from_json(r["start"]), r["type"], from_json(r["end"]), **r["properties"])
+        if "_map" in v:
+            return {k: from_json(x) for k, x in v["_map"].items()}
+    return v
@@ -0,0 +1,612 @@
+"""
+Incremental sync of the lahman2017 players, teams and appearances from MySQL into the fan graph.
+
+Players come from People, teams from Teams (a Team node per teamID, named as in its latest year) and
+APPEARED relationships from Appearances. There are two ways to find what to sync:
+  - reconcile() walks People by playerID, then Teams, then Appearances one year at a time, and diffs
+    every page against the same range of the graph. Use it to load an empty graph or to repair drift.
+  - sync_changes() reads the keys of changed rows from a change table, which MySQL triggers fill (see
+    install_change_capture()), in change_id order, and diffs only those keys. change_id is the
+    watermark, so the daily refresh only reads and writes what changed since the last run.
+
+Each batch reads the graph state of its keys, compares it with the MySQL rows and writes only the
+inserts, updates and deletes, together with the new checkpoint, in one write transaction. An
+interrupted run has committed a batch and its checkpoint or neither, and resumes after the last
+committed batch. Applying a batch again writes nothing, since its diff is empty.
+
+The checkpoint is a (:SyncCheckpoint {name}) node with
+  change_id             last change applied by sync_changes(),
+  reconcile_table       table reconcile() is walking, null when no reconcile is in progress,
+  reconcile_after       last key of that table reconcile() has applied,
+  reconcile_change_id   change_id when the reconcile started. Changes after it are left to sync_changes().
+
+    python graph_sync.py install        creates the change table and triggers
+    python graph_sync.py reconcile      full diff, e.g. the first time
+    python graph_sync.py sync           applies the changes since the last run, then prunes them
+    python graph_sync.py prune          deletes the applied changes from the change table
+    python graph_sync.py status         prints the checkpoint
+"""
+
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("People", "Teams", "Appearances")
+
+PEOPLE_FIELDS = ["playerID", "nameLast", "nameFirst"]
+TEAMS_FIELDS = ["teamID", "name", "yearID"]
+APPEARANCES_FIELDS = ["playerID", "teamID", "yearID", "G_all"]
+
+# Key columns written by the triggers for each table: key1, key2, key3.
+CHANGE_KEYS = {"People": ("playerID", None, None),
+               "Teams": ("teamID", None, None),
+               "Appearances": ("playerID", "teamID", "yearID")}
+
+CHANGE_TABLE_DDL = "CREATE TABLE IF NOT EXISTS {} (" + \
+                   "change_id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, " + \
+                   "table_name VARCHAR(32) NOT NULL, " + \
+                   "key1 VARCHAR(64) NOT NULL, " + \
+                   "key2 VARCHAR(64) NULL, " + \
+                   "key3 INT NULL, " + \
+                   "changed_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), " + \
+                   "INDEX (changed_at))"
+
+# Graph state, as rows shaped like the MySQL rows after conversion.
+PLAYER_RETURN = " RETURN p.player_id AS player_id, p.last_name AS last_name, p.first_name AS first_name"
+PLAYERS_BY_KEYS_Q = "UNWIND $keys AS k MATCH (p:Player {player_id: k})" + PLAYER_RETURN
+PLAYERS_RANGE_Q = "MATCH (p:Player) WHERE ($after IS NULL OR p.player_id > $after) " + \
+                  "AND ($last IS NULL OR p.player_id <= $last)" + PLAYER_RETURN
+
+TEAM_RETURN = " RETURN t.team_id AS team_id, t.team_name AS team_name"
+TEAMS_BY_KEYS_Q = "UNWIND $keys AS k MATCH (t:Team {team_id: k})" + TEAM_RETURN
+TEAMS_ALL_Q = "MATCH (t:Team)" + TEAM_RETURN
+
+APPEARANCE_RETURN = " RETURN p.player_id AS player_id, t.team_id AS team_id, r.year AS year, r.games AS games"
+APPEARANCES_BY_KEYS_Q = "UNWIND $keys AS k " + \
+                        "MATCH (p:Player {player_id: k.player_id})-[r:APPEARED {year: k.year}]->" + \
+                        "(t:Team {team_id: k.team_id})" + APPEARANCE_RETURN
+# A range of years is read from the Roster nodes of those years, found with the Roster.year index, and
+# the APPEARED relationships of their players, so a page only touches its own years. Without
+# materialized rosters every APPEARED is scanned, unless the server has the APPEARED.year index. An
+# APPEARED relationship that lost its roster link is not seen, rebuild_rosters() restores the links.
+APPEARANCES_RANGE_Q = "MATCH (ro:Roster) WHERE ro.year > $after AND ro.year <= $last " + \
+                      "MATCH (ro)<-[:ON_ROSTER]-(p:Player)-[r:APPEARED]->(t:Team {team_id: ro.team_id}) " + \
+                      "WHERE r.year = ro.year" + APPEARANCE_RETURN
+APPEARANCES_SCAN_Q = "MATCH (p:Player)-[r:APPEARED]->(t:Team) WHERE r.year > $after AND r.year <= $last" + \
+                     APPEARANCE_RETURN
+
+# Bounds for APPEARANCES_RANGE_Q when a page is open on one side.
+FIRST_YEAR = -1
+LAST_YEAR = 1000000
+
+# Deletes. Players and teams lose their APPEARED and roster links. The node itself is only deleted when
+# nothing else, e.g. a comment or a fan, is attached to it.
+DELETE_APPEARANCES_Q = "UNWIND $rows AS row " + \
+                       "MATCH (p:Player {player_id: row.player_id})-[r:APPEARED {year: row.year}]->" + \
+                       "(t:Team {team_id: row.team_id}) " + \
+                       "DELETE r " + \
+                       "WITH p, row " + \
+                       "MATCH (p)-[o:ON_ROSTER]->(:Roster {roster_id: row.team_id + '_' + toString(row.year)}) " + \
+                       "DELETE o"
+DELETE_PLAYER_LINKS_Q = "UNWIND $rows AS row " + \
+                        "MATCH (p:Player {player_id: row.player_id})-[r:APPEARED|ON_ROSTER]->() DELETE r"
+DELETE_PLAYERS_Q = "UNWIND $rows AS row " + \
+                   "MATCH (p:Player {player_id: row.player_id}) WHERE NOT (p)--() DELETE p"
+DELETE_TEAM_LINKS_Q = "UNWIND $rows AS row " + \
+                      "MATCH (t:Team {team_id: row.team_id}) " + \
+                      "OPTIONAL MATCH (t)<-[r:APPEARED]-() DELETE r " + \
+                      "WITH DISTINCT t " + \
+                      "OPTIONAL MATCH (t)<-[:ROSTER_OF]-(ro:Roster) DETACH DELETE ro"
+DELETE_TEAMS_Q = "UNWIND $rows AS row " + \
+                 "MATCH (t:Team {team_id: row.team_id}) WHERE NOT (t)--() DELETE t"
+
+CHECKPOINT_Q = "MERGE (c:SyncCheckpoint {name: $name}) SET c += $state, c.updated_at = timestamp()"
+READ_CHECKPOINT_Q = "MATCH (c:SyncCheckpoint {name: $name}) RETURN properties(c)"
+
+
+def player_key(row):
+    return row["player_id"]
+
+
+def team_key(row):
+    return row["team_id"]
+
+
+def appearance_key(row):
+    return row["player_id"], row["team_id"], row["year"]
+
+
+KEY_FUNCTIONS = {"People": player_key, "Teams": team_key, "Appearances": appearance_key}
+
+
+def player_rows(rows):
+    """
+    :param rows: People rows.
+    :return: {player_id: Player row}
+    """
+    return {r["playerID"]: {"player_id": r["playerID"], "last_name": r["nameLast"], "first_name": r["nameFirst"]}
+            for r in rows}
+
+
+def team_rows(rows):
+    """
+    :param rows: Teams rows. A team has one per year.
+    :return: {team_id: Team row}, named as in the latest year.
+    """
+    result = {}
+    for r in sorted(rows, key=lambda r: int(r["yearID"])):
+        result[r["teamID"]] = {"team_id": r["teamID"], "team_name": r["name"]}
+    return result
+
+
+def appearance_rows(rows):
+    """
+    :param rows: Appearances rows.
+    :return: {(player_id, team_id, year): APPEARED row}
+    """
+    result = {}
+    for r in rows:
+        row = {"player_id": r["playerID"], "team_id": r["teamID"], "year": int(r["yearID"]), "games": r["G_all"]}
+        result[appearance_key(row)] = row
+    return result
+
+
+def diff(source, target):
+    """
+    :param source: {key: row} in MySQL.
+    :param target: {key: row} in the graph.
+    :return: (rows to insert, rows to update, rows to delete, number of unchanged rows)
+    """
+    inserts, updates = [], []
+    unchanged = 0
+    for k, row in source.items():
+        existing = target.get(k)
+        if existing is None:
+            inserts.append(row)
+        elif existing != row:
+            updates.append(row)
+        else:
+            unchanged += 1
+    deletes = [row for k, row in target.items() if k not in source]
+    return inserts, updates, deletes, unchanged
+
+
+class GraphSync:
+
+    def __init__(self, fg, db, name="lahman2017", batch_size=1000, settle_seconds=5.0,
+                 change_table="graph_sync_changes"):
+        """
+        :param fg: The FanGraph to write.
+        :param db: The MysqlHelpers to read lahman2017 from.
+        :param name: Name of the SyncCheckpoint node. Syncs with different names keep separate progress.
+        :param batch_size: Keys, or changes, per transaction.
+        :param settle_seconds: Changes younger than this are left to the next batch. change_ids are
+            assigned when a row is written, not when its transaction commits, so a younger change could
+            still be followed by an older, uncommitted one. Must be longer than the longest write
+            transaction on the synced tables.
+        :param change_table: Table the triggers write changed keys to.
+        """
+        self.fg = fg
+        self.db = db
+        self.name = name
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.change_table = change_table
+
+    # Change capture. Each trigger writes the key of the changed row, an update writes the keys before
+    # and after it. What changed is found by the diff, so the operation is not recorded.
+    def install_change_capture(self, tables=TABLES):
+        """
+        Creates the change table and the insert, update and delete triggers on the tables. Replaces
+        existing triggers of the same name.
+        """
+        change_table = self.db.quote(self.change_table)
+        statements = [CHANGE_TABLE_DDL.format(change_table)]
+
+        for table in tables:
+            keys = CHANGE_KEYS[table]
+            columns = ["table_name"] + ["key{}".format(i + 1) for i, k in enumerate(keys) if k is not None]
+
+            def values(image):
+                return "('" + table + "'," + ",".join(image + "." + k for k in keys if k is not None) + ")"
+
+            for op, images in (("insert", ["NEW"]), ("update", ["OLD", "NEW"]), ("delete", ["OLD"])):
+                trigger = "{}_graph_sync_{}".format(table.lower(), op)
+                statements.append("DROP TRIGGER IF EXISTS " + trigger)
+                statements.append("CREATE TRIGGER {} AFTER {} ON {} FOR EACH ROW INSERT INTO {} ({}) VALUES {}".format(
+                    trigger, op.upper(), table, change_table, ",".join(columns),
+                    ",".join(values(i) for i in images)))
+
+        with self.db.pool.connection() as cnx:
+            for q in statements:
+                self.db.run_q(cnx, q, None, fetch=False, commit=False)
+        logger.info("Installed change capture on %s into %s.", ", ".join(tables), self.change_table)
+
+    def max_change_id(self):
+        """
+        :return: The latest change_id, 0 if there is none, or None without a change table.
+        """
+        try:
+            with self.db.pool.connection() as cnx:
+                rows = self.db.run_q(cnx, "SELECT MAX(change_id) AS m FROM " + self.db.quote(self.change_table),
+                                     None, fetch=True, commit=False)
+        except Exception as e:
+            logger.warning("No change table %s, changes are not tracked: %s", self.change_table, e)
+            return None
+        return rows[0]["m"] or 0
+
+    def read_changes(self, after):
+        """
+        :return: Up to batch_size changes after the change_id after, in change_id order, ending before
+            the first change that is younger than settle_seconds. changed_at is the start time of the
+            writing statement, so a later change_id can carry an earlier timestamp. Filtering on
+            changed_at could return it while skipping an unsettled change before it, and the
+            watermark would then pass the skipped change.
+        """
+        with self.db.pool.connection() as cnx:
+            cutoff = self.db.run_q(cnx, "SELECT NOW(6) - INTERVAL %s MICROSECOND AS c",
+                                   [int(self.settle_seconds * 1000000)], fetch=True, commit=False)[0]["c"]
+        changes = self.db.find_by_template(self.change_table, {"change_id": {">": after}},
+                                           ["change_id", "table_name", "key1", "key2", "key3", "changed_at"],
+                                           limit=self.batch_size,
+                                           orderBy={"fields": ["change_id"], "direction": "asc"})
+        for i, c in enumerate(changes):
+            if c["changed_at"] >= cutoff:
+                return changes[:i]
+        return changes
+
+    def prune_changes(self):
+        """
+        Deletes the changes the checkpoint has passed, with a plain DELETE. The change table is not
+        cached, so the rows are not read for the write listeners.
+
+        :return: Number of changes deleted.
+        """
+        change_id = self.checkpoint().get("change_id")
+        if not change_id:
+            return 0
+        with self.db.pool.connection() as cnx:
+            n = self.db.run_q(cnx, "DELETE FROM " + self.db.quote(self.change_table) + " WHERE change_id <= %s",
+                              [change_id], fetch=False, commit=True)
+        logger.info("Pruned %d changes up to change_id %d from %s.", n, change_id, self.change_table)
+        return n
+
+    # MySQL state of a set of keys.
+    def mysql_players(self, keys):
+        if not keys:
+            return {}
+        return player_rows(self.db.find_by_template("People", {"playerID": list(keys)}, PEOPLE_FIELDS))
+
+    def mysql_teams(self, keys):
+        if not keys:
+            return {}
+        return team_rows(self.db.find_by_template("Teams", {"teamID": list(keys)}, TEAMS_FIELDS))
+
+    def mysql_appearances(self, keys):
+        if not keys:
+            return {}
+        t = {"playerID": list({k[0] for k in keys}), "teamID": list({k[1] for k in keys}),
+             "yearID": list({k[2] for k in keys})}
+        # The template matches every combination of the players, teams and years. Keep the keys asked for.
+        rows = appearance_rows(self.db.find_by_template("Appearances", t, APPEARANCES_FIELDS))
+        return {k: v for k, v in rows.items() if k in keys}
+
+    def mysql_existing(self, table, keys):
+        """
+        :return: The subset of keys that have rows in MySQL.
+        """
+        read = {"People": self.mysql_players, "Teams": self.mysql_teams, "Appearances": self.mysql_appearances}
+        return set(read[table](set(keys)))
+
+    # Checkpoint.
+    def checkpoint(self):
+        """
+        :return: The properties of the SyncCheckpoint node, {} before the first sync.
+        """
+        state = self.fg.run_in_transaction(
+            lambda tx: tx.run(READ_CHECKPOINT_Q, {"name": self.name}).evaluate(), readonly=True)
+        return dict(state or {})
+
+    def save_checkpoint(self, state):
+        self.fg.run_in_transaction(lambda tx: tx.run(CHECKPOINT_Q, {"name": self.name, "state": state}))
+
+    # Applying a batch.
+    def apply_batch(self, source, read_graph, state, recheck_deletes=False):
+        """
+        Diffs source against the graph and writes the differences and the checkpoint state in one
+        transaction.
+
+        :param source: {table: {key: row}}, the MySQL state of every key in the batch. A key that is not
+            in MySQL any more is absent.
+        :param read_graph: Function taking the transaction and returning {table: {key: row}}, the graph
+            state of the same keys.
+        :param state: Checkpoint properties to set when the batch commits.
+        :param recheck_deletes: If True, rows only found in the graph are looked up in MySQL before they
+            are deleted. Needed when the graph was read by a key range, since MySQL and Neo4j may order
+            strings differently.
+        :return: {"inserted", "updated", "deleted", "unchanged"}
+        """
+        def work(tx):
+            target = read_graph(tx)
+            changes = {}
+            for table in TABLES:
+                if table not in target:
+                    continue
+                inserts, updates, deletes, unchanged = diff(source.get(table, {}), target[table])
+                if deletes and recheck_deletes:
+                    key = KEY_FUNCTIONS[table]
+                    existing = self.mysql_existing(table, [key(r) for r in deletes])
+                    deletes = [r for r in deletes if key(r) not in existing]
+                changes[table] = (inserts, updates, deletes, unchanged)
+
+            self.write_changes(tx, changes)
+            tx.run(CHECKPOINT_Q, {"name": self.name, "state": state})
+            return changes
+
+        changes = self.fg.run_in_transaction(work)
+        self.invalidate(changes)
+
+        stats = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+        for inserts, updates, deletes, unchanged in changes.values():
+            stats["inserted"] += len(inserts)
+            stats["updated"] += len(updates)
+            stats["deleted"] += len(deletes)
+            stats["unchanged"] += unchanged
+        return stats
+
+    def write_changes(self, tx, changes):
+        """
+        Writes nodes before the relationships that need them, and removes relationships before the
+        nodes they hold on to.
+        """
+        def upserts(table):
+            inserts, updates, deletes, unchanged = changes.get(table, ([], [], [], 0))
+            return inserts + updates
+
+        def deletes(table):
+            return changes.get(table, ([], [], [], 0))[2]
+
+        if upserts("People"):
+            tx.run(self.fg.BULK_PLAYERS_Q, {"rows": upserts("People")})
+        if upserts("Teams"):
+            tx.run(self.fg.BULK_TEAMS_Q, {"rows": upserts("Teams")})
+        if upserts("Appearances"):
+            q = self.fg.BULK_ROSTERS_Q if self.fg.materialize_rosters else self.fg.BULK_APPEARANCES_Q
+            tx.run(q, {"rows": upserts("Appearances")})
+
+        if deletes("Appearances"):
+            tx.run(DELETE_APPEARANCES_Q, {"rows": deletes("Appearances")})
+        if deletes("People"):
+            tx.run(DELETE_PLAYER_LINKS_Q, {"rows": deletes("People")})
+            tx.run(DELETE_PLAYERS_Q, {"rows": deletes("People")})
+        if deletes("Teams"):
+            tx.run(DELETE_TEAM_LINKS_Q, {"rows": deletes("Teams")})
+            tx.run(DELETE_TEAMS_Q, {"rows": deletes("Teams")})
+
+    def invalidate(self, changes):
+        """
+        Drops the FanGraph cache entries made stale by a committed batch.
+        """
+        if self.fg.cache is None:
+            return
+
+        calls = []
+        for table, (inserts, updates, deletes, unchanged) in changes.items():
+            for r in inserts + updates + deletes:
+                if table == "People":
+                    calls.append(("get_player", [r["player_id"]]))
+                elif table == "Teams":
+                    calls += [("get_team", [r["team_id"]]), ("get_team_comments", [r["team_id"]])]
+                else:
+                    calls += [("get_players_by_team", [r["team_id"], r["year"]]),
+                              ("get_roster", [r["team_id"], r["year"]])]
+        self.fg.invalidate_cached(calls)
+
+        # Rosters show player names. New players are on no cached roster yet.
+        people = changes.get("People")
+        if people is not None:
+            self.fg.invalidate_rosters_of([r["player_id"] for r in people[1] + people[2]])
+
+    # Incremental sync.
+    def sync_changes(self, max_batches=None):
+        """
+        Applies the changes after the checkpoint's change_id, batch_size changes per transaction.
+
+        :param max_batches: Stop after this many batches. None runs until no settled change is left.
+        :return: {"batches", "changes", "inserted", "updated", "deleted", "unchanged", "change_id", "seconds"}
+        """
+        start = time.time()
+        change_id = self.checkpoint().get("change_id") or 0
+        stats = {"batches": 0, "changes": 0, "inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+
+        while max_batches is None or stats["batches"] < max_batches:
+            changes = self.read_changes(change_id)
+            if not changes:
+                break
+
+            keys = {table: set() for table in TABLES}
+            for c in changes:
+                if c["table_name"] == "Appearances":
+                    keys["Appearances"].add((c["key1"], c["key2"], int(c["key3"])))
+                elif c["table_name"] in keys:
+                    keys[c["table_name"]].add(c["key1"])
+
+            source = {"People": self.mysql_players(keys["People"]),
+                      "Teams": self.mysql_teams(keys["Teams"]),
+                      "Appearances": self.mysql_appearances(keys["Appearances"])}
+
+            def read_graph(tx, keys=keys):
+                return {"People": {r["player_id"]: dict(r) for r in
+                                   tx.run(PLAYERS_BY_KEYS_Q, {"keys": list(keys["People"])})},
+                        "Teams": {r["team_id"]: dict(r) for r in
+                                  tx.run(TEAMS_BY_KEYS_Q, {"keys": list(keys["Teams"])})},
+                        "Appearances": appearance_graph_rows(tx.run(APPEARANCES_BY_KEYS_Q, {"keys": [
+                            {"player_id": k[0], "team_id": k[1], "year": k[2]} for k in keys["Appearances"]]}))}
+
+            change_id = changes[-1]["change_id"]
+            batch = self.apply_batch(source, read_graph, {"change_id": change_id})
+
+            stats["batches"] += 1
+            stats["changes"] += len(changes)
+            for k in batch:
+                stats[k] += batch[k]
+
+        stats["change_id"] = change_id
+        stats["seconds"] = time.time() - start
+        logger.info("Synced %d changes up to change_id %d in %.1f seconds: %d inserted, %d updated, %d deleted.",
+                    stats["changes"], change_id, stats["seconds"], stats["inserted"], stats["updated"],
+                    stats["deleted"])
+        return stats
+
+    # Full reconcile.
+    def reconcile(self):
+        """
+        Diffs all of People, Teams and Appearances against the graph, one page per transaction, and
+        resumes an interrupted reconcile from its checkpoint.
+
+        :return: {"batches", "inserted", "updated", "deleted", "unchanged", "seconds"}
+        """
+        start = time.time()
+        state = self.checkpoint()
+
+        if state.get("reconcile_table") is None:
+            state = {"reconcile_table": TABLES[0], "reconcile_after": None,
+                     "reconcile_change_id": self.max_change_id()}
+            self.save_checkpoint(state)
+        else:
+            logger.info("Resuming reconcile of %s after %s.", state["reconcile_table"], state.get("reconcile_after"))
+
+        stats = {"batches": 0, "inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+        table, after = state["reconcile_table"], state.get("reconcile_after")
+
+        while table is not None:
+            source, read_graph, last = self.reconcile_page(table, after)
+
+            if last is not None:
+                next_state = {"reconcile_table": table, "reconcile_after": last}
+            elif table != TABLES[-1]:
+                next_state = {"reconcile_table": TABLES[TABLES.index(table) + 1], "reconcile_after": None}
+            else:
+                # Done. Changes made during the reconcile may not have been seen, so sync_changes() starts
+                # from when it began.
+                next_state = {"reconcile_table": None, "reconcile_after": None, "reconcile_change_id": None}
+                change_id = state.get("reconcile_change_id")
+                if change_id is not None:
+                    next_state["change_id"] = max(change_id, self.checkpoint().get("change_id") or 0)
+
+            batch = self.apply_batch(source, read_graph, next_state, recheck_deletes=True)
+            stats["batches"] += 1
+            for k in batch:
+                stats[k] += batch[k]
+
+            table, after = next_state["reconcile_table"], next_state["reconcile_after"]
+
+        stats["seconds"] = time.time() - start
+        logger.info("Reconciled in %.1f seconds: %d inserted, %d updated, %d deleted, %d unchanged.",
+                    stats["seconds"], stats["inserted"], stats["updated"], stats["deleted"], stats["unchanged"])
+        return stats
+
+    def reconcile_page(self, table, after):
+        """
+        :param after: Last key of the previous page, None for the first page.
+        :return: (source, read_graph, last key of this page or None if it is the last page of the table)
+        """
+        order = {"direction": "asc"}
+
+        if table == "People":
+            t = {"playerID": {">": after}} if after is not None else None
+            rows = self.db.find_by_template("People", t, PEOPLE_FIELDS, limit=self.batch_size,
+                                            orderBy=dict(order, fields=["playerID"]))
+            last = rows[-1]["playerID"] if len(rows) == self.batch_size else None
+
+            def read_graph(tx):
+                return {"People": {r["player_id"]: dict(r)
+                                   for r in tx.run(PLAYERS_RANGE_Q, {"after": after, "last": last})}}
+
+            return {"People": player_rows(rows)}, read_graph, last
+
+        if table == "Teams":
+            # A team has a row per year, a few thousand rows in all. One page.
+            rows = self.db.find_by_template("Teams", None, TEAMS_FIELDS)
+
+            def read_graph(tx):
+                return {"Teams": {r["team_id"]: dict(r) for r in tx.run(TEAMS_ALL_Q)}}
+
+            return {"Teams": team_rows(rows)}, read_graph, None
+
+        # Appearances, a year per page. The graph is read from after the previous year up to this one, so
+        # years that only exist in the graph are deleted too.
+        t = {"yearID": {">": after}} if after is not None else None
+        years = self.db.find_by_template("Appearances", t, ["yearID"], limit=1,
+                                         orderBy=dict(order, fields=["yearID"]))
+        year = int(years[0]["yearID"]) if years else None
+        rows = self.db.find_by_template("Appearances", {"yearID": year}, APPEARANCES_FIELDS) if years else []
+
+        q = APPEARANCES_RANGE_Q if self.fg.materialize_rosters else APPEARANCES_SCAN_Q
+        bounds = {"after": after if after is not None else FIRST_YEAR,
+                  "last": year if year is not None else LAST_YEAR}
+
+        def read_graph(tx):
+            return {"Appearances": appearance_graph_rows(tx.run(q, bounds))}
+
+        return {"Appearances": appearance_rows(rows)}, read_graph, year
+
+    def run(self):
+        """
+        The daily refresh: finishes or starts a reconcile if the graph was never synced or one was
+        interrupted, then applies the changes and prunes the applied ones from the change table.
+        Without a change table every run is a full reconcile.
+
+        :return: {"reconcile": stats or None, "changes": stats or None, "pruned": number of changes
+            deleted}
+        """
+        state = self.checkpoint()
+        reconciled = None
+        if state.get("reconcile_table") is not None or state.get("change_id") is None:
+            reconciled = self.reconcile()
+
+        changes = None
+        pruned = 0
+        if self.checkpoint().get("change_id") is not None:
+            changes = self.sync_changes()
+            pruned = self.prune_changes()
+        return {"reconcile": reconciled, "changes": changes, "pruned": pruned}
+
+
+def appearance_graph_rows(records):
+    result = {}
+    for r in records:
+        row = dict(r)
+        row["year"] = int(row["year"])
+        result[appearance_key(row)] = row
+    return result
+
+
+def main(argv):
+    from fan_graph import FanGraph
+    from redis_helper import MysqlHelpers
+
+    logging.basicConfig(level=logging.INFO)
+    command = argv[0] if argv else "sync"
+    sync = GraphSync(FanGraph(check_schema=False), MysqlHelpers())
+
+    if command == "install":
+        sync.install_change_capture()
+    elif command == "reconcile":
+        print(sync.reconcile())
+    elif command == "sync":
+        print(sync.run())
+    elif command == "prune":
+        print(sync.prune_changes())
+    elif command == "status":
+        print(sync.checkpoint())
+    else:
+        print("Usage: python graph_sync.py [install|reconcile|sync|prune|status]")
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,221 @@
+"""
+Metrics for the cache, MySQL and graph paths.
+
+RedisFunctions, MysqlHelpers, FanGraph and GraphCache take a metrics argument. The default, NOOP_METRICS,
+records nothing and costs a method call. InMemoryMetrics keeps counters and latency histograms,
+labelled e.g. by table or FanGraph method, which can be exported with prometheus_text() or
+log_metrics().
+
+Metric names:
+  cache_hits_total, cache_misses_total, cache_fills_total, cache_evictions_total,
+  cache_invalidations_total                          {table}
+  cache_bytes_serialized_total                       {table}
+  cache_request_seconds                              {table}    histogram
+  l1_hits_total, l1_misses_total, l1_evictions_total
+  graph_cache_hits_total, graph_cache_misses_total   {method}
+  mysql_round_trips_total
+  mysql_query_seconds                                           histogram
+  neo4j_round_trips_total, neo4j_transactions_total, neo4j_retries_total
+  fan_graph_seconds                                  {method}   histogram
+"""
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Records nothing. Base class for the other implementations.
+    """
+
+    enabled = False
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the seconds the with block takes.
+        """
+        yield
+
+
+NOOP_METRICS = Metrics()
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # The last one counts values over every bucket.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class InMemoryMetrics(Metrics):
+    """
+    Thread safe counters and histograms, kept in this process.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}              # (name, labels) -> value
+        self.histograms = {}            # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def observe(self, name, value, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = Histogram(self.buckets)
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def value(self, name, **labels):
+        """
+        :return: The value of a counter, 0 if it was never incremented.
+        """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """
+        :return: {"counters": {name: [(labels, value)]}, "histograms": {name: [(labels, count, sum)]}}
+        """
+        with self._lock:
+            counters, histograms = {}, {}
+            for (name, labels), v in sorted(self.counters.items()):
+                counters.setdefault(name, []).append((dict(labels), v))
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                histograms.setdefault(name, []).append((dict(labels), h.count, h.sum))
+        return {"counters": counters, "histograms": histograms}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def timed(method):
+    """
+    Decorator observing the latency of a method as fan_graph_seconds{method}, using self.metrics.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return f(self, *args, **kwargs)
+            with self.metrics.timer("fan_graph_seconds", method=method):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CountingTransaction:
+    """
+    Wraps a py2neo transaction, counting each run() as a round trip.
+    """
+
+    def __init__(self, tx, metrics, name):
+        self._tx = tx
+        self._metrics = metrics
+        self._name = name
+
+    def run(self, *args, **kwargs):
+        self._metrics.incr(self._name)
+        return self._tx.run(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._tx, name)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+
+def format_bound(b):
+    return "{:g}".format(b)
+
+
+def prometheus_text(metrics):
+    """
+    :param metrics: An InMemoryMetrics.
+    :return: The metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with metrics._lock:
+        counters = sorted(metrics.counters.items())
+        histograms = sorted(metrics.histograms.items(), key=lambda kv: kv[0])
+
+    typed = set()
+    for (name, labels), v in counters:
+        if name not in typed:
+            lines.append("# TYPE {} counter".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, format_labels(dict(labels)), v))
+
+    for (name, labels), h in histograms:
+        if name not in typed:
+            lines.append("# TYPE {} histogram".format(name))
+            typed.add(name)
+        labels = dict(labels)
+        cumulative = 0
+        for bound, count in zip(h.buckets, h.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels, le=format_bound(bound))),
+                                                 cumulative))
+        lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels, le="+Inf")), h.count))
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), h.sum))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), h.count))
+
+    return "\n".join(lines) + "\n"
+
+
+def log_metrics(metrics, logger=None, level=logging.INFO):
+    """
+    Logs every counter, and the count and mean of every histogram, one line each.
+    """
+    logger = logger or logging.getLogger(__name__)
+    snapshot = metrics.snapshot()
+
+    for name, values in snapshot["counters"].items():
+        for labels, v in values:
+            logger.log(level, "%s%s %s", name, format_labels(labels), v)
+
+    for name, values in snapshot["histograms"].items():
+        for labels, count, total in values:
+            logger.log(level, "%s%s count=%d mean_ms=%.3f", name, format_labels(labels), count,
+                       total / count * 1000 if count else 0.0)
@@ -0,0 +1,174 @@
+"""
+In-process L1 cache in front of the Redis (L2) result cache.
+
+L1Cache holds decoded results, keyed by RedisFunctions.generate_key, in a bounded LRU with a short
+TTL. A hit costs a dictionary lookup instead of a Redis round trip and a decode. Results returned from
+L1 are shared between callers and must not be modified.
+
+Every RedisFunctions that writes or deletes L2 entries publishes the keys on a Redis pub/sub channel,
+and L1Subscriber drops them from the L1 of every other process. Messages can arrive late or be lost
+while a subscriber reconnects, so the TTL bounds how long a stale L1 entry can be served.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import NOOP_METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = "cache:l1:invalidate"
+
+# Key in an invalidation message that clears the whole L1.
+ALL_KEYS = "*"
+
+
+class L1Cache:
+
+    def __init__(self, max_entries=1024, ttl=5.0, max_rows=1000, metrics=None):
+        """
+        :param max_entries: Entries kept. The least recently used entry is dropped beyond this.
+        :param ttl: Seconds an entry is served for.
+        :param max_rows: Results with more rows are left to L2, so L1 memory stays bounded.
+        :param metrics: Metrics counting l1_hits_total, l1_misses_total and l1_evictions_total.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.metrics = metrics or NOOP_METRICS
+
+        self._entries = OrderedDict()           # key -> (expires at, rows)
+        self._lock = threading.Lock()
+
+        # Bumped by every invalidation. A result read from L2 before an invalidation is not put into L1
+        # after it, see put().
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        :return: The cached rows, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            self.metrics.incr("l1_misses_total")
+            return None
+        self.metrics.incr("l1_hits_total")
+        return entry[1]
+
+    def put(self, key, rows, generation=None):
+        """
+        :param generation: The value of self.generation before rows were read from L2 or the database.
+            If an invalidation happened since, rows may be stale and are not cached.
+        :return: True if the rows were cached.
+        """
+        if len(rows) > self.max_rows:
+            return False
+
+        evicted = 0
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+
+            self._entries[key] = (time.monotonic() + self.ttl, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+
+        if evicted:
+            self.metrics.incr("l1_evictions_total", evicted)
+        return True
+
+    def invalidate(self, keys):
+        """
+        :param keys: Keys to drop. A list containing ALL_KEYS clears the cache.
+        """
+        with self._lock:
+            self.generation += 1
+            if ALL_KEYS in keys:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                return
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        self.invalidate([ALL_KEYS])
+
+    def stats(self):
+        """
+        :return: {"hits", "misses", "hit_ratio", "evictions", "invalidations", "size"}
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations,
+                    "size": len(self._entries)}
+
+
+class L1Subscriber:
+    """
+    Listens on the invalidation channel in a daemon thread and drops the published keys from an L1Cache.
+    """
+
+    def __init__(self, r, l1, channel=DEFAULT_CHANNEL, origin=None):
+        """
+        :param r: Redis client with decode_responses=True.
+        :param origin: ID of the publisher in this process. Its own messages are skipped, since it
+            invalidates its L1 directly.
+        """
+        self.r = r
+        self.l1 = l1
+        self.channel = channel
+        self.origin = origin
+        self.pubsub = None
+        self.thread = None
+
+    def start(self):
+        self.pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{self.channel: self.handle})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        return self
+
+    def handle(self, message):
+        try:
+            msg = json.loads(message["data"])
+        except (TypeError, ValueError) as e:
+            logger.warning("Ignoring invalid L1 invalidation message %r: %s", message.get("data"), e)
+            return
+
+        if msg.get("origin") != self.origin:
+            self.l1.invalidate(msg.get("keys") or [])
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread = None
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+
+def invalidation_message(origin, keys):
+    return json.dumps({"origin": origin, "keys": list(keys)})
@@ -1,8 +1,19 @@
-import redis
 import json
+import hashlib
+import logging
+import threading
+import time
+import uuid
 from redis_helper import MysqlHelpers
+from cache_policy import CacheBudget, DEFAULT_POLICY, DEFAULT_TABLE_POLICIES
+from cache_codec import CacheCodec
+from instrumentation import NOOP_METRICS
+from l1_cache import DEFAULT_CHANNEL, L1Subscriber, invalidation_message
+from startup import redis_config
 from urllib.parse import urlencode
 
+logger = logging.getLogger(__name__)
+
 """
 Connect to local Redis server. StrictRedis complies more closely with standard than
 simple Redis client in this package. decode_responses specifies whether or not to convert
@@ -12,65 +23,787 @@ bytes to UTF8 character string or treat as raw bytes, e.g. an image, audio strea
 
 class RedisFunctions:
 
-    def __init__(self):
-        self.r = redis.StrictRedis(
-            host='localhost',
-            port=6379,
-            charset="utf-8", decode_responses=True)
+    def __init__(self, key_compat=False, max_key_length=128, policies=None, default_policy=None,
+                 max_cache_bytes=None, eviction="lru", stale_while_revalidate=None, lock_ttl_ms=5000,
+                 lock_wait=10.0, lock_poll_interval=0.05, db=None, codec=None, metrics=None, debug=False,
+                 l1=None, l1_channel=DEFAULT_CHANNEL, config=None):
+        """
+        Redis is connected, and the L1 subscriber started, on first use or by connect(). The MySQL
+        connection pool is opened by the first query.
+
+        :param key_compat: If True, a miss on a canonical key falls back to the key the legacy
+            (insertion ordered) scheme would have produced, and migrates the entry when found.
+            Turn this on while old and new clients share the same Redis.
+        :param max_key_length: Canonical keys longer than this are replaced by a fixed length digest.
+        :param policies: {table: CachePolicy}. Replaces the entries of DEFAULT_TABLE_POLICIES with
+            the same table name.
+        :param default_policy: CachePolicy for tables without their own policy.
+        :param max_cache_bytes: Memory budget for evictable entries. None means unbounded.
+        :param eviction: "lru" or "lfu".
+        :param stale_while_revalidate: Seconds an entry may be served after its TTL while one worker
+            refreshes it in the background. None disables it.
+        :param lock_ttl_ms: Expiry of the Redis lock that elects the process filling a missed key.
+        :param lock_wait: Seconds a caller waits for another process to fill a key before querying
+            the database itself.
+        :param lock_poll_interval: Seconds between checks for the value while waiting.
+        :param db: MysqlHelpers to use, e.g. one with a larger connection pool for serving from a
+            thread pool. A default MysqlHelpers is created if None.
+        :param codec: CacheCodec used to write cached values. Values are always decoded by their own
+            header, so the codec can be changed without flushing the cache. Defaults to plain JSON.
+        :param metrics: Metrics recording hits, misses, fills, evictions, invalidations, bytes written
+            and request latency per table. Records nothing by default.
+        :param debug: If True, the rows of every hit and fill are logged, pretty printed, at DEBUG level.
+            This costs a full serialization of each result.
+        :param l1: An L1Cache of decoded results in front of Redis. None disables it.
+        :param l1_channel: Pub/sub channel on which every write, eviction and deletion of a cached key is
+            published, so processes with an L1 drop the key. Publish even without an own L1 when
+            other processes have one. None disables publishing and listening.
+        :param config: Redis connection settings overriding the environment, see startup.redis_config().
+        """
+        self.key_compat = key_compat
+        self.max_key_length = max_key_length
+        self.metrics = metrics or NOOP_METRICS
+        self.debug = debug
+
+        self.default_policy = default_policy or DEFAULT_POLICY
+        self.policies = dict(DEFAULT_TABLE_POLICIES)
+        for table, policy in (policies or {}).items():
+            self.set_policy(table, policy)
+
+        self.stale_while_revalidate = stale_while_revalidate
+        self.lock_ttl_ms = lock_ttl_ms
+        self.lock_wait = lock_wait
+        self.lock_poll_interval = lock_poll_interval
+
+        # In process single flight: key -> InFlight for misses currently being filled.
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
-        if self.r:
-            print("Connected with Redis.")
+        self.config = config
+        self.max_cache_bytes = max_cache_bytes
+        self.eviction = eviction
+        self.codec = codec or CacheCodec()
 
-        self.db = MysqlHelpers()
+        # Set by connect_redis().
+        self._r = None
+        self._rb = None
+        self._budget = None
+        self._connect_lock = threading.Lock()
+
+        self.instance_id = uuid.uuid4().hex
+        self.l1 = l1
+        self.l1_channel = l1_channel
+        self.l1_subscriber = None
+
+        self.db = db or MysqlHelpers(metrics=self.metrics)
+        self.db.add_write_listener(self.invalidate)
+
+    @property
+    def r(self):
+        """
+        Redis client decoding responses to str.
+        """
+        r = self._r
+        if r is None:
+            r = self.connect_redis()
+        return r
+
+    @property
+    def rb(self):
+        """
+        Redis client returning bytes. Cached values may be binary, so they are read with it.
+        """
+        if self._r is None:
+            self.connect_redis()
+        return self._rb
+
+    @property
+    def budget(self):
+        """
+        The CacheBudget tracking evictable entries.
+        """
+        if self._r is None:
+            self.connect_redis()
+        return self._budget
+
+    def connect_redis(self):
+        """
+        Imports redis, creates the clients and the CacheBudget, and starts the L1 subscriber, if that
+        has not happened yet.
+
+        :return: The decoding Redis client.
+        """
+        with self._connect_lock:
+            if self._r is not None:
+                return self._r
+
+            import redis
+
+            config = redis_config(self.config)
+            r = redis.StrictRedis(decode_responses=True, **config)
+            self._rb = redis.StrictRedis(decode_responses=False, **config)
+            self._budget = CacheBudget(r, max_bytes=self.max_cache_bytes, strategy=self.eviction)
+
+            if self.l1 is not None and self.l1_channel is not None:
+                self.l1_subscriber = L1Subscriber(r, self.l1, self.l1_channel, origin=self.instance_id).start()
+
+            logger.info("Redis client for %s:%s.", config["host"], config["port"])
+            self._r = r
+            return r
+
+    def connect(self):
+        """
+        Connects to Redis and opens the MySQL connection pool now instead of on first use.
+        """
+        self.r.ping()
+        self.db.connect()
 
     # ----- sh3907 implementation begins----- #
     # requirement function 1
     def retrieve_by_template(self, table, template, fields=None, limit=None, offset=None, order_by=None,
                              use_cache=False):
+        """
+        :return: The list of matching rows. On a cache miss, concurrent callers in this process share
+            one database query, and callers in other processes wait for the one holding the fill lock.
+            Rows served from the L1 cache are shared and must not be modified.
+        """
+        with self.metrics.timer("cache_request_seconds", table=table):
 
-        in_cache = None
+            if use_cache:
 
-        if use_cache:
+                key = self.generate_key(table, template, fields, limit, offset, order_by)
+
+                generation = None
+                if self.l1 is not None:
+                    in_l1 = self.l1.get(key)
+                    if in_l1 is not None:
+                        return in_l1
+                    generation = self.l1.generation
+
+                in_cache = self.check_cache(table, template, fields, limit, offset, order_by)
 
-            in_cache = self.check_cache(table, template, fields, limit, offset, order_by)
+                if in_cache:
+                    self.metrics.incr("cache_hits_total", table=table)
+                    logger.debug("CACHE HIT key=%s", key)
+                    if self.debug:
+                        logger.debug("Check cache returned: %s", json.dumps(in_cache, indent=2, default=str))
 
-            if in_cache:
-                print("Check cache returned: ", json.dumps(json.loads(in_cache), indent=2))
-                print("CACHE HIT")
+                    if self.is_stale(table, key):
+                        self.refresh_in_background(key, table, template, fields, limit, offset, order_by)
+                    elif self.l1 is not None:
+                        self.l1.put(key, in_cache, generation)
 
-        if not use_cache or not in_cache:
+                    return in_cache
+
+                self.metrics.incr("cache_misses_total", table=table)
+                logger.debug("CACHE MISS key=%s", key)
+                return self.single_flight(key, lambda: self.fill(key, table, template, fields, limit, offset,
+                                                                 order_by, generation))
+
+            generation = self.l1.generation if self.l1 is not None else None
+            version = self.table_version(table)
             q_result = self.db.find_by_template(table, template, fields, limit, offset, order_by)
 
             if q_result:
-                print("Retrieve data from mysql database: ", json.dumps(q_result, indent=2))
-                self.add_to_cache(table, template, fields, limit, offset, order_by, q_result)
+                if self.debug:
+                    logger.debug("Retrieve data from mysql database: %s", json.dumps(q_result, indent=2, default=str))
+                self.add_to_cache(table, template, fields, limit, offset, order_by, q_result, version,
+                                  generation)
+            else:
+                logger.info("Data not found from the database. Please modify your input")
+
+            return q_result
+
+    def fill(self, key, table, template, fields, limit, offset, order_by, generation=None):
+        """
+        Fills a missed key. One process at a time holds the fill lock (SET NX PX) and runs the query,
+        the others poll for the value until it appears, the lock is released, or lock_wait passes.
+        Results that are not cached (empty, or over the policy size limit) are not shared across
+        processes, the next lock holder queries again.
+
+        :param generation: The L1 generation read before the caller missed L1, see add_to_cache.
+        :return: The query result.
+        """
+        lock_key = "cache:lock:" + key
+        deadline = time.time() + self.lock_wait
+
+        while True:
+            token = self.acquire_lock(lock_key)
+
+            if token:
+                try:
+                    # Another process may have filled the key between our miss and getting the lock.
+                    cached = self.retrieve_from_cache(key)
+                    if cached:
+                        return cached
+
+                    version = self.table_version(table)
+                    q_result = self.db.find_by_template(table, template, fields, limit, offset, order_by)
+                    if q_result:
+                        if self.debug:
+                            logger.debug("Retrieve data from mysql database: %s",
+                                         json.dumps(q_result, indent=2, default=str))
+                        self.add_to_cache(table, template, fields, limit, offset, order_by, q_result, version,
+                                          generation)
+                    else:
+                        logger.info("Data not found from the database. Please modify your input")
+                    return q_result
+                finally:
+                    self.release_lock(lock_key, token)
+
+            time.sleep(self.lock_poll_interval)
+
+            cached = self.retrieve_from_cache(key)
+            if cached:
+                return cached
+
+            if time.time() > deadline:
+                logger.warning("Timed out waiting for key=%s to be filled. Querying the database.", key)
+                return self.db.find_by_template(table, template, fields, limit, offset, order_by)
+
+    def single_flight(self, key, loader):
+        """
+        Runs loader once per key at a time in this process. Callers arriving while a load for the same
+        key is running wait for it and get its result (or its exception).
+        """
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = InFlight()
+                self._inflight[key] = call
+
+        if not leader:
+            return call.wait()
+
+        try:
+            call.result = loader()
+        except Exception as e:
+            call.error = e
+            raise e
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            call.done.set()
+
+        return call.result
+
+    def acquire_lock(self, lock_key):
+        """
+        :return: The lock token if the lock was acquired, otherwise None.
+        """
+        token = uuid.uuid4().hex
+        if self.r.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+            return token
+        return None
+
+    def release_lock(self, lock_key, token):
+        """
+        Deletes the lock only if it still holds our token, so a lock that expired and was taken by
+        another process is left alone.
+        """
+        from redis import WatchError
 
-                if use_cache:
-                    print("CACHE MISS")
+        with self.r.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    # Stale while revalidate. With stale_while_revalidate set, a value is written with its policy
+    # TTL plus the stale window, and a separate "fresh" marker key is written with the policy TTL. A hit
+    # with no fresh marker is served as is while one worker, elected by the fill lock, refreshes it.
+    def fresh_key(self, key):
+        return "cache:fresh:" + key
+
+    def is_stale(self, table, key):
+        if self.stale_while_revalidate is None or self.policy_for(table).ttl is None:
+            return False
+        return not self.r.exists(self.fresh_key(key))
+
+    def refresh_in_background(self, key, table, template, fields, limit, offset, order_by):
+        lock_key = "cache:lock:" + key
+        token = self.acquire_lock(lock_key)
+        if not token:
+            return
+
+        def refresh():
+            try:
+                generation = self.l1.generation if self.l1 is not None else None
+                version = self.table_version(table)
+                q_result = self.db.find_by_template(table, template, fields, limit, offset, order_by)
+                if q_result:
+                    self.add_to_cache(table, template, fields, limit, offset, order_by, q_result, version,
+                                      generation)
+            except Exception as e:
+                logger.warning("Background refresh of key=%s failed: %s", key, e)
+            finally:
+                self.release_lock(lock_key, token)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stream_by_template(self, table, template, fields=None, limit=None, offset=None, order_by=None,
+                           use_cache=False, chunk_size=1000):
+        """
+        Streams the rows of a query without materializing the result. Cached results are stored as a
+        Redis list of encoded chunks of chunk_size rows under "<key>:chunks", and are read back one chunk
+        at a time. On a miss the rows are streamed from MySQL and the chunks are written to a temporary
+        list that is renamed into place once the result is complete, so readers never see a partial
+        result.
+
+        :return: A generator of rows.
+        """
+        key = self.chunks_key(self.generate_key(table, template, fields, limit, offset, order_by))
+
+        if use_cache and self.r.exists(key):
+            self.metrics.incr("cache_hits_total", table=table)
+            logger.debug("CACHE HIT key=%s", key)
+            if self.budget.enabled:
+                self.budget.touch(key)
+
+            n_read = 0
+            i = 0
+            while True:
+                chunk = self.rb.lindex(key, i)
+                if chunk is None:
+                    break
+                for row in self.codec.decode(chunk):
+                    n_read += 1
+                    yield row
+                i += 1
+
+            if i == 0 or n_read > 0 and not self.r.exists(key):
+                # The list expired or was evicted while being read. Continue from the database, which
+                # is only exact for queries with a deterministic order.
+                logger.warning("Cached result for key=%s went away while being read.", key)
+                rows = self.db.iter_by_template(table, template, fields, limit, offset, order_by)
+                for n, row in enumerate(rows):
+                    if n >= n_read:
+                        yield row
+            return
+
+        if use_cache:
+            self.metrics.incr("cache_misses_total", table=table)
+            logger.debug("CACHE MISS key=%s", key)
+
+        policy = self.policy_for(table)
+        version = self.table_version(table)
+        tmp_key = key + ":tmp:" + uuid.uuid4().hex
+        size = 0
+        caching = True
+
+        for batch in self.db.iter_by_template(table, template, fields, limit, offset, order_by,
+                                              batch_size=chunk_size):
+            if caching:
+                v = self.codec.encode(batch)
+                size += len(v)
+                if policy.allows(size):
+                    pipe = self.r.pipeline()
+                    pipe.rpush(tmp_key, v)
+                    # Cleans up after readers that stop early.
+                    pipe.expire(tmp_key, 600)
+                    pipe.execute()
+                else:
+                    logger.info("Result for key=%s is over the %s byte limit. Not cached.",
+                                key, policy.max_value_bytes)
+                    self.r.delete(tmp_key)
+                    caching = False
+
+            for row in batch:
+                yield row
+
+        if caching and size > 0:
+            pipe = self.fill_pipeline(table, version)
+            if pipe is None:
+                self.r.delete(tmp_key)
+                return
+            pipe.rename(tmp_key, key)
+            if policy.ttl is not None:
+                pipe.expire(key, policy.ttl)
             else:
-                print("Data not found from the database. Please modify your input")
+                pipe.persist(key)
+            self.index_key(pipe, table, template, key, policy.ttl)
+            if policy.evictable and self.budget.enabled:
+                self.budget.track(pipe, key, size)
+            if self.execute_fill(pipe, table) is None:
+                self.r.delete(tmp_key)
+                return
+            self.metrics.incr("cache_fills_total", table=table)
+            self.metrics.incr("cache_bytes_serialized_total", size, table=table)
+            logger.debug("Successful add key=%s data into cache", key)
+            self.evict()
+
+    def chunks_key(self, key):
+        return key + ":chunks"
+
+    def retrieve_many(self, table, templates, fields=None, order_by=None, use_cache=True):
+        """
+        Retrieves the results for many templates on the same table, e.g. the People rows for a list of
+        playerIDs, in a few round trips: one MGET for all keys, one query per group of missed templates
+        and one pipeline writing all the fills.
+
+        Missed templates with the same columns and only scalar values are grouped. Within a group the
+        column with the most distinct values becomes an IN list, and templates that agree on the other
+        columns share one query. Other templates are queried one by one. Limit and offset are not
+        supported, because they cannot be applied per template to a combined query.
+
+        :return: A list with the rows for each template, in the order of templates.
+        """
+        keys = [self.generate_key(table, t, fields, None, None, order_by) for t in templates]
+        results = [None] * len(templates)
+
+        generation = None
+        if use_cache and self.l1 is not None:
+            generation = self.l1.generation
+            results = [self.l1.get(k) for k in keys]
+
+        pending = [i for i in range(len(keys)) if results[i] is None]
+        if use_cache and pending:
+            values = self.rb.mget([keys[i] for i in pending])
+            hits = []
+            for i, v in zip(pending, values):
+                if v:
+                    results[i] = self.codec.decode(v)
+                    hits.append(keys[i])
+                    if self.l1 is not None:
+                        self.l1.put(keys[i], results[i], generation)
+            if hits and self.budget.enabled:
+                self.budget.touch_many(hits)
+            self.metrics.incr("cache_hits_total", len(hits), table=table)
+            self.metrics.incr("cache_misses_total", len(pending) - len(hits), table=table)
+            logger.debug("retrieve_many: %d CACHE HIT, %d CACHE MISS", len(hits), len(pending) - len(hits))
+
+        # A template listed more than once is queried and filled once, under the first of its indexes.
+        misses = [i for i in pending if results[i] is None]
+        first = {}
+        for i in misses:
+            first.setdefault(keys[i], i)
+        unique = list(first.values())
+
+        version = self.table_version(table) if unique else None
+        for group in self.group_templates([templates[i] for i in unique]):
+            group = [unique[j] for j in group]
+            rows_by_template = self.query_group(table, [templates[i] for i in group], fields, order_by)
+            for i, rows in zip(group, rows_by_template):
+                results[i] = rows
+        for i in misses:
+            results[i] = results[first[keys[i]]]
+
+        if not any(results[i] for i in unique):
+            return results
+
+        pipe = self.fill_pipeline(table, version)
+        if pipe is None:
+            return results
+        tracked = []
+        filled = []
+        for i in unique:
+            if results[i]:
+                if self.queue_fill(pipe, table, templates[i], keys[i], results[i], tracked):
+                    filled.append(i)
+        if filled:
+            self.budget.track_many(pipe, tracked)
+            if self.execute_fill(pipe, table) is not None:
+                if self.l1 is not None and generation is not None:
+                    for i in filled:
+                        self.l1.put(keys[i], results[i], generation)
+                logger.debug("retrieve_many: added %d results to the cache.", len(filled))
+                self.evict()
+        else:
+            pipe.reset()
+
+        return results
+
+    def group_templates(self, templates):
+        """
+        :return: A list of groups, each a list of indexes into templates, that can be answered by one
+            query. See retrieve_many.
+        """
+        by_columns = {}
+        singles = []
+        for i, t in enumerate(templates):
+            if t and not any(isinstance(v, (list, tuple, set, dict)) for v in t.values()):
+                by_columns.setdefault(tuple(sorted(t.keys())), []).append(i)
+            else:
+                singles.append([i])
+
+        groups = []
+        for columns, members in by_columns.items():
+            pivot = max(columns, key=lambda c: len(set(str(templates[i][c]) for i in members)))
+            by_rest = {}
+            for i in members:
+                rest = tuple(str(templates[i][c]) for c in columns if c != pivot)
+                by_rest.setdefault(rest, []).append(i)
+            groups.extend(by_rest.values())
+
+        return groups + singles
+
+    def query_group(self, table, templates, fields, order_by):
+        """
+        Runs one query for a group from group_templates and splits the rows back per template.
+
+        :return: A list with the rows for each template.
+        """
+        if len(templates) == 1:
+            return [self.db.find_by_template(table, templates[0], fields, None, None, order_by) or []]
+
+        columns = sorted(templates[0].keys())
+        pivot = max(columns, key=lambda c: len(set(str(t[c]) for t in templates)))
+
+        q_template = {c: templates[0][c] for c in columns if c != pivot}
+        q_template[pivot] = list(dict.fromkeys(t[pivot] for t in templates))
+
+        q_fields = fields
+        if fields and pivot not in fields:
+            q_fields = list(fields) + [pivot]
+
+        rows = self.db.find_by_template(table, q_template, q_fields, None, None, order_by) or []
+
+        # MySQL compares strings case insensitively with the default collations, so do the same when
+        # matching rows back to templates.
+        by_value = {}
+        for r in rows:
+            v = str(r[pivot]).casefold()
+            if q_fields is not fields:
+                r = {c: r[c] for c in fields}
+            by_value.setdefault(v, []).append(r)
+
+        return [by_value.get(str(t[pivot]).casefold(), []) for t in templates]
 
     # requirement function 2
     def retrieve_from_cache(self, key):
         """
         :param key: A valid Redis key.
-        :return: The "map object" associated with the key.
+        :return: The "map object" associated with the key, decoded into a list of rows, or None.
         """
-        result = self.r.get(key)
+        result = self.codec.decode(self.rb.get(key))
         return result
 
     # requirement function 3
-    def add_to_cache(self, table, tmp, fields, limit, offset, order_by, q_result):
+    def add_to_cache(self, table, tmp, fields, limit, offset, order_by, q_result, version=None,
+                     generation=None):
+        """
+        Adds a query result to the cache, following the cache policy of the table.
+
+        :param version: The table_version read before q_result was queried. If the table was written
+            since, the result may predate the write and is not cached.
+        :param generation: The L1 generation read before q_result was queried. If given, the result is
+            also put in L1 once it is in Redis, unless an L1 invalidation happened since.
+        :return: True if the result was cached.
+        """
         key = self.generate_key(table, tmp, fields, limit, offset, order_by)
-        v = json.dumps(q_result)
-        save_result = self.r.set(key, v)
+
+        pipe = self.fill_pipeline(table, version)
+        if pipe is None:
+            return False
+        tracked = []
+        if not self.queue_fill(pipe, table, tmp, key, q_result, tracked):
+            pipe.reset()
+            return False
+        if tracked:
+            self.budget.track_many(pipe, tracked)
+        executed = self.execute_fill(pipe, table)
+        if executed is None:
+            return False
+        save_result = executed[0]
+
+        if save_result and self.l1 is not None and generation is not None:
+            self.l1.put(key, q_result, generation)
 
         if save_result:
-            print("Successful add key={} data into cache".format(key))
+            logger.debug("Successful add key=%s data into cache", key)
         else:
-            print("Fail to add into cache.")
+            logger.warning("Fail to add into cache.")
+
+        self.evict()
+
+        return bool(save_result)
+
+    def fill_pipeline(self, table, version):
+        """
+        :param version: The table_version read before the database query, or None to skip the check.
+        :return: A transaction pipeline to queue fills of table on, or None if the table was written
+            since version was read. The pipeline watches the version, so execute_fill also fails if a
+            write comes in before it runs.
+        """
+        pipe = self.r.pipeline()
+        if version is None:
+            return pipe
+
+        pipe.watch(self.version_key(table))
+        if (pipe.get(self.version_key(table)) or "0") != version:
+            pipe.reset()
+            logger.debug("Table %s was written during the fill. Not caching the result.", table)
+            return None
+        pipe.multi()
+        return pipe
+
+    def execute_fill(self, pipe, table):
+        """
+        :return: The pipeline results, or None if the table was written after fill_pipeline.
+        """
+        from redis import WatchError
+
+        try:
+            return pipe.execute()
+        except WatchError:
+            logger.debug("Table %s was written during the fill. Not caching the result.", table)
+            return None
+
+    def evict(self):
+        """
+        Evicts the coldest entries while the cache is over its budget.
+
+        :return: The list of evicted keys.
+        """
+        evicted = self.budget.evict()
+        if evicted:
+            self.unindex_keys(evicted)
+            self.publish_invalidation(evicted)
+            self.metrics.incr("cache_evictions_total", len(evicted))
+            logger.info("Evicted %d keys to stay within the cache budget.", len(evicted))
+        return evicted
+
+    def publish_invalidation(self, keys, pipe=None):
+        """
+        Drops keys from the L1 cache of this process and publishes them to the L1 caches of the others.
+
+        :param pipe: If given, the publish is queued on this pipeline instead of sent.
+        """
+        if not keys:
+            return
+        if self.l1 is not None:
+            self.l1.invalidate(keys)
+        if self.l1_channel is not None:
+            (pipe if pipe is not None else self.r).publish(self.l1_channel,
+                                                           invalidation_message(self.instance_id, keys))
+
+    def queue_fill(self, pipe, table, tmp, key, q_result, tracked):
+        """
+        Queues the writes that cache one result on pipe, following the cache policy of the table.
+
+        :param tracked: List the (key, size) pair is appended to if the entry counts against the
+            cache budget. The caller passes the list to CacheBudget.track_many on the same pipe.
+        :return: False if the policy does not allow caching the result.
+        """
+        v = self.codec.encode(q_result)
+        size = len(v)
+        policy = self.policy_for(table)
+
+        if not policy.allows(size):
+            logger.info("Result for key=%s is %d bytes, over the %s byte limit. Not cached.",
+                        key, size, policy.max_value_bytes)
+            return False
+
+        self.metrics.incr("cache_fills_total", table=table)
+        self.metrics.incr("cache_bytes_serialized_total", size, table=table)
+
+        ttl = policy.ttl
+        if ttl is not None and self.stale_while_revalidate is not None:
+            ttl = policy.ttl + self.stale_while_revalidate
+
+        pipe.set(key, v, ex=ttl)
+        # Other processes drop their L1 copy. The caller puts the new result in the L1 of this process
+        # once the pipeline ran.
+        if self.l1_channel is not None:
+            pipe.publish(self.l1_channel, invalidation_message(self.instance_id, [key]))
+        if ttl != policy.ttl:
+            pipe.set(self.fresh_key(key), 1, ex=policy.ttl)
+        self.index_key(pipe, table, tmp, key, ttl)
+        if policy.evictable and self.budget.enabled:
+            tracked.append((key, size))
+
+        return True
+
+    def policy_for(self, table):
+        """
+        :param table: Table name. Policies are looked up case insensitively.
+        :return: The CachePolicy for the table.
+        """
+        return self.policies.get(table.lower(), self.default_policy)
+
+    def set_policy(self, table, policy):
+        self.policies[table.lower()] = policy
 
     def generate_key(self, table, template, fields, limit, offset, order_by):
+        """
+        Builds the canonical cache key for a query. Logically equal queries map to the same key
+        regardless of the order of the template keys or of the field list.
+
+        :return: "<table>/<canonical query>", or "<table>/#<sha1 of the canonical key>" if the
+            canonical key is longer than max_key_length.
+        """
+        k = table + "/" + self.canonical_query(template, fields, limit, offset, order_by)
+
+        if len(k) > self.max_key_length:
+            k = table + "/#" + hashlib.sha1(k.encode("utf-8")).hexdigest()
+
+        return k
+
+    def canonical_query(self, template, fields, limit, offset, order_by):
+        """
+        Template columns are sorted, fields are de-duplicated and sorted and order_by is flattened
+        to "col,col DIRECTION". Query options use a leading underscore so they cannot collide with
+        column names in the template.
+
+        :return: The url encoded, canonical form of the query.
+        """
+        pairs = sorted((str(k), self.canonical_value(v)) for k, v in (template or {}).items())
+
+        if fields:
+            pairs.append(("_fields", ",".join(sorted(set(fields)))))
+        if limit is not None:
+            pairs.append(("_limit", str(limit)))
+        if offset is not None:
+            pairs.append(("_offset", str(offset)))
+        if order_by:
+            pairs.append(("_order_by", self.normalize_order_by(order_by)))
+
+        return urlencode(pairs)
+
+    def canonical_value(self, v):
+        """
+        :return: The canonical string for a template value. IN lists are de-duplicated, sorted and
+            written as a JSON list after "in:", range predicates as a JSON object after "range:". Scalars
+            are written as is, unless they could be read as one of those or as an escaped scalar, in
+            which case they are prefixed with "=". So a literal "in:a,b" and the list ["a", "b"] get
+            different keys.
+        """
+        if isinstance(v, (list, tuple, set)):
+            return "in:" + json.dumps(sorted(set(str(x) for x in v)), separators=(",", ":"))
+        if isinstance(v, dict):
+            return "range:" + json.dumps({op: str(b) for op, b in v.items()}, sort_keys=True,
+                                         separators=(",", ":"))
+        v = str(v)
+        if v.startswith(("in:", "range:", "=")):
+            return "=" + v
+        return v
+
+    def normalize_order_by(self, order_by):
+        """
+        :param order_by: {"fields": [...], "direction": "asc"|"desc"}, as passed to find_by_template.
+        :return: "col1,col2 ASC". The order of the fields is significant and is kept.
+        """
+        if isinstance(order_by, dict):
+            o_fields = order_by.get("fields", [])
+            direction = (order_by.get("direction") or "ASC").upper()
+        else:
+            o_fields = order_by
+            direction = "ASC"
+
+        if isinstance(o_fields, str):
+            o_fields = [o_fields]
+
+        return ",".join(o_fields) + " " + direction
+
+    def generate_legacy_key(self, table, template, fields, limit, offset, order_by):
+        """
+        The key scheme used before canonical keys. Only used for reads when key_compat is on.
+        """
         tmp = template.copy()
         if fields:
             tmp['field'] = ",".join(fields)
@@ -88,17 +821,327 @@ class RedisFunctions:
     def check_cache(self, table, tmp, fields, limit, offset, order_by):
         key = self.generate_key(table, tmp, fields, limit, offset, order_by)
         result = self.retrieve_from_cache(key)
+
+        if not result and self.key_compat:
+            legacy_key = self.generate_legacy_key(table, tmp, fields, limit, offset, order_by)
+            raw = self.rb.get(legacy_key)
+            if raw:
+                # Copy the entry under the canonical key, as a regular fill with the table's TTL, index
+                # entries and budget tracking. The legacy entry is left alone because clients that have
+                # not been upgraded yet still read it.
+                result = self.codec.decode(raw)
+                if self.add_to_cache(table, tmp, fields, limit, offset, order_by, result):
+                    logger.info("Migrated cache key=%s to key=%s", legacy_key, key)
+                return result
+
         if result:
+            if self.budget.enabled:
+                self.budget.touch(key)
             return result
         else:
             return None
 
-    def delete_keys(self):
-        keys = self.get_keys()
-        self.r.delete(*keys)
+    # Invalidation. Every cached key is indexed by its table and by each column=value pair in its
+    # template, in sorted sets scored by the key's expiry time, and its template is kept in a
+    # "cache:template:<key>" entry that expires with it. A write then only has to look at the live keys
+    # sharing at least one column value with a changed row, plus the keys of templates with no
+    # predicates, and deletes the ones whose template actually matches an old or new row image. Index
+    # entries of expired keys are trimmed by score whenever a set is written or read, and evicted or
+    # invalidated keys are removed from the index directly.
+    #
+    # MySQL compares strings case insensitively with the default collations, so column names and values
+    # are case folded in the tags and when matching templates against rows.
+    def tag_key(self, table, column=None, value=None):
+        if column is None:
+            return "cache:tags:" + table.lower()
+        return "cache:tags:" + table.lower() + ":" + str(column).lower() + "=" + self.fold(value)
+
+    def fold(self, v):
+        return str(v).casefold()
+
+    def template_key(self, key):
+        return "cache:template:" + key
+
+    def version_key(self, table):
+        return "cache:version:" + table.lower()
+
+    def table_version(self, table):
+        """
+        :return: The write version of table. Read it before querying the database for a fill, and pass
+            it to add_to_cache, so a result read before a write is not cached after the write's
+            invalidation ran.
+        """
+        return self.r.get(self.version_key(table)) or "0"
+
+    def index_key(self, pipe, table, template, key, ttl):
+        """
+        Queues the index entries for a new cache key on pipe.
+
+        :param ttl: TTL of the cache entry. A tag set expires with its newest member, and members that
+            expired are trimmed on every fill that writes the set.
+        """
+        template = self.normalize_template(template)
+        tags = [self.tag_key(table)] + self.value_tags(table, template)
+        now = time.time()
+        expires = now + ttl if ttl is not None else "+inf"
+
+        for tag in tags:
+            pipe.zremrangebyscore(tag, "-inf", now)
+            pipe.zadd(tag, {key: expires})
+            if ttl is not None:
+                pipe.expire(tag, ttl)
+            else:
+                pipe.persist(tag)
+        pipe.set(self.template_key(key), json.dumps({"table": table, "template": template}, sort_keys=True),
+                 ex=ttl)
+
+    def unindex(self, pipe, entries):
+        """
+        Queues the removal of the index entries of deleted keys on pipe.
+
+        :param entries: List of (key, table, template).
+        """
+        for key, table, template in entries:
+            for tag in [self.tag_key(table)] + self.value_tags(table, template):
+                pipe.zrem(tag, key)
+            pipe.delete(self.template_key(key))
+
+    def unindex_keys(self, keys):
+        """
+        Removes deleted keys, e.g. evicted ones, from the index.
+        """
+        if not keys:
+            return
+        entries = []
+        for key, t in zip(keys, self.r.mget([self.template_key(k) for k in keys])):
+            if t:
+                t = json.loads(t)
+                entries.append((key, t["table"], t["template"]))
+        pipe = self.r.pipeline(transaction=False)
+        self.unindex(pipe, entries)
+        pipe.execute()
+
+    def normalize_template(self, template):
+        """
+        :return: A JSON serializable copy of the template, with IN lists as sorted lists.
+        """
+        result = {}
+        for c, v in (template or {}).items():
+            if isinstance(v, (list, tuple, set)):
+                v = sorted(set(v), key=str)
+            result[c] = v
+        return result
+
+    def value_tags(self, table, template):
+        """
+        :return: The column=value tags a key is indexed under. Any row matching the template hits at
+            least one of them. Range predicates cannot be tagged by value, so a template with only range
+            predicates (or no predicates) is tagged as "_any" and checked on every write to the table.
+        """
+        tags = []
+        for c, v in template.items():
+            if isinstance(v, (list, tuple, set)):
+                tags.extend(self.tag_key(table, c, x) for x in v)
+            elif not isinstance(v, dict):
+                tags.append(self.tag_key(table, c, v))
+
+        if not tags:
+            tags.append(self.tag_key(table, "_any", ""))
+        return tags
+
+    def template_matches(self, template, row):
+        """
+        :return: False if the row certainly does not satisfy the template. Columns missing from the
+            row image are treated as matching.
+        """
+        row = {str(c).lower(): v for c, v in row.items()}
+        for c, v in template.items():
+            c = str(c).lower()
+            if c not in row:
+                continue
+            if isinstance(v, (list, tuple, set)):
+                if self.fold(row[c]) not in set(self.fold(x) for x in v):
+                    return False
+            elif isinstance(v, dict):
+                for op, bound in v.items():
+                    if not self.compare(row[c], op, bound):
+                        return False
+            elif self.fold(row[c]) != self.fold(v):
+                return False
+        return True
+
+    def compare(self, value, op, bound):
+        """
+        Evaluates a range predicate. Compares as numbers when both sides are numeric, else as case
+        folded strings. NULL never matches, as in SQL.
+        """
+        if value is None:
+            return False
+        try:
+            a, b = float(value), float(bound)
+        except (TypeError, ValueError):
+            a, b = self.fold(value), self.fold(bound)
+
+        if op == "=":
+            return a == b
+        if op == "!=":
+            return a != b
+        if op == "<":
+            return a < b
+        if op == "<=":
+            return a <= b
+        if op == ">":
+            return a > b
+        if op == ">=":
+            return a >= b
+        # Unknown operator: keep the invalidation conservative.
+        return True
+
+    def invalidate(self, table, rows=None):
+        """
+        Deletes the cached results a write to table may have changed, and bumps the table's write
+        version so fills that read the database before the write are not cached. Registered as a write
+        listener on MysqlHelpers.
+
+        :param table: The table that was written.
+        :param rows: Row images (before and after) of the changed rows. None invalidates every
+            cached result for the table.
+        :return: The list of deleted keys.
+        """
+        if rows is None:
+            tags = [self.tag_key(table)]
+        else:
+            tags = {self.tag_key(table, "_any", "")}
+            for row in rows:
+                tags.update(self.tag_key(table, c, v) for c, v in row.items())
+            tags = sorted(tags)
+
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        pipe.incr(self.version_key(table))
+        for tag in tags:
+            pipe.zremrangebyscore(tag, "-inf", now)
+            pipe.zrange(tag, 0, -1)
+        candidates = sorted(set(k for members in pipe.execute()[2::2] for k in members))
+
+        if not candidates:
+            return []
+
+        stale = []
+        gone = []
+        for key, t in zip(candidates, self.r.mget([self.template_key(k) for k in candidates])):
+            if not t:
+                # Deleted without being unindexed, e.g. by delete_keys. Drop it from the sets read.
+                gone.append(key)
+                continue
+            t = json.loads(t)["template"]
+            if rows is None or any(self.template_matches(t, row) for row in rows):
+                stale.append((key, table, t))
+
+        pipe = self.r.pipeline()
+        if gone:
+            for tag in tags:
+                pipe.zrem(tag, *gone)
+        if stale:
+            keys = [key for key, table, t in stale]
+            pipe.delete(*keys)
+            self.unindex(pipe, stale)
+            self.budget.forget(pipe, keys)
+            self.publish_invalidation(keys, pipe)
+        pipe.execute()
+
+        stale = [key for key, table, t in stale]
+        if stale:
+            self.metrics.incr("cache_invalidations_total", len(stale), table=table)
+            logger.debug("Invalidated %d cached results for table %s.", len(stale), table)
+        return stale
+
+    def delete_keys(self, table=None, batch_size=500, count=1000):
+        """
+        Deletes cached keys without blocking Redis. Keys are found with SCAN and removed with UNLINK in
+        pipelined batches, so other clients are served between batches.
+
+        :param table: If given, only the cached results and index entries for this table are deleted.
+            The match on the key prefix is case sensitive. If None, every key in Redis is deleted.
+        :param batch_size: Number of keys per UNLINK.
+        :param count: COUNT hint for SCAN.
+        :return: The number of keys deleted.
+        """
+        if table is None:
+            patterns = ["*"]
+        else:
+            patterns = [self.escape_pattern(table) + "/*",
+                        self.escape_pattern(self.tag_key(table)),
+                        self.escape_pattern(self.tag_key(table)) + ":*",
+                        self.escape_pattern(self.template_key(table + "/")) + "*"]
+
+        deleted = 0
+        for pattern in patterns:
+            batch = []
+            for key in self.scan_keys(pattern, count):
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    deleted += self.unlink_batch(batch, forget=table is not None)
+                    batch = []
+                    logger.debug("Deleted %d keys so far.", deleted)
+
+            if batch:
+                deleted += self.unlink_batch(batch, forget=table is not None)
+
+        logger.info("Deleted %d keys.", deleted)
+        return deleted
+
+    def unlink_batch(self, keys, forget=True):
+        """
+        :param forget: Also remove the keys from the cache budget bookkeeping.
+        :return: The number of keys that existed and were unlinked.
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.unlink(*keys)
+        if forget and self.budget.enabled:
+            self.budget.forget(pipe, keys)
+        self.publish_invalidation(keys, pipe)
+        return pipe.execute()[0]
+
+    def escape_pattern(self, s):
+        """
+        Escapes the glob characters SCAN MATCH understands.
+        """
+        for c in "\\*?[]":
+            s = s.replace(c, "\\" + c)
+        return s
 
     # ----- sh3907 implementation ends----- #
 
-    def get_keys(self):
-        result = self.r.keys()
+    def scan_keys(self, pattern="*", count=1000):
+        """
+        :param pattern: SCAN MATCH pattern, e.g. "People/*".
+        :param count: COUNT hint for SCAN.
+        :return: An iterator over the matching keys. A key may be returned more than once.
+        """
+        return self.r.scan_iter(match=pattern, count=count)
+
+    def get_keys(self, pattern="*"):
+        """
+        :return: A list of the keys matching pattern. Uses SCAN, but builds the whole list, so prefer
+            scan_keys() for large caches.
+        """
+        result = list(self.scan_keys(pattern))
         return result
+
+
+class InFlight:
+    """
+    A load in progress for RedisFunctions.single_flight.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -7,18 +7,161 @@ Check and return if cached.
 Call DB and add to cache if not cached.
 '''
 
-import pymysql.cursors
+import logging
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import NOOP_METRICS
+from startup import mysql_config
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    A bounded, thread safe pool of DB connections. At most max_size connections are checked out at
+    once. Idle connections are reused most recently used first, and are pinged (and reconnected if
+    needed) before reuse when they have been idle longer than health_check_interval.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=5.0, health_check_interval=30.0):
+        """
+        :param connect: Function returning a new connection.
+        :param min_size: Connections opened up front.
+        :param max_size: Most connections checked out at the same time.
+        :param timeout: Seconds to wait for a free connection before raising TimeoutError.
+        :param health_check_interval: Idle seconds after which a connection is pinged before reuse.
+        """
+        if min_size > max_size:
+            raise ValueError("min_size {} is larger than max_size {}.".format(min_size, max_size))
+
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+        for i in range(min_size):
+            self._idle.put((connect(), time.time()))
+
+    def acquire(self):
+        """
+        :return: A connection. Give it back with release().
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("No DB connection became free within {} seconds.".format(self.timeout))
+
+        try:
+            try:
+                cnx, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            if time.time() - last_used > self.health_check_interval:
+                try:
+                    cnx.ping(reconnect=True)
+                except Exception:
+                    self.close_quietly(cnx)
+                    cnx = self._connect()
+
+            return cnx
+        except Exception as e:
+            self._slots.release()
+            raise e
+
+    def release(self, cnx, discard=False):
+        """
+        :param discard: Close the connection instead of returning it to the pool, e.g. after an error
+            that may have left it in an unknown state.
+        """
+        if discard:
+            self.close_quietly(cnx)
+        else:
+            self._idle.put((cnx, time.time()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of a with block. If the block raises, the connection
+        is rolled back, or discarded if the rollback fails too.
+        """
+        cnx = self.acquire()
+        try:
+            yield cnx
+        except Exception as e:
+            discard = False
+            try:
+                cnx.rollback()
+            except Exception:
+                discard = True
+            self.release(cnx, discard=discard)
+            raise e
+        else:
+            self.release(cnx)
+
+    def close_all(self):
+        while True:
+            try:
+                cnx, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.close_quietly(cnx)
+
+    def close_quietly(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+
+# Table and column names are put into the SQL text, so they must be plain identifiers. Lahman has
+# columns starting with a digit, e.g. 2B and 3B, so every identifier is backtick-quoted, see quote.
+IDENTIFIER = re.compile(r"^[A-Za-z0-9_$]+$")
+
+# Operators allowed in range predicates, e.g. {"yearID": {">=": 2010, "<": 2015}}.
+RANGE_OPERATORS = ("=", "!=", "<", "<=", ">", ">=")
+
+INT_TYPES = ("tinyint", "smallint", "mediumint", "int", "integer", "bigint", "year")
+FLOAT_TYPES = ("float", "double", "decimal", "numeric")
+
 
 class MysqlHelpers:
 
-    def __init__(self):
+    def __init__(self, pool_min_size=1, pool_max_size=10, pool_timeout=5.0, metrics=None, config=None):
+        """
+        No connection is opened until the first query, or until connect() is called.
+
+        :param pool_min_size: Connections opened when the pool is created.
+        :param pool_max_size: Most connections in use at the same time.
+        :param pool_timeout: Seconds to wait for a free connection.
+        :param metrics: Metrics counting round trips and query latency. Records nothing by default.
+        :param config: Connection parameters overriding the environment, see startup.mysql_config().
+        """
         self.db_schema = None                                # Schema containing accessed data
-        self.cnx = None                                      # DB connection to use for accessing the data.
+        self.config = config
+        self._pool = None                                    # ConnectionPool for accessing the data.
+        self._pool_lock = threading.Lock()
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.pool_timeout = pool_timeout
         self.key_delimiter = '_'                             # This should probably be a config option.
+        self.write_listeners = []                            # Called with (table, rows) after each write.
+        self.sql_cache = {}                                  # Query shape -> generated SQL text.
+        self.column_types = {}                               # Table -> {column: MySQL data type}.
+        self.primary_keys = {}                               # Table -> [primary key columns].
+        self.metrics = metrics or NOOP_METRICS
         self.set_config()
 
 
     def get_new_connection(self, params=None):
+        import pymysql.cursors
+
         if not params:
             params = self.default_db_params
 
@@ -29,52 +172,242 @@ class MysqlHelpers:
             password=params["dbpw"],
             db=params["dbname"],
             charset=params["charset"],
-            cursorclass=params["cursorClass"])
+            cursorclass=params.get("cursorClass") or pymysql.cursors.DictCursor,
+            autocommit=params.get("autocommit", True))
         return cnx
 
     def set_config(self):
         """
-        Creates the DB connection and sets the global variables.
+        Sets the connection parameters and the schema from startup.mysql_config(). Connections run in
+        autocommit mode, so reads need no COMMIT and do not hold a snapshot open between queries.
+        Writes start an explicit transaction.
 
-        :param cfg: Application configuration data.
-        :return: None
+        :return: The connection parameters.
+        """
+        db_params = mysql_config(self.config)
+
+        self.db_schema = db_params["dbname"]
+        self.default_db_params = db_params
+        return db_params
+
+    @property
+    def pool(self):
+        """
+        The ConnectionPool, created by the first query that needs it.
+        """
+        pool = self._pool
+        if pool is None:
+            pool = self.connect()
+        return pool
+
+    def connect(self):
+        """
+        Creates the connection pool, opening pool_min_size connections, if it does not exist yet.
+
+        :return: The ConnectionPool.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ConnectionPool(lambda: self.get_new_connection(self.default_db_params),
+                                            min_size=self.pool_min_size,
+                                            max_size=self.pool_max_size,
+                                            timeout=self.pool_timeout)
+                logger.info("Mysql Connection Pool: %s", self._pool)
+            return self._pool
+
+
+    # Given one of our magic templates, forms a WHERE clause with %s placeholders and the list of
+    # arguments for them. Template values may be
+    #   a scalar:                  { a: b }                       --> a=%s
+    #   a list, tuple or set:      { a: [b, c] }                  --> a IN (%s,%s)
+    #   a dict of range operators: { a: {">=": b, "<": c} }       --> a>=%s AND a<%s
+    # Columns are emitted in sorted order, so templates with the same columns produce the same SQL.
+    def templateToWhereClause(self, t, table=None):
+        """
+        :param t: Template.
+        :param table: If given, arguments are converted to the type of their column.
+        :return: (where clause or "", list of arguments)
+        """
+        clauses = []
+        args = []
+
+        for k in sorted((t or {}).keys()):
+            v = t[k]
+            c = self.quote(k)
+
+            if isinstance(v, (list, tuple, set)):
+                values = self.pad_in_list(sorted(v, key=str))
+                if values:
+                    clauses.append(c + " IN (" + ",".join(["%s"] * len(values)) + ")")
+                    args.extend(self.coerce(table, k, x) for x in values)
+                else:
+                    clauses.append("FALSE")
+            elif isinstance(v, dict):
+                for op in sorted(v.keys()):
+                    if op not in RANGE_OPERATORS:
+                        raise ValueError("Invalid operator {} for column {}.".format(op, k))
+                    clauses.append(c + op + "%s")
+                    args.append(self.coerce(table, k, v[op]))
+            else:
+                clauses.append(c + "=%s")
+                args.append(self.coerce(table, k, v))
+
+        if clauses:
+            return "WHERE " + " AND ".join(clauses), args
+        else:
+            return "", args
+
+    def pad_in_list(self, values):
+        """
+        Pads an IN list to the next power of two by repeating its last value. The result is the same,
+        but the number of distinct statements stays logarithmic in the list length.
         """
+        n = 1
+        while n < len(values):
+            n *= 2
+        return list(values) + [values[-1]] * (n - len(values)) if values else []
 
+    def template_shape(self, t):
+        """
+        :return: A hashable description of the predicates in a template, ignoring the values.
+        """
+        shape = []
+        for k in sorted((t or {}).keys()):
+            v = t[k]
+            if isinstance(v, (list, tuple, set)):
+                shape.append((k, "in", len(self.pad_in_list(list(v)))))
+            elif isinstance(v, dict):
+                shape.append((k, "range", tuple(sorted(v.keys()))))
+            else:
+                shape.append((k, "="))
+        return tuple(shape)
 
+    def check_identifier(self, name):
+        if not isinstance(name, str) or not IDENTIFIER.match(name):
+            raise ValueError("Invalid table or column name {}.".format(name))
 
-        db_params = {
-            "dbhost": "localhost",
-            "port": 3306,
-            "dbname": "lahman2017",
-            "dbuser": "dbuser",
-            "dbpw": "dbuserdbuser",
-            "cursorClass": pymysql.cursors.DictCursor,
-            "charset": 'utf8mb4'
-        }
+    def quote(self, name):
+        """
+        :return: The checked identifier name, backtick-quoted for use in SQL text.
+        """
+        self.check_identifier(name)
+        return "`" + name + "`"
 
-        self.db_schema = "lahman2017"
+    def get_column_types(self, table):
+        """
+        :return: {column: MySQL data type} for the table, read once from information_schema. Empty if
+            the table is unknown or the lookup fails. A failed lookup is not cached, the next call tries
+            again. Needs a connection from the pool, so do not call it while holding one.
+        """
+        types = self.column_types.get(table)
+        if types is None:
+            q = "SELECT column_name AS c, data_type AS t FROM information_schema.columns " + \
+                "WHERE table_schema=%s AND table_name=%s"
+            try:
+                with self.pool.connection() as cnx:
+                    rows = self.run_q(cnx, q, [self.db_schema, table], fetch=True, commit=False)
+                types = {r["c"]: r["t"].lower() for r in rows}
+            except Exception as e:
+                logger.warning("Could not read the column types of %s: %s", table, e)
+                return {}
+            self.column_types[table] = types
+        return types
 
-        self.cnx = self.get_new_connection(db_params)
+    def get_primary_key(self, table):
+        """
+        :return: The primary key columns of the table in key order, read once from information_schema.
+            Empty if the table has none or the lookup fails. A failed lookup is not cached. Needs a
+            connection from the pool, so do not call it while holding one.
+        """
+        key = self.primary_keys.get(table)
+        if key is None:
+            q = "SELECT column_name AS c FROM information_schema.key_column_usage " + \
+                "WHERE table_schema=%s AND table_name=%s AND constraint_name='PRIMARY' ORDER BY ordinal_position"
+            try:
+                with self.pool.connection() as cnx:
+                    rows = self.run_q(cnx, q, [self.db_schema, table], fetch=True, commit=False)
+                key = [r["c"] for r in rows]
+            except Exception as e:
+                logger.warning("Could not read the primary key of %s: %s", table, e)
+                return []
+            self.primary_keys[table] = key
+        return key
 
-        print("Mysql Connection Object: ", self.cnx)
-        return self.cnx
+    def last_insert_id(self, cnx):
+        """
+        :return: The AUTO_INCREMENT value generated by the last insert on the connection.
+        """
+        return self.run_q(cnx, "SELECT LAST_INSERT_ID() AS id", None, fetch=True, commit=False)[0]["id"]
 
+    def coerce(self, table, column, v):
+        """
+        Converts a template value to the type of its column, so that e.g. yearID='2013' is compared as
+        a number and can use the index.
+        """
+        if table is None or v is None:
+            return v
 
-    # Given one of our magic templates, forms a WHERE clause.
-    # { a: b, c: d } --> WHERE a=b and c=d. Currently treats everything as a string.
-    # We can fix this by using PyMySQL connector query templates.
-    def templateToWhereClause(self, t):
-        s = ""
-        for k,v in t.items():
-            if s != "":
-                s += " AND "
-            s += k + "=\'" + v + "\'"
+        t = self.get_column_types(table).get(column)
+        try:
+            if t in INT_TYPES and isinstance(v, str):
+                return int(v)
+            if t in FLOAT_TYPES and isinstance(v, str):
+                return float(v)
+        except ValueError:
+            return v
+        if t is not None and t not in INT_TYPES and t not in FLOAT_TYPES and isinstance(v, (int, float)):
+            return str(v)
+        return v
 
-        if s != "":
-            s = "WHERE " + s + ";"
+    def build_select(self, table, t, fields=None, limit=None, offset=None, orderBy=None):
+        """
+        Generates the SELECT for find_by_template. The SQL text only depends on the shape of the query
+        (table, template columns and predicate kinds, fields, order and whether there is a limit and
+        offset), and is cached on that shape.
 
-        return s
+        :return: (SQL text, list of arguments)
+        """
+        if fields:
+            fields = tuple(fields)
+        if orderBy:
+            o_fields = orderBy['fields']
+            if isinstance(o_fields, str):
+                o_fields = [o_fields]
+            order = (tuple(o_fields), (orderBy.get('direction') or "ASC").upper())
+        else:
+            order = None
+
+        shape = (table, self.template_shape(t), fields, order, limit is not None, offset is not None)
+        q = self.sql_cache.get(shape)
+
+        if q is None:
+            if order and order[1] not in ("ASC", "DESC"):
+                raise ValueError("Invalid order direction {}.".format(order[1]))
+
+            w, args = self.templateToWhereClause(t, table)
+
+            q = "SELECT " + (",".join(self.quote(f) for f in fields) if fields else "*") + \
+                " FROM " + self.quote(table)
+            if w:
+                q += " " + w
+            if order:
+                q += " ORDER BY " + ",".join(self.quote(f) for f in order[0]) + " " + order[1]
+            if limit is not None:
+                q += " LIMIT %s"
+            if offset is not None:
+                # MySQL has no OFFSET without LIMIT, use the largest possible limit.
+                q += " OFFSET %s" if limit is not None else " LIMIT 18446744073709551615 OFFSET %s"
+
+            self.sql_cache[shape] = q
+        else:
+            w, args = self.templateToWhereClause(t, table)
 
+        if limit is not None:
+            args.append(int(limit))
+        if offset is not None:
+            args.append(int(offset))
+
+        return q, args
 
     def run_q(self, cnx, q, args, fetch=False, commit=True):
         """
@@ -91,12 +424,15 @@ class MysqlHelpers:
         result = None
 
         try:
-            cursor = cnx.cursor()
-            result = cursor.execute(q, args)
-            if fetch:
-                result = cursor.fetchall()
-            if commit:
-                cnx.commit()
+            with self.metrics.timer("mysql_query_seconds"):
+                cursor = cnx.cursor()
+                result = cursor.execute(q, args)
+                if fetch:
+                    result = cursor.fetchall()
+                self.metrics.incr("mysql_round_trips_total")
+                if commit:
+                    cnx.commit()
+                    self.metrics.incr("mysql_round_trips_total")
         except Exception as original_e:
             #print("dffutils.run_q got exception = ", original_e)
             raise(original_e)
@@ -105,29 +441,147 @@ class MysqlHelpers:
 
     def find_by_template(self, table, t, fields=None, limit=None, offset=None, orderBy=None):
 
-        if t is not None:
-            w = self.templateToWhereClause(t)
-        else:
-            w = ""
+        q, args = self.build_select(table, t, fields, limit, offset, orderBy)
 
-        if orderBy is not None:
-            o = "order by " + ",".join(orderBy['fields']) + " " + orderBy['direction'] + " "
-        else:
-            o = ""
+        with self.pool.connection() as cnx:
+            r = self.run_q(cnx, q, args, fetch=True, commit=False)
 
-        if limit is not None:
-            w += " LIMIT " + str(limit)
-        if offset is not None:
-            w += " OFFSET " + str(offset)
+        return r
 
-        if fields is None:
-            fields = " * "
-        else:
-            fields = " " + ",".join(fields) + " "
+    def iter_by_template(self, table, t, fields=None, limit=None, offset=None, orderBy=None, batch_size=None):
+        """
+        Like find_by_template, but streams the result from an unbuffered server side cursor
+        (SSDictCursor) instead of fetching it all, so memory use does not grow with the result size.
+        The connection is held until the generator is exhausted or closed. A generator closed early
+        discards its connection rather than reading the rest of the result.
+
+        :param batch_size: If None, yields one row at a time. Otherwise yields lists of up to
+            batch_size rows.
+        :return: A generator.
+        """
+        q, args = self.build_select(table, t, fields, limit, offset, orderBy)
+        fetch_size = batch_size or 1000
+
+        import pymysql.cursors
+
+        cnx = self.pool.acquire()
+        finished = False
+        try:
+            cursor = cnx.cursor(pymysql.cursors.SSDictCursor)
+            cursor.execute(q, args)
+            self.metrics.incr("mysql_round_trips_total")
+
+            while True:
+                # Rows arrive as the unbuffered cursor reads them, count each fetch as a round trip.
+                self.metrics.incr("mysql_round_trips_total")
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                if batch_size:
+                    yield rows
+                else:
+                    for r in rows:
+                        yield r
+
+            cursor.close()
+            finished = True
+        finally:
+            self.pool.release(cnx, discard=not finished)
+
+    def add_write_listener(self, listener):
+        """
+        Registers a function that is called after every committed insert, update or delete.
+
+        :param listener: Called as listener(table, rows). rows holds the images of every row the write
+            touched, before and after the change, as dictionaries.
+        :return: None
+        """
+        self.write_listeners.append(listener)
+
+    def notify_write(self, table, rows):
+        for listener in self.write_listeners:
+            listener(table, rows)
 
-        #cursor = self.cnx.cursor()
-        q = "SELECT " + fields + " FROM " + table + " " + w + ";"
+    def insert(self, table, new_row):
+        """
+        Inserts a row. The row is read back by its primary key on the same connection, so the listeners
+        see the column defaults and the generated AUTO_INCREMENT value too. Without a primary key they
+        get new_row.
+
+        :param table: Table name.
+        :param new_row: {column: value} for the new row.
+        :return: Number of rows inserted.
+        """
+        cols = list(new_row.keys())
+        q = "INSERT INTO " + self.quote(table) + " (" + ",".join(self.quote(c) for c in cols) + ") VALUES (" + \
+            ",".join(["%s"] * len(cols)) + ")"
+        args = [self.coerce(table, c, new_row[c]) for c in cols]
+        key = self.get_primary_key(table)
+
+        with self.pool.connection() as cnx:
+            r = self.run_q(cnx, q, args, fetch=False, commit=False)
+            if len(key) == 1 and key[0] not in new_row:
+                t = {key[0]: self.last_insert_id(cnx)}
+            elif key and all(c in new_row for c in key):
+                t = {c: new_row[c] for c in key}
+            else:
+                t = None
+            rows = None
+            if t is not None:
+                sq, sq_args = self.build_select(table, t, None, None, None, None)
+                rows = self.run_q(cnx, sq, sq_args, fetch=True, commit=False)
+
+        self.notify_write(table, list(rows) if rows else [new_row])
+        return r
+
+    def update_by_template(self, table, t, new_values):
+        """
+        Updates the rows matching the template. The matching rows are read and locked first, in the
+        same transaction, so the listeners see both the old and the new row images.
+
+        :param table: Table name.
+        :param t: Template selecting the rows to update.
+        :param new_values: {column: value} to set.
+        :return: Number of rows updated.
+        """
+        if not t:
+            raise ValueError("An empty template would update every row of {}.".format(table))
+        w, w_args = self.templateToWhereClause(t, table)
+        cols = list(new_values.keys())
+        q = "UPDATE " + self.quote(table) + " SET " + ",".join([self.quote(c) + "=%s" for c in cols]) + " " + w
+        set_args = [self.coerce(table, c, new_values[c]) for c in cols]
+
+        with self.pool.connection() as cnx:
+            cnx.begin()
+            self.metrics.incr("mysql_round_trips_total")
+            old_rows = self.run_q(cnx, "SELECT * FROM " + self.quote(table) + " " + w + " FOR UPDATE", w_args,
+                                  fetch=True, commit=False)
+            r = self.run_q(cnx, q, set_args + w_args, fetch=False, commit=False)
+            cnx.commit()
+            self.metrics.incr("mysql_round_trips_total")
+
+        new_rows = [{**o, **new_values} for o in old_rows]
+        self.notify_write(table, list(old_rows) + new_rows)
+        return r
+
+    def delete_by_template(self, table, t):
+        """
+        :param table: Table name.
+        :param t: Template selecting the rows to delete.
+        :return: Number of rows deleted.
+        """
+        if not t:
+            raise ValueError("An empty template would delete every row of {}.".format(table))
+        w, w_args = self.templateToWhereClause(t, table)
 
-        r = self.run_q(self.cnx, q, None, fetch=True, commit=True)
+        with self.pool.connection() as cnx:
+            cnx.begin()
+            self.metrics.incr("mysql_round_trips_total")
+            old_rows = self.run_q(cnx, "SELECT * FROM " + self.quote(table) + " " + w + " FOR UPDATE", w_args,
+                                  fetch=True, commit=False)
+            r = self.run_q(cnx, "DELETE FROM " + self.quote(table) + " " + w, w_args, fetch=False, commit=False)
+            cnx.commit()
+            self.metrics.incr("mysql_round_trips_total")
 
-        return r
\ No newline at end of file
+        self.notify_write(table, list(old_rows))
+        return r
@@ -0,0 +1,144 @@
+"""
+Connection settings and warm up for MysqlHelpers, RedisFunctions, GraphCache and FanGraph.
+
+The clients import their drivers (pymysql, redis, py2neo) and connect on first use, so creating one is
+cheap and a process only pays for the backends it touches. Settings come from, in increasing priority,
+the defaults below, environment variables and a config dictionary passed to the client:
+
+  MySQL   MYSQL_HOST, MYSQL_PORT, MYSQL_DATABASE, MYSQL_USER, MYSQL_PASSWORD
+  Redis   REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
+  Neo4j   NEO4J_HOST, NEO4J_PORT, NEO4J_USER, NEO4J_PASSWORD, NEO4J_SECURE, NEO4J_READ_HOST, NEO4J_READ_PORT
+
+Servers that want connections open before the first request call warm_up(), which connects the given
+clients in parallel:
+
+    rf, fg = RedisFunctions(), FanGraph()
+    warm_up(rf, fg)
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MYSQL_DEFAULTS = {
+    "dbhost": "localhost",
+    "port": 3306,
+    "dbname": "lahman2017",
+    "dbuser": "dbuser",
+    "dbpw": "dbuserdbuser",
+    "charset": "utf8mb4",
+    "autocommit": True
+}
+
+REDIS_DEFAULTS = {
+    "host": "localhost",
+    "port": 6379,
+    "db": 0,
+    "password": None
+}
+
+NEO4J_DEFAULTS = {
+    "host": "localhost",
+    "port": 7687,
+    "user": "neo4j",
+    "password": "sh3907",
+    "secure": False,
+    "read_host": None,
+    "read_port": None
+}
+
+# Setting -> (environment variable, type).
+MYSQL_ENV = {"dbhost": ("MYSQL_HOST", str), "port": ("MYSQL_PORT", int), "dbname": ("MYSQL_DATABASE", str),
+             "dbuser": ("MYSQL_USER", str), "dbpw": ("MYSQL_PASSWORD", str)}
+REDIS_ENV = {"host": ("REDIS_HOST", str), "port": ("REDIS_PORT", int), "db": ("REDIS_DB", int),
+             "password": ("REDIS_PASSWORD", str)}
+NEO4J_ENV = {"host": ("NEO4J_HOST", str), "port": ("NEO4J_PORT", int), "user": ("NEO4J_USER", str),
+             "password": ("NEO4J_PASSWORD", str), "secure": ("NEO4J_SECURE", "bool"),
+             "read_host": ("NEO4J_READ_HOST", str), "read_port": ("NEO4J_READ_PORT", int)}
+
+
+def resolve(defaults, env, config=None, environ=None):
+    """
+    :param config: Dictionary of settings overriding the environment. Keys set to None are ignored.
+    :param environ: Mapping read instead of os.environ.
+    :return: The settings dictionary.
+    """
+    environ = os.environ if environ is None else environ
+    result = dict(defaults)
+
+    for k, (var, kind) in env.items():
+        v = environ.get(var)
+        if v is None or v == "":
+            continue
+        if kind == "bool":
+            result[k] = v.lower() in ("1", "true", "yes", "on")
+        else:
+            try:
+                result[k] = kind(v)
+            except ValueError:
+                raise ValueError("Invalid value {!r} for {}.".format(v, var))
+
+    for k, v in (config or {}).items():
+        if v is not None:
+            result[k] = v
+    return result
+
+
+def mysql_config(config=None, environ=None):
+    """
+    :return: The MysqlHelpers connection parameters: dbhost, port, dbname, dbuser, dbpw, charset and
+        autocommit.
+    """
+    return resolve(MYSQL_DEFAULTS, MYSQL_ENV, config, environ)
+
+
+def redis_config(config=None, environ=None):
+    """
+    :return: Keyword arguments for redis.StrictRedis: host, port, db and password.
+    """
+    return resolve(REDIS_DEFAULTS, REDIS_ENV, config, environ)
+
+
+def neo4j_config(config=None, environ=None):
+    """
+    :return: The FanGraph connection settings: host, port, user, password, secure, read_host and read_port.
+    """
+    return resolve(NEO4J_DEFAULTS, NEO4J_ENV, config, environ)
+
+
+def warm_up(*clients):
+    """
+    Calls connect() on every client in parallel, e.g. to open the MySQL pool, the Redis connection
+    and the Neo4j driver at startup instead of on the first request.
+
+    :param clients: Objects with a connect() method: MysqlHelpers, RedisFunctions or FanGraph.
+    :return: {"<class name>[<position>]": seconds its connect() took}. The first error is raised after
+        every client finished.
+    """
+    def connect(c):
+        start = time.perf_counter()
+        c.connect()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    timings = {}
+    error = None
+    with ThreadPoolExecutor(max(1, len(clients))) as executor:
+        futures = [executor.submit(connect, c) for c in clients]
+        for i, (c, f) in enumerate(zip(clients, futures)):
+            name = "{}[{}]".format(type(c).__name__, i)
+            try:
+                timings[name] = f.result()
+            except Exception as e:
+                logger.error("warm_up: %s failed to connect: %s", name, e)
+                error = error or e
+
+    if error is not None:
+        raise error
+
+    logger.info("Warmed up %d clients in %.3f seconds: %s", len(clients), time.perf_counter() - start,
+                ", ".join("{} {:.3f}s".format(k, v) for k, v in timings.items()))
+    return timings
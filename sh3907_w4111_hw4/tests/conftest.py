@@ -0,0 +1,88 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from benchmark import SqliteHelpers, seed_lahman  # noqa: E402
+from redis_func import RedisFunctions  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def lahman_path(tmp_path_factory):
+    """
+    A SQLite lahman2017 subset, see benchmark.seed_lahman. Tests must not write to it.
+    """
+    path = str(tmp_path_factory.mktemp("lahman") / "lahman.db")
+    seed_lahman(path, n_players=200, n_teams=6)
+    return path
+
+
+@pytest.fixture
+def db(lahman_path):
+    return SqliteHelpers(lahman_path)
+
+
+@pytest.fixture
+def writable_db(tmp_path):
+    """
+    A SqliteHelpers over a lahman2017 subset of its own, for tests that write.
+    """
+    path = str(tmp_path / "lahman.db")
+    seed_lahman(path, n_players=20, n_teams=2)
+    return SqliteHelpers(path)
+
+
+@pytest.fixture
+def make_rf(db):
+    """
+    :return: Function creating RedisFunctions over db, all sharing one fakeredis server.
+    """
+    server = fakeredis.FakeServer()
+
+    def connect(*args, decode_responses=False, **kwargs):
+        return fakeredis.FakeStrictRedis(server=server, decode_responses=decode_responses)
+
+    def make(**kwargs):
+        kwargs.setdefault("db", db)
+        with mock.patch("redis.StrictRedis", connect):
+            rf = RedisFunctions(**kwargs)
+            rf.connect_redis()
+        return rf
+
+    return make
+
+
+@pytest.fixture
+def rf(make_rf):
+    return make_rf()
+
+
+class CountingDb:
+    """
+    Wraps find_by_template of a MysqlHelpers, recording the templates queried.
+    """
+
+    def __init__(self, db, delay=0.0):
+        self.db = db
+        self.delay = delay
+        self.queries = []
+        self.find = db.find_by_template
+        db.find_by_template = self.find_by_template
+
+    def find_by_template(self, table, t, *args, **kwargs):
+        import time
+
+        self.queries.append((table, t))
+        if self.delay:
+            time.sleep(self.delay)
+        return self.find(table, t, *args, **kwargs)
+
+
+@pytest.fixture
+def counting_db(db):
+    return CountingDb(db)
@@ -0,0 +1,69 @@
+import asyncio
+
+import fakeredis
+
+from async_api import AsyncRedisFunctions
+from conftest import CountingDb
+from instrumentation import InMemoryMetrics
+from l1_cache import L1Cache
+
+
+def make_arf(make_rf, **kwargs):
+    rf = make_rf(metrics=InMemoryMetrics(), **kwargs)
+    server = rf.r.connection_pool.connection_kwargs["server"]
+    return AsyncRedisFunctions(rf, max_workers=4, async_redis=fakeredis.FakeAsyncRedis(server=server))
+
+
+def run(arf, f):
+    """
+    :return: The result of awaiting f(), after closing arf, which waits for the work handed to its threads.
+    """
+    async def main():
+        try:
+            return await f()
+        finally:
+            await arf.close()
+
+    return asyncio.run(main())
+
+
+def test_miss_is_counted_and_filled_once(make_rf, db):
+    counting = CountingDb(db)
+    arf = make_arf(make_rf)
+    template = {"playerID": "player00001"}
+
+    async def read():
+        return [await arf.retrieve_by_template("People", template, use_cache=True) for _ in range(2)]
+
+    first, second = run(arf, read)
+
+    assert first == second and [r["playerID"] for r in first] == ["player00001"]
+    assert len(counting.queries) == 1
+    assert arf.rf.metrics.value("cache_misses_total", table="People") == 1
+    assert arf.rf.metrics.value("cache_hits_total", table="People") == 1
+
+
+def test_l1_is_read_before_redis(make_rf):
+    arf = make_arf(make_rf, l1=L1Cache(), l1_channel=None)
+    template = {"playerID": "player00002"}
+    key = arf.rf.generate_key("People", template, None, None, None, None)
+    arf.rf.l1.put(key, [{"playerID": "from l1"}], arf.rf.l1.generation)
+
+    rows = run(arf, lambda: arf.check_cache("People", template))
+
+    assert rows == [{"playerID": "from l1"}]
+    assert arf.rf.metrics.value("cache_hits_total", table="People") == 0
+
+
+def test_legacy_key_is_migrated(make_rf):
+    arf = make_arf(make_rf, key_compat=True)
+    rf = arf.rf
+    args = ("Batting", {"yearID": 2000, "teamID": "T01"}, ["teamID", "playerID"], None, None, None)
+    legacy_key = rf.generate_legacy_key(*args)
+    assert legacy_key != rf.generate_key(*args)
+    rf.rb.set(legacy_key, rf.codec.encode([{"playerID": "legacy"}]))
+
+    rows = run(arf, lambda: arf.check_cache(*args))
+
+    assert rows == [{"playerID": "legacy"}]
+    assert rf.retrieve_from_cache(rf.generate_key(*args)) == rows
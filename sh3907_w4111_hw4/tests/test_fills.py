@@ -0,0 +1,74 @@
+import threading
+
+from conftest import CountingDb
+
+
+def test_single_flight_shares_one_query(rf, db):
+    counting = CountingDb(db, delay=0.2)
+    results = []
+
+    def read():
+        results.append(rf.retrieve_by_template("People", {"playerID": "player00001"}, use_cache=True))
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(counting.queries) == 1
+    assert len(results) == 8
+    assert all(r == results[0] and len(r) == 1 for r in results)
+
+
+def test_waiter_reads_the_value_filled_by_the_lock_holder(make_rf, db):
+    counting = CountingDb(db)
+    holder = make_rf()
+    waiter = make_rf(lock_wait=5.0, lock_poll_interval=0.01)
+    template = {"playerID": "player00002"}
+    key = holder.generate_key("People", template, None, None, None, None)
+    token = holder.acquire_lock("cache:lock:" + key)
+
+    def fill():
+        holder.add_to_cache("People", template, None, None, None, None, [{"playerID": "filled"}])
+        holder.release_lock("cache:lock:" + key, token)
+
+    timer = threading.Timer(0.1, fill)
+    timer.start()
+    result = waiter.retrieve_by_template("People", template, use_cache=True)
+    timer.join()
+
+    assert result == [{"playerID": "filled"}]
+    assert counting.queries == []
+
+
+def test_waiter_queries_the_database_when_the_lock_holder_stalls(make_rf, db):
+    counting = CountingDb(db)
+    rf = make_rf(lock_wait=0.1, lock_poll_interval=0.02)
+    template = {"playerID": "player00003"}
+    key = rf.generate_key("People", template, None, None, None, None)
+    assert rf.acquire_lock("cache:lock:" + key)
+
+    result = rf.retrieve_by_template("People", template, use_cache=True)
+
+    assert [r["playerID"] for r in result] == ["player00003"]
+    assert counting.queries == [("People", template)]
+    # The stalled holder still owns the fill.
+    assert not rf.r.exists(key)
+
+
+def test_released_lock_is_taken_over(make_rf, db):
+    counting = CountingDb(db)
+    rf = make_rf(lock_wait=5.0, lock_poll_interval=0.01)
+    template = {"playerID": "player00004"}
+    key = rf.generate_key("People", template, None, None, None, None)
+    token = rf.acquire_lock("cache:lock:" + key)
+    timer = threading.Timer(0.1, rf.release_lock, ["cache:lock:" + key, token])
+
+    timer.start()
+    result = rf.retrieve_by_template("People", template, use_cache=True)
+    timer.join()
+
+    assert [r["playerID"] for r in result] == ["player00004"]
+    assert len(counting.queries) == 1
+    assert rf.r.exists(key)
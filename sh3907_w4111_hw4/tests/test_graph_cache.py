@@ -0,0 +1,44 @@
+import fakeredis
+
+from graph_cache import GraphCache
+
+
+def make_cache():
+    return GraphCache(fakeredis.FakeStrictRedis(decode_responses=True))
+
+
+def test_fetch_caches_the_loaded_result():
+    cache = make_cache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [{"team_id": "T01"}]
+
+    assert cache.fetch("get_team", ["T01"], load) == [{"team_id": "T01"}]
+    assert cache.fetch("get_team", ["T01"], load) == [{"team_id": "T01"}]
+    assert len(loads) == 1
+
+
+def test_result_invalidated_during_the_load_is_not_cached():
+    cache = make_cache()
+
+    def load():
+        cache.invalidate([("get_team", ["T01"])])
+        return "stale"
+
+    assert cache.fetch("get_team", ["T01"], load) == "stale"
+    assert not cache.r.exists(cache.key("get_team", ["T01"]))
+
+
+def test_dependency_invalidated_during_the_load_is_not_cached():
+    cache = make_cache()
+
+    def load():
+        cache.invalidate_dependents(["player:p1"])
+        return ["p1"]
+
+    cache.fetch("get_roster", ["T01", 2017], load, lambda result: ["player:" + p for p in result])
+
+    assert not cache.r.exists(cache.key("get_roster", ["T01", 2017]))
+    assert not cache.r.exists(cache.dependents_key("player:p1"))
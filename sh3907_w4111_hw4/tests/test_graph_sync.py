@@ -0,0 +1,281 @@
+import contextlib
+import copy
+import sqlite3
+
+import pytest
+
+import graph_sync as gs
+from benchmark import SqliteHelpers, seed_lahman
+from fan_graph import FanGraph
+
+
+class Result(list):
+
+    def evaluate(self):
+        return self[0] if self else None
+
+
+class StubTransaction:
+    """
+    Runs the graph_sync and FanGraph bulk statements against the dictionaries of a StubGraph.
+    """
+
+    def __init__(self, graph):
+        self.g = graph
+
+    def run(self, q, args=None):
+        g, a = self.g, args or {}
+
+        def player(k):
+            return dict(g.players[k], player_id=k)
+
+        def appearance(k):
+            return {"player_id": k[0], "team_id": k[1], "year": k[2], "games": g.appearances[k]}
+
+        if q == gs.READ_CHECKPOINT_Q:
+            return Result([dict(g.checkpoint)] if g.checkpoint else [])
+        if q == gs.PLAYERS_BY_KEYS_Q:
+            return Result(player(k) for k in a["keys"] if k in g.players)
+        if q == gs.PLAYERS_RANGE_Q:
+            return Result(player(k) for k in g.players
+                          if (a["after"] is None or k > a["after"]) and (a["last"] is None or k <= a["last"]))
+        if q in (gs.TEAMS_BY_KEYS_Q, gs.TEAMS_ALL_Q):
+            return Result({"team_id": k, "team_name": g.teams[k]} for k in a.get("keys", list(g.teams))
+                          if k in g.teams)
+        if q == gs.APPEARANCES_BY_KEYS_Q:
+            keys = [(k["player_id"], k["team_id"], k["year"]) for k in a["keys"]]
+            return Result(appearance(k) for k in keys if k in g.appearances)
+        if q in (gs.APPEARANCES_RANGE_Q, gs.APPEARANCES_SCAN_Q):
+            return Result(appearance(k) for k in g.appearances if a["after"] < k[2] <= a["last"])
+
+        g.writes.append(q)
+        rows = a.get("rows", [])
+        if q == gs.CHECKPOINT_Q:
+            g.checkpoint.update({k: v for k, v in a["state"].items() if v is not None})
+            for k in [k for k, v in a["state"].items() if v is None]:
+                g.checkpoint.pop(k, None)
+        elif q == FanGraph.BULK_PLAYERS_Q:
+            for r in rows:
+                g.players[r["player_id"]] = {"last_name": r["last_name"], "first_name": r["first_name"]}
+        elif q == FanGraph.BULK_TEAMS_Q:
+            for r in rows:
+                g.teams[r["team_id"]] = r["team_name"]
+        elif q in (FanGraph.BULK_ROSTERS_Q, FanGraph.BULK_APPEARANCES_Q):
+            for r in rows:
+                if r["player_id"] in g.players and r["team_id"] in g.teams:
+                    g.appearances[(r["player_id"], r["team_id"], r["year"])] = r["games"]
+        elif q == gs.DELETE_APPEARANCES_Q:
+            for r in rows:
+                g.appearances.pop((r["player_id"], r["team_id"], r["year"]), None)
+        elif q in (gs.DELETE_PLAYER_LINKS_Q, gs.DELETE_TEAM_LINKS_Q):
+            i, column = (0, "player_id") if q == gs.DELETE_PLAYER_LINKS_Q else (1, "team_id")
+            for r in rows:
+                for k in [k for k in g.appearances if k[i] == r[column]]:
+                    del g.appearances[k]
+        elif q == gs.DELETE_PLAYERS_Q:
+            for r in rows:
+                g.players.pop(r["player_id"], None)
+        elif q == gs.DELETE_TEAMS_Q:
+            for r in rows:
+                g.teams.pop(r["team_id"], None)
+        else:
+            raise AssertionError("Unexpected statement " + q)
+        return Result()
+
+
+class StubGraph:
+    """
+    Stands in for FanGraph. Transactions are atomic, and fail_after makes every transaction after
+    that many fail, like a crash.
+    """
+
+    BULK_PLAYERS_Q = FanGraph.BULK_PLAYERS_Q
+    BULK_TEAMS_Q = FanGraph.BULK_TEAMS_Q
+    BULK_ROSTERS_Q = FanGraph.BULK_ROSTERS_Q
+    BULK_APPEARANCES_Q = FanGraph.BULK_APPEARANCES_Q
+    materialize_rosters = True
+    cache = None
+
+    def __init__(self):
+        self.players, self.teams, self.appearances, self.checkpoint = {}, {}, {}, {}
+        self.writes = []
+        self.transactions = 0
+        self.fail_after = None
+
+    def run_in_transaction(self, work, readonly=False, retries=None):
+        self.transactions += 1
+        if self.fail_after is not None and self.transactions > self.fail_after:
+            raise RuntimeError("crash")
+        state = copy.deepcopy((self.players, self.teams, self.appearances, self.checkpoint))
+        try:
+            return work(StubTransaction(self))
+        except Exception:
+            self.players, self.teams, self.appearances, self.checkpoint = state
+            raise
+
+    def invalidate_cached(self, calls):
+        pass
+
+
+@pytest.fixture
+def lahman(tmp_path):
+    """
+    A writable lahman2017 subset: (path, SqliteHelpers).
+    """
+    path = str(tmp_path / "lahman.db")
+    seed_lahman(path, n_players=120, n_teams=4, first_year=2010)
+    return path, SqliteHelpers(path)
+
+
+@pytest.fixture
+def sync(lahman):
+    s = gs.GraphSync(StubGraph(), lahman[1], batch_size=50)
+    s.max_change_id = lambda: 0
+    return s
+
+
+def graph_state(fg):
+    return fg.players, fg.teams, fg.appearances
+
+
+def test_diff():
+    source = {1: {"v": 1}, 2: {"v": 2}, 3: {"v": 3}}
+    target = {2: {"v": 2}, 3: {"v": 30}, 4: {"v": 4}}
+
+    assert gs.diff(source, target) == ([{"v": 1}], [{"v": 3}], [{"v": 4}], 1)
+
+
+def test_reconcile_loads_an_empty_graph(sync, lahman):
+    stats = sync.reconcile()
+
+    cnx = sqlite3.connect(lahman[0])
+    assert len(sync.fg.players) == cnx.execute("SELECT COUNT(*) FROM People").fetchone()[0]
+    assert len(sync.fg.teams) == cnx.execute("SELECT COUNT(DISTINCT teamID) FROM Teams").fetchone()[0]
+    assert len(sync.fg.appearances) == cnx.execute("SELECT COUNT(*) FROM Appearances").fetchone()[0]
+    assert stats["inserted"] == len(sync.fg.players) + len(sync.fg.teams) + len(sync.fg.appearances)
+    assert sync.fg.checkpoint == {"change_id": 0}
+
+
+def test_interrupted_reconcile_resumes(sync, lahman):
+    expected = gs.GraphSync(StubGraph(), lahman[1], batch_size=50)
+    expected.max_change_id = lambda: 0
+    expected.reconcile()
+
+    sync.fg.fail_after = 4
+    with pytest.raises(RuntimeError):
+        sync.reconcile()
+    assert sync.fg.checkpoint["reconcile_table"] == "People"
+    assert sync.fg.checkpoint["reconcile_after"] == max(sync.fg.players)
+    loaded = len(sync.fg.players)
+
+    sync.fg.fail_after = None
+    stats = sync.reconcile()
+
+    assert graph_state(sync.fg) == graph_state(expected.fg)
+    assert stats["inserted"] == len(expected.fg.players) + len(expected.fg.teams) + \
+        len(expected.fg.appearances) - loaded
+    assert sync.fg.checkpoint == {"change_id": 0}
+
+
+def test_reconcile_again_writes_nothing_but_checkpoints(sync):
+    sync.reconcile()
+    sync.fg.writes = []
+
+    stats = sync.reconcile()
+
+    assert stats["inserted"] == stats["updated"] == stats["deleted"] == 0
+    assert set(sync.fg.writes) == {gs.CHECKPOINT_Q}
+
+
+def test_reconcile_repairs_drift(sync, lahman):
+    sync.reconcile()
+    cnx = sqlite3.connect(lahman[0])
+    cnx.execute("UPDATE People SET nameLast='Changed' WHERE playerID='player00005'")
+    cnx.execute("DELETE FROM Appearances WHERE playerID='player00007'")
+    cnx.commit()
+    sync.fg.players["stray"] = {"last_name": "x", "first_name": "y"}
+
+    stats = sync.reconcile()
+
+    assert sync.fg.players["player00005"]["last_name"] == "Changed"
+    assert "stray" not in sync.fg.players
+    assert not [k for k in sync.fg.appearances if k[0] == "player00007"]
+    assert stats["updated"] == 1
+    assert stats["deleted"] == 1 + cnx.execute("SELECT COUNT(*) FROM Batting WHERE playerID='player00007'").fetchone()[0]
+
+
+def test_apply_batch_commits_changes_and_checkpoint_together(sync):
+    source = {"People": {"p1": {"player_id": "p1", "last_name": "A", "first_name": "B"}}}
+
+    def read_graph(tx):
+        return {"People": {r["player_id"]: dict(r) for r in tx.run(gs.PLAYERS_BY_KEYS_Q, {"keys": ["p1"]})}}
+
+    sync.fg.fail_after = sync.fg.transactions
+    with pytest.raises(RuntimeError):
+        sync.apply_batch(source, read_graph, {"change_id": 7})
+    assert sync.fg.players == {} and sync.fg.checkpoint == {}
+
+    sync.fg.fail_after = None
+    assert sync.apply_batch(source, read_graph, {"change_id": 7})["inserted"] == 1
+    assert sync.apply_batch(source, read_graph, {"change_id": 7})["unchanged"] == 1
+    assert sync.fg.checkpoint == {"change_id": 7}
+
+
+def test_sync_changes_applies_changes_after_the_watermark(sync, lahman):
+    sync.reconcile()
+    cnx = sqlite3.connect(lahman[0])
+    cnx.execute("UPDATE People SET nameFirst='Q' WHERE playerID='player00010'")
+    year, team = cnx.execute("SELECT yearID, teamID FROM Appearances WHERE playerID='player00011'").fetchone()
+    cnx.execute("DELETE FROM Appearances WHERE playerID='player00011' AND yearID=? AND teamID=?", (year, team))
+    cnx.commit()
+    changes = [{"change_id": 5, "table_name": "People", "key1": "player00010", "key2": None, "key3": None},
+               {"change_id": 6, "table_name": "Appearances", "key1": "player00011", "key2": team, "key3": year}]
+    sync.read_changes = lambda after: [c for c in changes if c["change_id"] > after][:1]
+
+    stats = sync.sync_changes()
+
+    assert (stats["batches"], stats["updated"], stats["deleted"], stats["change_id"]) == (2, 1, 1, 6)
+    assert sync.fg.players["player00010"]["first_name"] == "Q"
+    assert ("player00011", team, year) not in sync.fg.appearances
+    assert sync.fg.checkpoint == {"change_id": 6}
+    assert sync.sync_changes()["batches"] == 0
+
+
+def test_run_prunes_applied_changes(sync):
+    pruned = []
+    sync.read_changes = lambda after: []
+    sync.prune_changes = lambda: pruned.append(sync.checkpoint()["change_id"]) or 3
+
+    assert sync.run()["pruned"] == 3
+    assert pruned == [0]
+
+
+class ChangeDb:
+    """
+    Stands in for the MysqlHelpers of read_changes: the cutoff query returns cutoff and the change
+    table is changes.
+    """
+
+    def __init__(self, changes, cutoff):
+        self.changes, self.cutoff = changes, cutoff
+        self.pool = self
+
+    def connection(self):
+        return contextlib.nullcontext()
+
+    def run_q(self, cnx, q, args, fetch=False, commit=True):
+        return [{"c": self.cutoff}]
+
+    def find_by_template(self, table, t, fields=None, limit=None, offset=None, orderBy=None):
+        return [dict(c) for c in sorted(self.changes, key=lambda c: c["change_id"])
+                if c["change_id"] > t["change_id"][">"]][:limit]
+
+
+def test_read_changes_stops_at_the_first_unsettled_change():
+    # change 2 started after change 3 and is not settled yet.
+    changes = [{"change_id": i, "table_name": "People", "key1": "p", "key2": None, "key3": None, "changed_at": at}
+               for i, at in ((1, 10), (2, 25), (3, 15), (4, 12))]
+    sync = gs.GraphSync(StubGraph(), ChangeDb(changes, cutoff=20), batch_size=50)
+
+    assert [c["change_id"] for c in sync.read_changes(0)] == [1]
+    assert [c["change_id"] for c in sync.read_changes(2)] == [3, 4]
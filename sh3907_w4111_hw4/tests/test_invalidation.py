@@ -0,0 +1,138 @@
+import time
+
+import pytest
+
+from cache_policy import CachePolicy
+
+
+def cache(rf, table, template, rows=None):
+    rf.add_to_cache(table, template, None, None, None, None, rows or [{"x": 1}])
+    return rf.generate_key(table, template, None, None, None, None)
+
+
+def indexed(rf, table):
+    return set(rf.r.zrange(rf.tag_key(table), 0, -1))
+
+
+def test_invalidate_deletes_only_matching_templates(rf):
+    year = cache(rf, "Batting", {"yearID": 2000})
+    other_year = cache(rf, "Batting", {"yearID": 2001})
+    player = cache(rf, "Batting", {"playerID": "player00001"})
+    years_in = cache(rf, "Batting", {"yearID": [1999, 2000]})
+    years_range = cache(rf, "Batting", {"yearID": {">=": 2001}})
+    other_table = cache(rf, "People", {"playerID": "player00002"})
+
+    deleted = rf.invalidate("Batting", [{"playerID": "player00002", "yearID": 2000, "teamID": "T01"}])
+
+    assert sorted(deleted) == sorted([year, years_in])
+    for k in (other_year, player, years_range, other_table):
+        assert rf.r.exists(k)
+    assert indexed(rf, "Batting") == {other_year, player, years_range}
+
+
+def test_invalidate_range_template(rf):
+    before = cache(rf, "Batting", {"yearID": {"<": 2000}})
+    after = cache(rf, "Batting", {"yearID": {">=": 2000}})
+
+    assert rf.invalidate("Batting", [{"yearID": 2005}]) == [after]
+    assert rf.r.exists(before)
+
+
+def test_invalidate_is_case_insensitive(rf):
+    key = cache(rf, "People", {"playerID": "ABC01"})
+
+    assert rf.invalidate("People", [{"PLAYERID": "abc01"}]) == [key]
+    assert not rf.r.exists(key)
+
+
+def test_invalidate_whole_table(rf):
+    keys = {cache(rf, "Batting", {"yearID": y}) for y in (2000, 2001)}
+    kept = cache(rf, "People", {"playerID": "player00001"})
+
+    assert set(rf.invalidate("Batting")) == keys
+    assert rf.r.exists(kept)
+    assert indexed(rf, "Batting") == set()
+
+
+def test_write_listener_invalidates(make_rf, writable_db):
+    rf = make_rf(db=writable_db)
+    key = cache(rf, "People", {"nameLast": "Newman"})
+
+    writable_db.insert("People", {"playerID": "zz_test", "nameLast": "Newman"})
+
+    assert not rf.r.exists(key)
+
+
+def test_index_entries_expire_with_their_keys(rf):
+    rf.set_policy("People", CachePolicy(ttl=1))
+    for i in range(12):
+        cache(rf, "People", {"playerID": "player{:05d}".format(i)})
+    assert len(indexed(rf, "People")) == 12
+
+    time.sleep(1.1)
+    live = cache(rf, "People", {"playerID": "player00100"})
+
+    assert indexed(rf, "People") == {live}
+    assert rf.r.keys("cache:template:People/*") == ["cache:template:" + live]
+    assert rf.r.keys("cache:tags:people:playerid=*") == ["cache:tags:people:playerid=player00100"]
+
+
+def test_untimed_tags_do_not_expire(rf):
+    rf.set_policy("People", CachePolicy(ttl=1))
+    cache(rf, "People", {"playerID": "player00001"})
+    rf.set_policy("People", CachePolicy(ttl=None))
+    key = cache(rf, "People", {"playerID": "player00002"})
+
+    assert rf.r.ttl(rf.tag_key("People")) == -1
+    assert rf.r.ttl(rf.template_key(key)) == -1
+
+
+def test_evicted_keys_are_unindexed(make_rf):
+    rows = [{"x": "a" * 20}]
+    rf = make_rf(max_cache_bytes=1)
+    # Room for one entry.
+    rf.budget.max_bytes = len(rf.codec.encode(rows)) * 3 // 2
+    first = cache(rf, "Batting", {"yearID": 2000}, rows)
+    second = cache(rf, "Batting", {"yearID": 2001}, rows)
+
+    assert not rf.r.exists(first)
+    assert not rf.r.exists(rf.template_key(first))
+    assert rf.r.zscore(rf.tag_key("Batting", "yearID", 2000), first) is None
+    assert indexed(rf, "Batting") == {second}
+
+
+def test_fill_read_before_a_write_is_not_cached(rf):
+    template = {"playerID": "player00003"}
+    version = rf.table_version("People")
+
+    rf.invalidate("People", [template])
+
+    assert not rf.add_to_cache("People", template, None, None, None, None, [{"x": 1}], version)
+    assert not rf.r.exists(rf.generate_key("People", template, None, None, None, None))
+
+
+def test_scalar_values_do_not_collide_with_lists(rf):
+    key = rf.generate_key("People", {"playerID": "in:a,b"}, None, None, None, None)
+
+    assert key != rf.generate_key("People", {"playerID": ["a", "b"]}, None, None, None, None)
+    assert rf.generate_key("People", {"playerID": ["a,b"]}, None, None, None, None) != \
+        rf.generate_key("People", {"playerID": ["a", "b"]}, None, None, None, None)
+
+
+def test_insert_notifies_the_row_as_stored(writable_db):
+    with writable_db.pool.connection() as cnx:
+        writable_db.run_q(cnx, "CREATE TABLE Notes (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT, "
+                               "status TEXT DEFAULT 'new')", [])
+    written = []
+    writable_db.add_write_listener(lambda table, rows: written.append((table, rows)))
+
+    writable_db.insert("Notes", {"body": "x"})
+
+    assert written == [("Notes", [{"id": 1, "body": "x", "status": "new"}])]
+
+
+def test_update_and_delete_need_a_template(writable_db):
+    with pytest.raises(ValueError):
+        writable_db.update_by_template("People", {}, {"nameLast": "x"})
+    with pytest.raises(ValueError):
+        writable_db.delete_by_template("People", None)
@@ -0,0 +1,48 @@
+def test_group_templates(rf):
+    templates = [{"playerID": "a", "yearID": 2000},
+                 {"playerID": "b", "yearID": 2000},
+                 {"playerID": "c", "yearID": 2001},
+                 {"teamID": "T01"},
+                 {"yearID": [2000, 2001]},
+                 {}]
+
+    assert sorted(rf.group_templates(templates)) == [[0, 1], [2], [3], [4], [5]]
+
+
+def test_retrieve_many_groups_misses_into_one_query(rf, counting_db):
+    templates = [{"playerID": "player{:05d}".format(i)} for i in (5, 6, 7, 8)] + [{"playerID": "nobody"}]
+
+    results = rf.retrieve_many("People", templates)
+
+    assert [[r["playerID"] for r in rows] for rows in results] == \
+        [["player00005"], ["player00006"], ["player00007"], ["player00008"], []]
+    assert len(counting_db.queries) == 1
+    assert counting_db.queries[0][1] == {"playerID": ["player00005", "player00006", "player00007",
+                                                      "player00008", "nobody"]}
+
+    assert rf.retrieve_many("People", templates[:4]) == results[:4]
+    assert len(counting_db.queries) == 1
+
+
+def test_retrieve_many_pivots_on_the_varying_column(rf, counting_db):
+    results = rf.retrieve_many("Batting", [{"teamID": "T01", "yearID": y} for y in (2000, 2001)],
+                               fields=["playerID", "teamID"])
+
+    assert len(counting_db.queries) == 1
+    assert counting_db.queries[0][1] == {"teamID": "T01", "yearID": [2000, 2001]}
+    for y, rows in zip((2000, 2001), results):
+        assert rows == rf.db.find_by_template("Batting", {"teamID": "T01", "yearID": y}, ["playerID", "teamID"])
+        assert all(set(r) == {"playerID", "teamID"} for r in rows)
+
+
+def test_retrieve_many_fills_a_repeated_template_once(make_rf, counting_db):
+    rf = make_rf(max_cache_bytes=1024 * 1024)
+    templates = [{"teamID": "T01", "yearID": y} for y in (2000, 2000, 2001)]
+
+    results = rf.retrieve_many("Batting", templates)
+
+    assert len(counting_db.queries) == 1
+    assert results[0] == results[1] == rf.db.find_by_template("Batting", templates[0])
+    sizes = rf.r.hgetall(rf.budget.sizes_key)
+    assert len(sizes) == 2
+    assert int(rf.r.get(rf.budget.total_key)) == sum(int(s) for s in sizes.values())